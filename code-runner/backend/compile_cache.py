@@ -0,0 +1,148 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import docker
+from config import COMPILE_CACHE_FOLDER, COMPILE_CACHE_SIZE_MB
+
+logger = logging.getLogger(__name__)
+
+# compiled languages write everything a run needs into this folder of the home folder
+BUILD_FOLDER = 'build'
+
+
+class CompileCache:
+    '''
+    Content-addressed store of build folders, as the tar archives Docker returns for them, with
+    least recently used builds evicted once the folder grows beyond `size_limit` bytes. The
+    recency survives restarts as the modification time of the files.
+    '''
+
+    def __init__(self, folder, size_limit):
+        self.folder = folder
+        self.size_limit = size_limit
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        if self.enabled:
+            os.makedirs(folder, exist_ok=True)
+            self.load()
+
+    @property
+    def enabled(self):
+        return self.size_limit > 0
+
+    def load(self):
+        files = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith('.tar'):
+                files.append((os.path.getmtime(path), name[:-len('.tar')], os.path.getsize(path)))
+            elif name.endswith('.tmp'):
+                os.remove(path)
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def get_key(self, compile_command, image_id, code):
+        build = hashlib.sha256(f'{compile_command}\n{image_id}'.encode('utf-8')).hexdigest()[:16]
+        return f"{build}-{hashlib.sha256(code.encode('utf-8')).hexdigest()}"
+
+    def get_path(self, key):
+        return os.path.join(self.folder, f'{key}.tar')
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self.lock:
+            if key not in self.entries:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self.get_path(key))
+            return data
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+            return None
+
+    def put(self, key, data):
+        if not self.enabled or len(data) > self.size_limit:
+            return
+        path = self.get_path(key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        with self.lock:
+            self.size += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self.counters['stores'] += 1
+        self.evict()
+
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.size <= self.size_limit or len(self.entries) == 0:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.size -= size
+                self.counters['evictions'] += 1
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            looked_up = self.counters['hits'] + self.counters['misses']
+            return {
+                'enabled': self.enabled,
+                'entries': len(self.entries),
+                'size': self.size,
+                'size_limit': self.size_limit,
+                **self.counters,
+                'hit_rate': round(self.counters['hits'] / looked_up, 4) if looked_up > 0 else None,
+            }
+
+
+def get_build_key(container, config, code):
+    # the image the container was started from, so a rebuilt image does not reuse old builds
+    return compile_cache.get_key(config['compile'], container.attrs['Image'], code)
+
+
+def restore_build(pool, container, key):
+    '''
+    Copies the cached build folder into the container, returns False if there is none. The
+    archive keeps the times of the original build, recycled containers are nonetheless cleaned
+    of it because recycling restores the home folder from its snapshot.
+    '''
+    data = compile_cache.get(key)
+    if data is None:
+        return False
+    container.put_archive(pool.home, data)
+    return True
+
+
+def save_build(pool, container, key):
+    if not compile_cache.enabled:
+        return
+    try:
+        stream, _ = container.get_archive(f'{pool.home}/{BUILD_FOLDER}')
+        compile_cache.put(key, b''.join(stream))
+    except docker.errors.NotFound:
+        logger.warning(f'The compiler wrote no {BUILD_FOLDER} folder in {pool.image}')
+
+
+def get_compile_command(config):
+    # compilers like javac add to an existing folder, start from an empty one so no stale output is cached
+    return ['sh', '-c', f"rm -rf {BUILD_FOLDER} && mkdir {BUILD_FOLDER} && {config['compile']}"]
+
+
+compile_cache = CompileCache(COMPILE_CACHE_FOLDER, COMPILE_CACHE_SIZE_MB * 1024 * 1024)
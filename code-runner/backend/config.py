@@ -1,3 +1,6 @@
+import os
+import json
+
 LANGUAGE_CONFIG = {
     'python2': {
         'env': 'python2',
@@ -25,7 +28,9 @@ LANGUAGE_CONFIG = {
         'image': 'code_runner/nodejs',
         'command': 'tsc code.ts && node code.js',
         'commandRedirect': "sh -c 'tsc code.ts && node code.js > output.txt'",
-        'extension': 'ts'
+        'extension': 'ts',
+        'compile': 'tsc code.ts --outDir build',
+        'run': 'node build/code.js'
     },
     'csharp': {
         'env' : 'dotnet',
@@ -39,55 +44,103 @@ LANGUAGE_CONFIG = {
         'image': 'code_runner/mono',
         'command': "sh -c 'mcs -out:code -codepage:utf8 code.cs && mono code --encoding=utf8'",
         'commandRedirect': "sh -c 'mcs -out:code -codepage:utf8 code.cs && mono code --encoding=utf8> output.txt'",
-        'extension': 'cs'
+        'extension': 'cs',
+        'compile': 'mcs -out:build/code -codepage:utf8 code.cs',
+        'run': 'mono build/code --encoding=utf8'
     },
     'cpp': {
         'env': 'cpp',
         'image': 'code_runner/cpp',
         'command': "sh -c 'g++ code.cpp -o code && ./code'",
         'commandRedirect': "sh -c 'g++ code.cpp -o code && ./code > output.txt'",
-        'extension': 'cpp'
+        'extension': 'cpp',
+        'compile': 'g++ code.cpp -o build/code',
+        'run': './build/code'
     },
     'go': {
         'env': 'go',
         'image': 'code_runner/go',
         'command': 'go run code.go',
         'commandRedirect': "sh -c 'go run code.go > output.txt'",
-        'extension': 'go'
+        'extension': 'go',
+        'compile': 'go build -o build/code code.go',
+        'run': './build/code'
     },
     'java': {
         'env': 'java',
         'image': 'code_runner/java',
         'command': "sh -c 'javac -encoding utf-8 code.java && java code'",
         'commandRedirect': "sh -c 'javac -encoding utf-8 code.java && java code > output.txt'",
-        'extension': 'java'
+        'extension': 'java',
+        'compile': 'javac -encoding utf-8 -d build code.java',
+        'run': 'java -cp build code'
     },
     'jupyter-csharp': {
         'env': 'jupyter',
         'image': 'code_runner/jupyterlab',
         'command': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel .net-csharp",
         'commandRedirect': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel .net-csharp",
-        'extension': 'ipynb'
+        'extension': 'ipynb',
+        'kernel': '.net-csharp'
     },
     'jupyter-fsharp': {
         'env': 'jupyter',
         'image': 'code_runner/jupyterlab',
         'command': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel .net-fsharp",
         'commandRedirect': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel .net-fsharp",
-        'extension': 'ipynb'
+        'extension': 'ipynb',
+        'kernel': '.net-fsharp'
     },
     'jupyter-python3': {
         'env': 'jupyter',
         'image': 'code_runner/jupyterlab',
         'command': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel python3",
         'commandRedirect': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel python3",
-        'extension': 'ipynb'
+        'extension': 'ipynb',
+        'kernel': 'python3'
     },
     'jupyter-r': {
         'env': 'jupyter',
         'image': 'code_runner/jupyterlab',
         'command': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel ir",
         'commandRedirect': "python /nbconvert/convert.py /home/jovyan/code.ipynb /home/jovyan/output.txt --kernel ir",
-        'extension': 'ipynb'
+        'extension': 'ipynb',
+        'kernel': 'ir'
     },
 }
+
+# warm sandbox containers kept per image, see container_pool.py
+POOL_CONFIG = {
+    # idle containers started ahead of requests
+    'min_size': int(os.getenv('CONTAINER_POOL_MIN_SIZE', '1')),
+    # idle containers kept at most, returned containers beyond this are removed
+    'max_size': int(os.getenv('CONTAINER_POOL_MAX_SIZE', '4')),
+    # runs per container, 1 gives every run a fresh container. Between runs the home folder is
+    # restored and the temp folders emptied, anything else the sandbox user can write survives,
+    # so keep 1 for images where it owns more (jovyan owns /opt/conda in code_runner/jupyterlab)
+    'max_uses': int(os.getenv('CONTAINER_POOL_MAX_USES', '1')),
+    # overrides per image, e.g. {"code_runner/jupyterlab": {"min_size": 0}}
+    'images': json.loads(os.getenv('CONTAINER_POOL_IMAGES', '{}')),
+}
+
+# runs executed at the same time, see run_limits.py
+RUN_CONFIG = {
+    'max_concurrency': int(os.getenv('MAX_CONCURRENT_RUNS', '32')),
+    # limits per language, e.g. {"jupyter-csharp": 2, "java": 4}
+    'language_limits': json.loads(os.getenv('LANGUAGE_CONCURRENCY', '{}')),
+}
+
+# kernel_server.py of the jupyterlab image, runs jupyter-* languages on warm kernels when set.
+# Opt-in: notebooks of all users then run in one container, isolated by uid instead of a
+# container per run, so only reach it over an internal network
+JUPYTER_GATEWAY_URL = os.getenv('JUPYTER_GATEWAY_URL', '')
+# the KERNEL_SERVER_TOKEN the kernel server was started with
+JUPYTER_GATEWAY_TOKEN = os.getenv('JUPYTER_GATEWAY_TOKEN', '')
+
+# output bytes sent by /api/run/stream before the run is stopped
+STREAM_OUTPUT_LIMIT = int(os.getenv('STREAM_OUTPUT_LIMIT', str(1024 * 1024)))
+
+# builds of compiled languages, keyed by the compile command, the image and the code
+COMPILE_CACHE_FOLDER = os.getenv('COMPILE_CACHE_FOLDER', './.compile_cache/')
+# least recently used builds are removed beyond this size, 0 turns the cache off
+COMPILE_CACHE_SIZE_MB = int(os.getenv('COMPILE_CACHE_SIZE_MB', '1024'))
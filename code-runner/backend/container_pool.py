@@ -0,0 +1,268 @@
+import io
+import time
+import tarfile
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import docker
+from config import LANGUAGE_CONFIG, POOL_CONFIG, JUPYTER_GATEWAY_URL
+
+logger = logging.getLogger(__name__)
+
+POOL_LABEL = 'code_runner.pool'
+# the home folder as the image has it, written when a pooled container starts and restored by recycle
+HOME_SNAPSHOT = '/run/code_runner_home.tar'
+# world-writable folders, emptied of the sandbox user's files by recycle
+TEMP_FOLDERS = ['/tmp', '/var/tmp', '/dev/shm']
+
+# creates and removes containers off the request path
+pool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='container-pool')
+pools = {}
+
+
+def get_user(config):
+    return 'sandbox' if config['env'] != 'jupyter' else 'jovyan'
+
+
+class ContainerPool:
+    '''
+    Idle sandbox containers of one image, started ahead of requests. A run takes a container,
+    copies its files in and executes the command with `exec_run`, then returns the container,
+    which is removed in the background or, when `max_uses` allows, cleaned and kept for the
+    next run.
+    '''
+
+    def __init__(self, client, image, user, min_size=1, max_size=4, max_uses=1):
+        self.client = client
+        self.image = image
+        self.user = user
+        self.home = f'/home/{user}'
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.max_uses = max(max_uses, 1)
+        self.idle = deque()
+        self.uses = {}
+        self.starting = 0
+        self.in_use = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'created': 0, 'removed': 0, 'recycled': 0, 'failed_starts': 0}
+        self.acquire_seconds = 0.0
+
+    def create(self):
+        container = self.client.containers.run(
+            image=self.image,
+            # root owns the snapshot so that code run as the sandbox user cannot change it
+            command=['sh', '-c', f'tar -cf {HOME_SNAPSHOT} -C {self.home} . && chmod 600 {HOME_SNAPSHOT} && exec sleep infinity'],
+            user='root',
+            working_dir=self.home,
+            labels={POOL_LABEL: self.image},
+            tty=True,
+            detach=True,
+            environment={
+                'LANG': 'en_US.UTF-8',
+                'LC_ALL': 'en_US.UTF-8'
+            }
+        )
+        with self.lock:
+            self.counters['created'] += 1
+        return container
+
+    def acquire(self):
+        start_time = time.time()
+        container = None
+        while container is None:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError(f'The container pool of {self.image} is closed')
+                container = self.idle.popleft() if len(self.idle) > 0 else None
+                self.counters['hits' if container is not None else 'misses'] += 1
+                self.in_use += 1
+            self.refill()
+            if container is None:
+                try:
+                    container = self.create()
+                except Exception:
+                    with self.lock:
+                        self.in_use -= 1
+                    raise
+            elif not self.is_running(container):
+                # an idle container that died is replaced by the next one
+                with self.lock:
+                    self.in_use -= 1
+                    self.counters['hits'] -= 1
+                self.remove(container)
+                container = None
+
+        with self.lock:
+            self.acquire_seconds += time.time() - start_time
+        return container
+
+    def release(self, container, reusable=True):
+        with self.lock:
+            self.in_use -= 1
+            uses = self.uses.pop(container.id, 0) + 1
+            keep = reusable and not self.closed and uses < self.max_uses and len(self.idle) + self.starting < self.max_size
+        if keep:
+            pool_executor.submit(self.recycle, container, uses)
+        else:
+            pool_executor.submit(self.remove, container)
+        self.refill()
+
+    def recycle(self, container, uses):
+        # the home folder is emptied and restored from the snapshot rather than cleaned by file
+        # times, which a run can set to anything
+        clean = (
+            f'find {self.home} -mindepth 1 -delete'
+            f' && tar -xpf {HOME_SNAPSHOT} -C {self.home}'
+            f" && find {' '.join(TEMP_FOLDERS)} -mindepth 1 -user {self.user} -delete"
+        )
+        try:
+            container.exec_run(['sh', '-c', 'kill -9 -1'], user=self.user)
+            exit_code, output = container.exec_run(['sh', '-c', clean], user='root')
+            if exit_code != 0:
+                raise RuntimeError(f"Cleaning the container exited with {exit_code}: {output.decode('utf-8', errors='replace')}")
+        except Exception:
+            logger.exception(f'Recycling a container of {self.image} failed')
+            self.remove(container)
+            return
+
+        with self.lock:
+            if self.closed:
+                keep = False
+            else:
+                keep = True
+                self.uses[container.id] = uses
+                self.idle.append(container)
+                self.counters['recycled'] += 1
+        if not keep:
+            self.remove(container)
+
+    def refill(self):
+        with self.lock:
+            missing = 0 if self.closed else self.min_size - len(self.idle) - self.starting
+            self.starting += max(missing, 0)
+        for _ in range(missing):
+            pool_executor.submit(self.add)
+
+    def add(self):
+        try:
+            container = self.create()
+        except Exception:
+            logger.exception(f'Starting a container of {self.image} failed')
+            with self.lock:
+                self.starting -= 1
+                self.counters['failed_starts'] += 1
+            return
+
+        with self.lock:
+            self.starting -= 1
+            keep = not self.closed
+            if keep:
+                self.idle.append(container)
+        if not keep:
+            self.remove(container)
+
+    def remove(self, container):
+        try:
+            container.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+        except Exception:
+            logger.exception(f'Removing container {container.id} failed')
+        with self.lock:
+            self.uses.pop(container.id, None)
+            self.counters['removed'] += 1
+
+    def is_running(self, container):
+        try:
+            container.reload()
+        except docker.errors.NotFound:
+            return False
+        return container.status == 'running'
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+        for container in idle:
+            self.remove(container)
+
+    def put_files(self, container, files):
+        '''
+        Copies `files`, a dict from names to text, into the home folder of the sandbox user.
+        '''
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for name, content in files.items():
+                data = content.encode('utf-8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o666
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+        container.put_archive(self.home, buffer.getvalue())
+
+    def read_file(self, container, name):
+        '''
+        Returns the text of a file in the home folder, or None if there is no such file.
+        '''
+        try:
+            stream, _ = container.get_archive(f'{self.home}/{name}')
+        except docker.errors.NotFound:
+            return None
+        with tarfile.open(fileobj=io.BytesIO(b''.join(stream))) as tar:
+            member = tar.next()
+            return tar.extractfile(member).read().decode('utf-8')
+
+    def stats(self):
+        with self.lock:
+            acquired = self.counters['hits'] + self.counters['misses']
+            return {
+                'idle': len(self.idle),
+                'starting': self.starting,
+                'in_use': self.in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'max_uses': self.max_uses,
+                **self.counters,
+                'hit_rate': round(self.counters['hits'] / acquired, 4) if acquired > 0 else None,
+                'average_acquire_ms': round(self.acquire_seconds / acquired * 1000, 3) if acquired > 0 else None,
+            }
+
+
+def get_pool(client, config):
+    image = config['image']
+    if image not in pools:
+        options = {key: POOL_CONFIG[key] for key in ('min_size', 'max_size', 'max_uses')}
+        options.update(POOL_CONFIG['images'].get(image, {}))
+        pools[image] = ContainerPool(client, image, get_user(config), **options)
+    return pools[image]
+
+
+def start_pools(client):
+    '''
+    Warms a pool for every image of LANGUAGE_CONFIG that is available locally, except the
+    jupyterlab image when notebooks run on the kernel server.
+    '''
+    images = set()
+    for config in LANGUAGE_CONFIG.values():
+        if config['image'] in images or (JUPYTER_GATEWAY_URL != '' and config['env'] == 'jupyter'):
+            continue
+        images.add(config['image'])
+        try:
+            client.images.get(config['image'])
+        except docker.errors.ImageNotFound:
+            logger.warning(f"Image {config['image']} is not built, no containers are started for it")
+            continue
+        get_pool(client, config).refill()
+
+
+def stop_pools():
+    for pool in pools.values():
+        pool.close()
+
+
+def get_pool_stats():
+    return {image: pool.stats() for image, pool in pools.items()}
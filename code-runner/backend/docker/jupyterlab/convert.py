@@ -12,14 +12,16 @@ def notebook_to_html(notebook_path, output_path, kernel_name=None):
     client = NotebookClient(notebook_content, kernel_name=kernel_name)
     client.execute()
 
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(export_html(notebook_content))
+
+def export_html(notebook_content):
     # 导出结果
     html_exporter = HTMLExporter(template_name='basic')
     html_exporter.exclude_input = True
 
     (body, resources) = html_exporter.from_notebook_node(notebook_content)
-
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(body)
+    return body
 
 def notebook_to_notebook(notebook_path, output_path, kernel_name=None):
     with open(notebook_path, 'r', encoding='utf-8') as f:
@@ -28,14 +30,17 @@ def notebook_to_notebook(notebook_path, output_path, kernel_name=None):
     # 执行笔记本
     client = NotebookClient(notebook_content, kernel_name=kernel_name)
     client.execute()
-    
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(export_notebook(notebook_content))
+
+def export_notebook(notebook_content):
     # 隐藏输入
     for cell in notebook_content.cells:
         if cell.cell_type == 'code':
             cell.metadata['hide_input'] = True
 
-    with open(output_path, 'w', encoding='utf-8') as f:
-        nbformat.write(notebook_content, f)
+    return nbformat.writes(notebook_content)
 
 def main():
     parser = argparse.ArgumentParser(description='Convert Jupyter Notebook to HTML.')
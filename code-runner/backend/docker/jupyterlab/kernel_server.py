@@ -0,0 +1,376 @@
+import os
+import hmac
+import json
+import time
+import shutil
+import signal
+import asyncio
+import argparse
+import tempfile
+import nbformat
+from nbclient import NotebookClient
+from nbclient.exceptions import CellExecutionError
+from jupyter_client.manager import AsyncKernelManager
+from tornado import web
+from tornado.iostream import StreamClosedError
+from convert import export_html, export_notebook
+
+# 常驻的内核服务：为每种内核预先启动若干内核，运行笔记本时直接使用，省去启动容器和内核的时间
+# 可选功能：所有用户的笔记本都在同一个容器中运行，不再是每次运行一个容器，隔离依赖以下措施：
+# 1. 服务以 root 运行，每个内核使用单独的 uid，无法读取其他内核的连接文件和工作目录，也无法向其发送信号
+# 2. /nbconvert 归 root 所有且只读，内核无法替换服务代码
+# 3. 请求需要携带 KERNEL_SERVER_TOKEN，令牌不会传给内核；服务只应接入内部网络，不要发布端口
+# docker network create --internal code_runner
+# docker run -d --network code_runner --name kernel_server --user root -e KERNEL_SERVER_TOKEN=<token> code_runner/jupyterlab \
+#     python /nbconvert/kernel_server.py --port 8888 --kernels python3 .net-csharp .net-fsharp ir
+
+EXPORTERS = {'html': export_html, 'notebook': export_notebook}
+# 内核用户可以写入的临时目录，内核关闭后清理其中属于该用户的文件
+TEMP_FOLDERS = ['/tmp', '/var/tmp', '/dev/shm']
+
+
+class KernelUsers:
+    '''
+    Hands out the uids kernels run as, one per running kernel. A uid is only handed out again
+    after every process and temporary file of its previous kernel is gone.
+    '''
+
+    def __init__(self, first_uid):
+        self.next_uid = first_uid
+        self.free = []
+
+    def acquire(self):
+        if len(self.free) > 0:
+            return self.free.pop()
+        self.next_uid += 1
+        return self.next_uid - 1
+
+    def release(self, uid):
+        self.free.append(uid)
+
+
+class SandboxKernelManager(AsyncKernelManager):
+    def write_connection_file(self, **kwargs):
+        # 连接文件中有签名密钥，只有内核自己的用户可以读取
+        super().write_connection_file(**kwargs)
+        os.chown(self.connection_file, self.kernel_uid, self.kernel_uid)
+
+
+def get_kernel_env(workdir):
+    env = {key: value for key, value in os.environ.items() if key not in ('HOME', 'USER', 'KERNEL_SERVER_TOKEN')}
+    env.update({'HOME': workdir, 'JUPYTER_RUNTIME_DIR': workdir})
+    return env
+
+
+def clean_kernel_user(uid):
+    # 结束该用户残留的进程（包括内核启动的后台进程），再删除其临时文件
+    for _ in range(10):
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit() and get_owner(f'/proc/{pid}') == uid]
+        if len(pids) == 0:
+            break
+        for pid in pids:
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        time.sleep(0.1)
+    for folder in TEMP_FOLDERS:
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if entry.stat(follow_symlinks=False).st_uid != uid:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+
+def get_owner(path):
+    try:
+        return os.stat(path).st_uid
+    except FileNotFoundError:
+        return None
+
+
+class KernelPool:
+    def __init__(self, kernel_name, size, max_runs, users):
+        self.kernel_name = kernel_name
+        self.users = users
+        self.size = size
+        self.max_runs = max(max_runs, 1)
+        self.idle = []
+        self.starting = 0
+        self.in_use = 0
+        self.counters = {'hits': 0, 'misses': 0, 'started': 0, 'reused': 0, 'shutdown': 0, 'failures': 0, 'failed_starts': 0}
+
+    async def start(self):
+        # 每个内核使用独立的用户和工作目录，工作目录只有该用户可以访问
+        uid = self.users.acquire()
+        workdir = tempfile.mkdtemp(prefix=f'kernel-{self.kernel_name}-')
+        km = SandboxKernelManager(kernel_name=self.kernel_name)
+        km.kernel_uid = uid
+        km.connection_file = os.path.join(workdir, 'kernel.json')
+        try:
+            os.chown(workdir, uid, uid)
+            await km.start_kernel(cwd=workdir, env=get_kernel_env(workdir), user=uid, group=uid, extra_groups=[])
+            await self.wait_for_ready(km)
+        except Exception:
+            await self.shutdown(km, workdir)
+            raise
+        self.counters['started'] += 1
+        return km, workdir
+
+    async def wait_for_ready(self, km):
+        kc = km.client()
+        kc.start_channels()
+        try:
+            await kc.wait_for_ready(timeout=120)
+        finally:
+            kc.stop_channels()
+
+    def refill(self):
+        missing = self.size - len(self.idle) - self.starting
+        for _ in range(max(missing, 0)):
+            self.starting += 1
+            asyncio.create_task(self.add())
+
+    async def add(self):
+        try:
+            kernel = await self.start()
+        except Exception as e:
+            print(f"内核 '{self.kernel_name}' 启动失败: {e}")
+            self.counters['failed_starts'] += 1
+            return
+        finally:
+            self.starting -= 1
+        self.idle.append((*kernel, 0))
+
+    async def acquire(self):
+        self.in_use += 1
+        if len(self.idle) > 0:
+            self.counters['hits'] += 1
+            kernel = self.idle.pop(0)
+        else:
+            self.counters['misses'] += 1
+            try:
+                kernel = (*await self.start(), 0)
+            except Exception:
+                self.in_use -= 1
+                raise
+        self.refill()
+        return kernel
+
+    def release(self, km, workdir, runs, healthy):
+        # 内核默认只运行一次，每次运行都使用新的内核；max_runs 大于 1 时复用内核，变量等状态会保留到下一次运行
+        self.in_use -= 1
+        if healthy and runs < self.max_runs:
+            self.counters['reused'] += 1
+            self.idle.append((km, workdir, runs))
+        else:
+            asyncio.create_task(self.shutdown(km, workdir))
+            self.refill()
+
+    async def shutdown(self, km, workdir):
+        try:
+            await km.shutdown_kernel(now=True)
+        except Exception as e:
+            print(f"内核 '{self.kernel_name}' 关闭失败: {e}")
+        shutil.rmtree(workdir, ignore_errors=True)
+        try:
+            await asyncio.to_thread(clean_kernel_user, km.kernel_uid)
+            self.users.release(km.kernel_uid)
+        except Exception as e:
+            # 清理失败的 uid 不再使用
+            print(f"内核用户 {km.kernel_uid} 清理失败: {e}")
+        self.counters['shutdown'] += 1
+
+    async def run(self, code, output_format, timeout):
+        km, workdir, runs = await self.acquire()
+        notebook = nbformat.v4.new_notebook()
+        notebook.cells.append(nbformat.v4.new_code_cell(code))
+        client = NotebookClient(notebook, km=km, kernel_name=self.kernel_name, timeout=timeout)
+        healthy = False
+        try:
+            await client.async_execute()
+            healthy = True
+        except CellExecutionError:
+            # 代码本身出错时内核仍然可用
+            healthy = True
+            raise
+        except Exception:
+            # 超时或崩溃的内核不再复用
+            self.counters['failures'] += 1
+            raise
+        finally:
+            if client.kc is not None:
+                client.kc.stop_channels()
+            self.release(km, workdir, runs + 1, healthy)
+        return EXPORTERS[output_format](notebook)
+
+    async def stream(self, code, timeout):
+        # 逐条转发内核 iopub 上的输出，文本直接发送，图表等富输出用 HTMLExporter 渲染
+        km, workdir, runs = await self.acquire()
+        kc = km.client()
+        kc.start_channels()
+        messages = asyncio.Queue()
+        execution = None
+        healthy = False
+        try:
+            await kc.wait_for_ready(timeout=timeout)
+            execution = asyncio.ensure_future(kc.execute_interactive(code, output_hook=messages.put_nowait, allow_stdin=False, timeout=timeout))
+            execution.add_done_callback(lambda _: messages.put_nowait(None))
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                event = to_event(message)
+                if event is not None:
+                    yield event
+            reply = execution.result()
+            healthy = True
+            yield {'status': reply['content']['status']}
+        finally:
+            if execution is not None and not execution.done():
+                execution.cancel()
+            if not healthy:
+                # 超时、崩溃或客户端断开时内核可能仍在运行，不再复用
+                self.counters['failures'] += 1
+            kc.stop_channels()
+            self.release(km, workdir, runs + 1, healthy)
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        await asyncio.gather(*[self.shutdown(km, workdir) for km, workdir, _ in idle])
+
+    def stats(self):
+        acquired = self.counters['hits'] + self.counters['misses']
+        return {
+            'idle': len(self.idle),
+            'starting': self.starting,
+            'in_use': self.in_use,
+            'size': self.size,
+            'max_runs': self.max_runs,
+            **self.counters,
+            'hit_rate': round(self.counters['hits'] / acquired, 4) if acquired > 0 else None,
+        }
+
+
+class AuthenticatedHandler(web.RequestHandler):
+    def prepare(self):
+        expected = f"Bearer {self.settings['token']}"
+        if not hmac.compare_digest(self.request.headers.get('Authorization', '').encode('utf-8'), expected.encode('utf-8')):
+            self.set_status(401)
+            self.finish({'error': 'invalid token'})
+
+    def write_error_message(self, message):
+        self.set_status(400)
+        self.write({'error': message})
+
+
+class RunHandler(AuthenticatedHandler):
+    def initialize(self, pools, timeout):
+        self.pools = pools
+        self.timeout = timeout
+
+    async def post(self):
+        body = json.loads(self.request.body)
+        pool = self.pools.get(body.get('kernel'))
+        output_format = body.get('format', 'html')
+        if pool is None:
+            return self.write_error_message(f"unsupported kernel '{body.get('kernel')}'")
+        if output_format not in EXPORTERS:
+            return self.write_error_message(f"unsupported output format '{output_format}' for nbconvert")
+
+        start_time = time.time()
+        try:
+            output = await pool.run(body['code'], output_format, self.timeout)
+            self.write({'output': output, 'time': time.time() - start_time})
+        except Exception as e:
+            self.write({'output': None, 'error': str(e), 'time': time.time() - start_time})
+
+
+class StreamHandler(RunHandler):
+    async def post(self):
+        body = json.loads(self.request.body)
+        pool = self.pools.get(body.get('kernel'))
+        if pool is None:
+            return self.write_error_message(f"unsupported kernel '{body.get('kernel')}'")
+
+        self.set_header('Content-Type', 'application/x-ndjson')
+        events = pool.stream(body['code'], self.timeout)
+        try:
+            async for event in events:
+                self.write(json.dumps(event) + '\n')
+                await self.flush()
+        except StreamClosedError:
+            pass
+        except Exception as e:
+            self.write(json.dumps({'error': str(e) or type(e).__name__}) + '\n')
+        finally:
+            await events.aclose()
+
+
+def to_event(message):
+    msg_type = message['header']['msg_type']
+    content = message['content']
+    if msg_type == 'stream':
+        return {'text': content['text']}
+    if msg_type == 'error':
+        return {'text': '\n'.join(content['traceback']) + '\n'}
+    if msg_type in ('execute_result', 'display_data'):
+        notebook = nbformat.v4.new_notebook()
+        cell = nbformat.v4.new_code_cell()
+        cell.outputs.append(nbformat.v4.output_from_msg(message))
+        notebook.cells.append(cell)
+        return {'html': export_html(notebook)}
+    return None
+
+
+class StatsHandler(AuthenticatedHandler):
+    def initialize(self, pools):
+        self.pools = pools
+
+    def get(self):
+        self.write({kernel_name: pool.stats() for kernel_name, pool in self.pools.items()})
+
+
+async def serve(args, token):
+    users = KernelUsers(args.first_uid)
+    pools = {kernel_name: KernelPool(kernel_name, args.size, args.max_runs, users) for kernel_name in args.kernels}
+    app = web.Application([
+        (r'/run', RunHandler, {'pools': pools, 'timeout': args.timeout}),
+        (r'/run/stream', StreamHandler, {'pools': pools, 'timeout': args.timeout}),
+        (r'/stats', StatsHandler, {'pools': pools}),
+    ], token=token)
+    app.listen(args.port, address=args.host)
+    for pool in pools.values():
+        pool.refill()
+    print(f'内核服务已启动: http://{args.host}:{args.port}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await asyncio.gather(*[pool.close() for pool in pools.values()])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run notebooks against warm Jupyter kernels.')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--kernels', nargs='+', default=['python3', '.net-csharp', '.net-fsharp', 'ir'], help='Kernel names to keep warm')
+    parser.add_argument('--size', type=int, default=1, help='Idle kernels kept per kernel name')
+    parser.add_argument('--max-runs', type=int, default=1, help='Runs per kernel, kernels keep their state between runs, also between runs of different users')
+    parser.add_argument('--timeout', type=int, default=60, help='Seconds a cell may run before its kernel is replaced')
+    parser.add_argument('--first-uid', type=int, default=20000, help='Kernels run as uids from this one on, one uid per running kernel')
+
+    args = parser.parse_args()
+    # 令牌从环境变量中移除，避免被内核继承
+    token = os.environ.pop('KERNEL_SERVER_TOKEN', '')
+    if token == '':
+        parser.error('KERNEL_SERVER_TOKEN is required')
+    if os.geteuid() != 0:
+        parser.error('the kernel server needs to run as root to start kernels as other users')
+    asyncio.run(serve(args, token))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import json
+import httpx
+from config import JUPYTER_GATEWAY_URL, JUPYTER_GATEWAY_TOKEN
+
+# runs of the kernel server take as long as their cells, it enforces its own timeout
+gateway_client = httpx.AsyncClient(
+    base_url=JUPYTER_GATEWAY_URL,
+    headers={'Authorization': f'Bearer {JUPYTER_GATEWAY_TOKEN}'},
+    timeout=httpx.Timeout(600, connect=10)
+)
+
+
+def is_gateway_run(config):
+    return JUPYTER_GATEWAY_URL != '' and config['env'] == 'jupyter'
+
+
+async def run_on_gateway(config, code, format):
+    '''
+    Runs `code` on a warm kernel of the kernel server. Returns the rendered output, or None if
+    the code failed like convert.py does.
+    '''
+    response = await gateway_client.post('/run', json={'kernel': config['kernel'], 'code': code, 'format': format})
+    if response.status_code == 400:
+        raise ValueError(response.json()['error'])
+    response.raise_for_status()
+    return response.json()['output']
+
+
+async def stream_on_gateway(config, code):
+    '''
+    Runs `code` on a warm kernel and yields its outputs as the kernel publishes them, text as
+    UTF-8 like the output of a container, then the exit code.
+    '''
+    async with gateway_client.stream('POST', '/run/stream', json={'kernel': config['kernel'], 'code': code}) as response:
+        if response.status_code == 400:
+            await response.aread()
+            raise ValueError(response.json()['error'])
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line == '':
+                continue
+            event = json.loads(line)
+            if 'error' in event:
+                raise RuntimeError(event['error'])
+            if 'text' in event:
+                yield 'output', event['text'].encode('utf-8')
+            elif 'html' in event:
+                yield 'html', event['html']
+            elif 'status' in event:
+                yield 'exit', 0 if event['status'] == 'ok' else 1
+
+
+async def get_gateway_stats():
+    if JUPYTER_GATEWAY_URL == '':
+        return None
+    try:
+        response = await gateway_client.get('/stats')
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        return {'error': str(e)}
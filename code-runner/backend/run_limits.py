@@ -0,0 +1,51 @@
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+from config import RUN_CONFIG
+
+
+class RunLimiter:
+    '''
+    Bounds the runs executed at the same time, in total and per language. A run first waits for
+    a slot of its language so that a busy language does not hold global slots while it queues.
+    '''
+
+    def __init__(self, max_concurrency, language_limits):
+        self.max_concurrency = max_concurrency
+        self.language_limits = language_limits
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.language_slots = {language: asyncio.Semaphore(limit) for language, limit in language_limits.items()}
+        self.running = {}
+        self.waiting = {}
+
+    @asynccontextmanager
+    async def slot(self, language):
+        self.waiting[language] = self.waiting.get(language, 0) + 1
+        admitted = False
+        try:
+            async with self.language_slots.get(language, nullcontext()):
+                async with self.slots:
+                    admitted = True
+                    self.waiting[language] -= 1
+                    self.running[language] = self.running.get(language, 0) + 1
+                    try:
+                        yield
+                    finally:
+                        self.running[language] -= 1
+        finally:
+            if not admitted:
+                self.waiting[language] -= 1
+
+    def stats(self):
+        return {
+            'max_concurrency': self.max_concurrency,
+            'language_limits': self.language_limits,
+            'running': sum(self.running.values()),
+            'waiting': sum(self.waiting.values()),
+            'languages': {
+                language: {'running': self.running.get(language, 0), 'waiting': self.waiting.get(language, 0)}
+                for language in sorted(set(self.running) | set(self.waiting))
+            },
+        }
+
+
+run_limiter = RunLimiter(RUN_CONFIG['max_concurrency'], RUN_CONFIG['language_limits'])
@@ -1,16 +1,30 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Body, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import asynccontextmanager
 import docker
+import nbformat
 from pydantic import BaseModel
-import os
-import shutil
-import uuid
 import time
-from config import LANGUAGE_CONFIG
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from config import LANGUAGE_CONFIG, RUN_CONFIG, STREAM_OUTPUT_LIMIT
 from fastapi.middleware.cors import CORSMiddleware
-from utils import code_to_ipynb, code_to_file, remove_ansi_sequences
+from utils import code_to_notebook, remove_ansi_sequences
+from container_pool import get_pool, start_pools, stop_pools, get_pool_stats
+from run_limits import run_limiter
+from jupyter_gateway import is_gateway_run, run_on_gateway, stream_on_gateway, get_gateway_stats
+from streaming import OutputStream, format_event, iterate_in_thread
+from functools import partial
+from compile_cache import compile_cache, get_build_key, restore_build, save_build, get_compile_command
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_pools(client)
+    yield
+    stop_pools()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -19,6 +33,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 client = docker.from_env()
+# every admitted run holds one thread while its Docker calls block
+executor = ThreadPoolExecutor(max_workers=RUN_CONFIG['max_concurrency'], thread_name_prefix='run')
 
 
 class RunCodeRequest(BaseModel):
@@ -30,58 +46,194 @@ class RunCodeRequest(BaseModel):
 @app.post("/api/run")
 async def run_code(request: RunCodeRequest = Body(...), format: str = Query(default='html')):
     start_time = time.time()
-    container_name = f"./runner_{uuid.uuid4().hex}"
     config = LANGUAGE_CONFIG.get(request.language)
 
     if not config:
         raise HTTPException(
             status_code=400, detail=f"Unsupported language: {request.language}")
 
-    extension = config['extension']
-    os.makedirs(container_name, exist_ok=True)
-    if config['env'] != 'jupyter':
-        code_to_file(request.code, os.path.join(container_name, f'code.{extension}'))
+    if config['env'] != 'jupyter' or is_gateway_run(config):
+        code = request.code
     else:
-        code_to_ipynb(request.code, os.path.join(container_name, f'code.{extension}'))
+        code = nbformat.writes(code_to_notebook(request.code))
+
+    try:
+        async with run_limiter.slot(request.language):
+            if is_gateway_run(config):
+                output = await run_on_gateway(config, code, format)
+                output = output if output is not None else 'An error occurs when executing code.'
+            else:
+                loop = asyncio.get_running_loop()
+                output = await loop.run_in_executor(executor, execute, config, code, format)
+    except Exception as e:
+         raise HTTPException(status_code=500, detail=str(e))
+
+    type = f'text/{format}' if config['env'] == 'jupyter' else 'text/plain'
+    return JSONResponse(content={"output": output, 'type': type, 'time': time.time() - start_time})
+
 
+def execute(config, code, format):
+    '''
+    Runs `code` in a pooled container and returns its output. The Docker calls block, so this
+    runs on `executor` rather than on the event loop.
+    '''
+    pool = get_pool(client, config)
+    container = pool.acquire()
+    reusable = False
+    environment = {
+        'LANG': 'en_US.UTF-8',
+        'LC_ALL': 'en_US.UTF-8',
+        'NBCONVERT_OUTPUT_FORMAT': format
+    }
     try:
-        user = 'sandbox' if config['env'] != 'jupyter' else 'jovyan'
-        container = client.containers.run(
-            image=config['image'],
-            command=config['commandRedirect'],
-            volumes={os.path.abspath(container_name): {
-                'bind': f'/home/{user}', 'mode': 'rw'}
-            },
+        pool.put_files(container, {f"code.{config['extension']}": code})
+        command = config['commandRedirect']
+        if 'compile' in config:
+            key = get_build_key(container, config, code)
+            if not restore_build(pool, container, key):
+                exit_code, _ = container.exec_run(get_compile_command(config), user=pool.user, workdir=pool.home, tty=True, environment=environment)
+                if exit_code != 0:
+                    # like commandRedirect, a failed compilation leaves no output.txt
+                    reusable = True
+                    return 'An error occurs when executing code.'
+                save_build(pool, container, key)
+            command = ['sh', '-c', f"{config['run']} > output.txt"]
+
+        _, logs = container.exec_run(
+            command,
+            user=pool.user,
+            workdir=pool.home,
             tty=True,
-            detach=True,
-            environment={
-                'LANG': 'en_US.UTF-8',
-                'LC_ALL': 'en_US.UTF-8',
-                'NBCONVERT_OUTPUT_FORMAT': format
-            }
+            environment=environment
         )
-        container.wait()
 
-        output = container.logs().decode('utf-8')
+        output = logs.decode('utf-8')
         output = remove_ansi_sequences(output)
 
-        redirected_output = os.path.join(container_name, 'output.txt')
-        if not os.path.exists(redirected_output):
+        content = pool.read_file(container, 'output.txt')
+        if content is None:
             output = 'An error occurs when executing code.'
         else:
-            with open(os.path.join(container_name, 'output.txt'), 'rt', encoding='utf-8') as f:
-                content = f.read()
-                output = content if content != '' else output
+            output = content if content != '' else output
+        reusable = True
+        return output
+    finally:
+        pool.release(container, reusable)
+
+
+@app.post("/api/run/stream")
+async def run_code_stream(request: RunCodeRequest = Body(...)):
+    '''
+    Runs the code like /api/run but sends the output as server-sent events while it is produced:
+    `output` events with `text` or, for rich notebook outputs, `html`, then one `done` event.
+    '''
+    config = LANGUAGE_CONFIG.get(request.language)
+
+    if not config:
+        raise HTTPException(
+            status_code=400, detail=f"Unsupported language: {request.language}")
+
+    return StreamingResponse(stream_run(request, config), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
-        type = f'text/{format}' if config['env'] == 'jupyter' else 'text/plain'
-        return JSONResponse(content={"output": output, 'type': type, 'time': time.time() - start_time})
-            
+
+async def stream_run(request, config):
+    start_time = time.time()
+    output = OutputStream(STREAM_OUTPUT_LIMIT)
+    exit_code = None
+    try:
+        async with run_limiter.slot(request.language):
+            if is_gateway_run(config):
+                chunks = stream_on_gateway(config, request.code)
+            elif config['env'] == 'jupyter':
+                chunks = stream_notebook(config, request.code)
+            else:
+                chunks = stream_in_container(config, request.code)
+            try:
+                async for kind, value in chunks:
+                    if kind == 'exit':
+                        exit_code = value
+                        continue
+                    data = {'text': output.feed(value)} if kind == 'output' else {'html': output.take_html(value)}
+                    if data.get('text', data.get('html')):
+                        yield format_event('output', data)
+                    if output.truncated:
+                        break
+                text = output.feed(b'', final=True)
+                if text:
+                    yield format_event('output', {'text': text})
+            finally:
+                # stops a run that is cut off or whose client went away
+                await chunks.aclose()
     except Exception as e:
-         raise HTTPException(status_code=500, detail=str(e))
+        yield format_event('error', {'detail': str(e)})
+    yield format_event('done', {'exit_code': exit_code, 'truncated': output.truncated, 'time': time.time() - start_time})
+
+
+async def stream_in_container(config, code):
+    '''
+    Runs `config['command']` in a pooled container and yields its raw output as it arrives, then
+    the exit code. Compiled languages run `config['run']` on a cached build when there is one.
+    '''
+    loop = asyncio.get_running_loop()
+    pool = get_pool(client, config)
+    container = await loop.run_in_executor(executor, pool.acquire)
+    reusable = False
+    try:
+        await loop.run_in_executor(executor, pool.put_files, container, {f"code.{config['extension']}": code})
+        command = config['command']
+        if 'compile' in config:
+            key = get_build_key(container, config, code)
+            if not await loop.run_in_executor(executor, restore_build, pool, container, key):
+                async for kind, value in stream_exec(pool, container, get_compile_command(config)):
+                    if kind == 'exit' and value != 0:
+                        reusable = True
+                        yield kind, value
+                        return
+                    if kind == 'output':
+                        yield kind, value
+                await loop.run_in_executor(executor, save_build, pool, container, key)
+            command = config['run']
+
+        async for kind, value in stream_exec(pool, container, command):
+            reusable = kind == 'exit'
+            yield kind, value
     finally:
-        container.stop()
-        container.remove(force=True)
-        shutil.rmtree(container_name)
+        # a container whose run was stopped early is removed, which also ends the exec stream
+        pool.release(container, reusable)
+
+
+async def stream_exec(pool, container, command):
+    loop = asyncio.get_running_loop()
+    exec_id = await loop.run_in_executor(executor, partial(
+        client.api.exec_create,
+        container.id,
+        command,
+        user=pool.user,
+        workdir=pool.home,
+        tty=True,
+        environment={
+            'LANG': 'en_US.UTF-8',
+            'LC_ALL': 'en_US.UTF-8'
+        }
+    ))
+    chunks = await loop.run_in_executor(executor, partial(client.api.exec_start, exec_id, tty=True, stream=True))
+    async for chunk in iterate_in_thread(chunks, executor):
+        yield 'output', chunk
+    result = await loop.run_in_executor(executor, client.api.exec_inspect, exec_id)
+    yield 'exit', result['ExitCode']
+
+
+async def stream_notebook(config, code):
+    # convert.py renders the notebook once it has run, so there is only one chunk
+    loop = asyncio.get_running_loop()
+    output = await loop.run_in_executor(executor, execute, config, nbformat.writes(code_to_notebook(code)), 'html')
+    yield 'html', output
+    yield 'exit', 0
+
+
+@app.get("/api/stats")
+async def get_stats():
+    return {'container_pools': get_pool_stats(), 'runs': run_limiter.stats(), 'compile_cache': compile_cache.stats(), 'jupyter_gateway': await get_gateway_stats()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,90 @@
+import re
+import json
+import codecs
+import asyncio
+from utils import remove_ansi_sequences
+
+# an escape sequence cut off at the end of a chunk, completed by the next chunk
+partial_ansi_sequence = re.compile(r'\x1b(\[[0-?]*[ -/]*)?$')
+
+
+class OutputStream:
+    '''
+    Turns the raw output of a run into text chunk by chunk: decodes UTF-8 and strips ANSI
+    sequences across chunk boundaries, and cuts the output off after `limit` bytes.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.pending = ''
+
+    def feed(self, data, final=False):
+        text = self.pending + self.decoder.decode(data, final=final)
+        match = partial_ansi_sequence.search(text)
+        if match is not None and not final and len(text) - match.start() < 64:
+            self.pending = text[match.start():]
+            text = text[:match.start()]
+        else:
+            self.pending = ''
+        return self.take(remove_ansi_sequences(text))
+
+    def take(self, text):
+        '''
+        Returns the part of `text` that fits into the limit.
+        '''
+        size = len(text.encode('utf-8'))
+        if self.size + size > self.limit:
+            self.truncated = True
+            text = text.encode('utf-8')[:self.limit - self.size].decode('utf-8', errors='ignore')
+            # the bytes of a character that did not fit stay unused, nothing is sent after the cut
+            self.size = self.limit
+            return text
+        self.size += size
+        return text
+
+    def take_html(self, html):
+        '''
+        Returns `html` if all of it fits into the limit, and nothing otherwise, since cut markup
+        would leave broken tags.
+        '''
+        size = len(html.encode('utf-8'))
+        if self.size + size > self.limit:
+            self.truncated = True
+            self.size = self.limit
+            return ''
+        self.size += size
+        return html
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+async def iterate_in_thread(iterator, executor):
+    '''
+    Consumes a blocking iterator on `executor` and yields its items on the event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end = object()
+
+    def pump():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (end, e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, (end, None))
+
+    loop.run_in_executor(executor, pump)
+    while True:
+        item, error = await queue.get()
+        if error is not None:
+            raise error
+        if item is end:
+            return
+        yield item
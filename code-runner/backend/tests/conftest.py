@@ -0,0 +1,6 @@
+import os, sys
+
+# the modules of the backend import each other by name, as when server.py is run from this folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# keeps the module level compile cache from creating its folder, the tests use their own caches
+os.environ['COMPILE_CACHE_SIZE_MB'] = '0'
@@ -0,0 +1,73 @@
+import os
+import time
+from compile_cache import CompileCache, get_compile_command
+
+
+def test_get_and_put(tmp_path):
+    cache = CompileCache(str(tmp_path), 100)
+    assert cache.get('a') is None
+    cache.put('a', b'build')
+    assert cache.get('a') == b'build'
+    stats = cache.stats()
+    assert (stats['entries'], stats['size'], stats['hits'], stats['misses'], stats['stores']) == (1, 5, 1, 1, 1)
+
+
+def test_replacing_an_entry_keeps_the_size(tmp_path):
+    cache = CompileCache(str(tmp_path), 100)
+    cache.put('a', b'x' * 10)
+    cache.put('a', b'x' * 20)
+    assert cache.size == 20
+    assert len(cache.entries) == 1
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = CompileCache(str(tmp_path), 30)
+    for key in 'abc':
+        cache.put(key, b'x' * 10)
+    cache.get('a')
+    cache.put('d', b'x' * 10)
+
+    assert list(cache.entries) == ['c', 'a', 'd']
+    assert cache.size == 30
+    assert cache.stats()['evictions'] == 1
+    assert sorted(os.listdir(tmp_path)) == ['a.tar', 'c.tar', 'd.tar']
+
+
+def test_skips_builds_larger_than_the_limit(tmp_path):
+    cache = CompileCache(str(tmp_path), 10)
+    cache.put('a', b'x' * 11)
+    assert cache.get('a') is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_reload_keeps_recency_and_size(tmp_path):
+    cache = CompileCache(str(tmp_path), 100)
+    for index, key in enumerate('abc'):
+        cache.put(key, b'x' * 10)
+        os.utime(cache.get_path(key), (time.time() - 10 + index,) * 2)
+    cache.get('a')
+    (tmp_path / 'd.tar.tmp').write_bytes(b'unfinished')
+
+    reloaded = CompileCache(str(tmp_path), 25)
+    assert list(reloaded.entries) == ['c', 'a']
+    assert reloaded.size == 20
+    assert sorted(os.listdir(tmp_path)) == ['a.tar', 'c.tar']
+
+
+def test_key_depends_on_image_and_code(tmp_path):
+    cache = CompileCache(str(tmp_path), 100)
+    key = cache.get_key('javac', 'sha256:1', 'code')
+    assert key == cache.get_key('javac', 'sha256:1', 'code')
+    assert key != cache.get_key('javac', 'sha256:2', 'code')
+    assert key != cache.get_key('javac', 'sha256:1', 'other code')
+
+
+def test_disabled_cache(tmp_path):
+    cache = CompileCache(str(tmp_path / 'cache'), 0)
+    cache.put('a', b'build')
+    assert cache.get('a') is None
+    assert not os.path.exists(tmp_path / 'cache')
+
+
+def test_compiles_into_an_empty_build_folder():
+    assert get_compile_command({'compile': 'javac -d build code.java'}) == ['sh', '-c', 'rm -rf build && mkdir build && javac -d build code.java']
@@ -0,0 +1,61 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from streaming import OutputStream, format_event, iterate_in_thread
+
+
+def test_decodes_characters_split_across_chunks():
+    output = OutputStream(100)
+    data = '你好'.encode('utf-8')
+    assert output.feed(data[:2]) == ''
+    assert output.feed(data[2:]) == '你好'
+
+
+def test_strips_ansi_sequences_split_across_chunks():
+    output = OutputStream(100)
+    assert output.feed(b'red \x1b[3') == 'red '
+    assert output.feed(b'1mtext\x1b[0m') == 'text'
+    assert output.feed(b'\x1b', final=True) == '\x1b'
+
+
+def test_cuts_off_at_the_limit_without_splitting_characters():
+    output = OutputStream(7)
+    assert output.feed(b'abcd') == 'abcd'
+    assert output.feed('éé'.encode('utf-8')) == 'é'
+    assert output.truncated
+    assert output.feed(b'more') == ''
+
+
+def test_html_is_sent_whole_or_not_at_all():
+    output = OutputStream(20)
+    assert output.take_html('<p>short</p>') == '<p>short</p>'
+    assert not output.truncated
+    assert output.take_html('<p>too long</p>') == ''
+    assert output.truncated
+
+
+def test_format_event():
+    assert format_event('output', {'text': 'é'}) == 'event: output\ndata: {"text": "é"}\n\n'
+
+
+def test_iterate_in_thread():
+    def items():
+        yield 1
+        yield 2
+        raise RuntimeError('stopped')
+
+    async def consume():
+        received = []
+        with pytest.raises(RuntimeError, match='stopped'):
+            async for item in iterate_in_thread(items(), executor):
+                received.append(item)
+        return received
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        assert asyncio.run(consume()) == [1, 2]
+
+
+def test_sends_nothing_after_skipped_html():
+    output = OutputStream(20)
+    assert output.take_html('<p>' + 'x' * 20 + '</p>') == ''
+    assert output.feed(b'text') == ''
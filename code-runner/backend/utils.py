@@ -1,20 +1,14 @@
 import nbformat
 import re
 
-def code_to_ipynb(code_string, notebook_name='output_notebook.ipynb'):
+def code_to_notebook(code_string):
     nb = nbformat.v4.new_notebook()
 
     code_cell = nbformat.v4.new_code_cell(code_string)
 
     nb['cells'].append(code_cell)
 
-    with open(notebook_name, 'wt', encoding='utf-8') as f:
-        nbformat.write(nb, f)
-
-def code_to_file(code_string, file_path):
-    with open(file_path, 'wt', encoding='utf-8') as f:
-        f.write(code_string)
-
+    return nb
 
 def remove_ansi_sequences(input_string):
     ansi_escape = re.compile(r'\x1b\[([0-?]*[ -/]*[@-~])')
@@ -0,0 +1,209 @@
+from typing import Awaitable, Callable, Dict, List, Optional
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from time import time, perf_counter
+import os, json, math, heapq, asyncio, itertools, threading
+
+priorities = {'interactive': 0, 'default': 1, 'batch': 2}
+
+class AdmissionRejected(Exception):
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f'Too many requests queued for {name}')
+        self.retry_after = retry_after
+
+class DeadlineExceeded(Exception):
+    pass
+
+class ClientDisconnected(Exception):
+    pass
+
+
+@dataclass(order=True)
+class Waiter:
+    priority: int
+    sequence: int
+    future: asyncio.Future = field(compare=False)
+
+
+class ConcurrencyLimiter:
+    '''
+    Lets at most `max_concurrency` requests run at once (0 means no limit) and queues up to
+    `max_queue` more, which are admitted by priority and then in arrival order. Requests beyond
+    that are rejected with a `Retry-After` estimated from the recent service time.
+    '''
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiters: List[Waiter] = []
+        self.sequence = itertools.count()
+        self.service_time = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    async def acquire(self, priority: int, deadline: Optional[float]):
+        if self.max_concurrency <= 0 or (self.running < self.max_concurrency and len(self.waiters) == 0):
+            self.running += 1
+            self.admitted += 1
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(self.name, self.retry_after())
+
+        waiter = Waiter(priority=priority, sequence=next(self.sequence), future=asyncio.get_event_loop().create_future())
+        heapq.heappush(self.waiters, waiter)
+        try:
+            timeout = None if deadline is None else max(deadline - time(), 0)
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted at the same moment, hand the slot on
+                self.release()
+            else:
+                # leave the queue now, a waiter left in the heap would count against max_queue
+                waiter.future.cancel()
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                self.expired += 1
+                raise DeadlineExceeded(f'Deadline passed while queued for {self.name}')
+            raise
+        self.admitted += 1
+
+    def release(self, service_time: Optional[float] = None):
+        if service_time is not None:
+            self.service_time = 0.9 * self.service_time + 0.1 * service_time
+        if len(self.waiters) > 0:
+            # the slot passes straight to the waiter, `running` stays the same
+            heapq.heappop(self.waiters).future.set_result(None)
+            return
+        self.running -= 1
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.service_time * (len(self.waiters) + 1) / max(self.max_concurrency, 1)))
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'queued': len(self.waiters),
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'expired': self.expired,
+            'avg_service_seconds': round(self.service_time, 3),
+        }
+
+
+max_concurrent_requests = int(os.getenv('MAX-CONCURRENT-REQUESTS', '64'))
+max_queued_requests = int(os.getenv('MAX-QUEUED-REQUESTS', '256'))
+request_timeout = float(os.getenv('REQUEST-TIMEOUT', '0'))
+# e.g. {"Qwen/Qwen1.5-1.8B-Chat": 4}, models without an entry are only bound by the global limit
+model_concurrency: Dict[str, int] = json.loads(os.getenv('MODEL-CONCURRENCY', '{}'))
+
+global_limiter = ConcurrencyLimiter('all models', max_concurrent_requests, max_queued_requests)
+model_limiters: Dict[str, ConcurrencyLimiter] = {}
+
+def get_model_limiter(model_name: str) -> Optional[ConcurrencyLimiter]:
+    if model_name not in model_concurrency:
+        return None
+    if model_name not in model_limiters:
+        model_limiters[model_name] = ConcurrencyLimiter(model_name, model_concurrency[model_name], max_queued_requests)
+    return model_limiters[model_name]
+
+@asynccontextmanager
+async def admit(model_name: str, priority: int, deadline: Optional[float], is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None):
+    '''
+    Holds a slot of the model and a global one while the block runs. The model slot is taken
+    first so that requests waiting for a busy model do not hold up other models. With
+    `is_disconnected`, a client that goes away while queued gives up its place in the queue.
+    '''
+    if deadline is not None and time() >= deadline:
+        raise DeadlineExceeded('Deadline passed before the request was admitted')
+    limiters = [limiter for limiter in [get_model_limiter(model_name), global_limiter] if limiter is not None]
+    acquired = []
+    try:
+        for limiter in limiters:
+            if is_disconnected is None:
+                await limiter.acquire(priority, deadline)
+            else:
+                await acquire_while_connected(limiter, priority, deadline, is_disconnected)
+            acquired.append(limiter)
+        started_at = perf_counter()
+        yield
+    finally:
+        service_time = perf_counter() - started_at if len(acquired) == len(limiters) else None
+        for limiter in reversed(acquired):
+            limiter.release(service_time)
+
+async def acquire_while_connected(limiter: ConcurrencyLimiter, priority: int, deadline: Optional[float], is_disconnected: Callable[[], Awaitable[bool]], poll_interval: float = 0.25):
+    task = asyncio.ensure_future(limiter.acquire(priority, deadline))
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if task in done:
+                return task.result()
+            if await is_disconnected():
+                raise ClientDisconnected('Client disconnected while queued')
+    except BaseException:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            # admitted while the disconnect was checked
+            limiter.release()
+        raise
+
+def get_deadline(timeout_header: Optional[str], deadline: Optional[float]) -> Optional[float]:
+    '''
+    The earliest of the `deadline` field (unix time), the `X-Request-Timeout` header (seconds)
+    and REQUEST-TIMEOUT. Raises ValueError if the header is not a number of seconds.
+    '''
+    deadlines = [deadline] if deadline is not None else []
+    if timeout_header:
+        try:
+            timeout = float(timeout_header)
+        except ValueError:
+            timeout = math.nan
+        if not math.isfinite(timeout) or timeout < 0:
+            raise ValueError(f'X-Request-Timeout needs to be a number of seconds, got {timeout_header!r}')
+        deadlines.append(time() + timeout)
+    if request_timeout > 0:
+        deadlines.append(time() + request_timeout)
+    return min(deadlines) if len(deadlines) > 0 else None
+
+def get_priority(priority_header: Optional[str], default: str) -> int:
+    return priorities.get((priority_header or default).lower(), priorities[default])
+
+async def run_cancellable(work: Callable[[threading.Event], Awaitable], is_disconnected: Callable[[], Awaitable[bool]], deadline: Optional[float], poll_interval: float = 0.25):
+    '''
+    Awaits `work(cancelled)` while watching for the client to disconnect and for the deadline to
+    pass. Either one sets `cancelled`, which generation checks between tokens, and cancels the
+    task, which also drops it from the executor and batcher queues it has not left yet. Work that
+    finishes after the deadline raises DeadlineExceeded too, since generation stops at the
+    deadline by itself and would otherwise look like one that ran out of tokens.
+    '''
+    cancelled = threading.Event()
+    task = asyncio.ensure_future(work(cancelled))
+    try:
+        while True:
+            timeout = poll_interval if deadline is None else max(min(poll_interval, deadline - time()), 0)
+            done, _ = await asyncio.wait({task}, timeout=timeout)
+            if task in done and (deadline is None or time() < deadline):
+                return task.result()
+            if deadline is not None and time() >= deadline:
+                if task.done() and not task.cancelled():
+                    # retrieved so that a failure cut short by the deadline is not logged as unhandled
+                    task.exception()
+                raise DeadlineExceeded('Deadline passed during processing')
+            if await is_disconnected():
+                raise ClientDisconnected('Client disconnected')
+    finally:
+        if not task.done():
+            cancelled.set()
+            task.cancel()
+
+def get_admission_stats() -> dict:
+    return {limiter.name: limiter.stats() for limiter in [global_limiter] + list(model_limiters.values())}
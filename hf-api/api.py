@@ -1,45 +1,269 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from models import CompletionRequest, ChatCompletionRequest, EmbeddingsRequest, EmbeddingsObjectResponse, EmbeddingsResponse, Usage, CompletionResponse, CompletionResponseChoice, ChatCompletionResponse, ChatCompletionResponseChoice, ChatMessage
+from models import ChatCompletionStreamResponse, ChatCompletionResponseStreamChoice, DeltaMessage, CompletionStreamResponse, CompletionResponseStreamChoice
+from fastapi.responses import StreamingResponse, JSONResponse, Response, FileResponse
+from contextlib import asynccontextmanager, AsyncExitStack
 from fastapi import FastAPI, HTTPException
-from completion import get_chat_completion_async, get_text_completion_async
-from embeddings import get_embeddings_async
-import os, uvicorn, asyncio
+from completion import get_chat_completion_async, get_text_completion_async, stream_chat_completion_async, stream_text_completion_async, get_prefix_cache_stats
+from embeddings import get_embeddings_async, get_batcher_stats, get_embedding_cache_stats, serialize_embeddings, check_dimensions
+from registry import model_registry
+from preload import preload_models, preload_status, is_ready
+from workers import get_worker_stats, shutdown_workers
+from speculative import get_speculative_stats
+from batch_jobs import create_job, get_job, list_jobs, cancel_job, resume_jobs, stop_jobs, get_output_path, get_batch_job_stats
+from admission import admit, run_cancellable, get_deadline, get_priority, get_admission_stats, AdmissionRejected, DeadlineExceeded, ClientDisconnected
+from metrics import get_metrics, register_executor, register_stats
+from utils import createLogger
+from prometheus_client import CONTENT_TYPE_LATEST
+import completion, embeddings, batch_jobs
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Optional
+import os, json, uvicorn, asyncio, uuid, time
 from uvicorn.config import LOGGING_CONFIG
 
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
-app = FastAPI(title='A OpenAI Compatible API for HuggingFace')
 
-@app.post("/v1/embeddings")
-async def text_embeddings(request: EmbeddingsRequest) -> EmbeddingsResponse:
-    embeddings, usage = await get_embeddings_async(request)
-    if isinstance(request.input, str):
-        return EmbeddingsResponse(data=embeddings, model=request.model, usage=usage, object="list")
-    
-    if isinstance(request.input, list):
-        return EmbeddingsResponse(data=embeddings, model=request.model, usage=usage, object="list")
-    
-    raise HTTPException(
-        status_code=400, detail="input needs to be an array of strings or a string"
-    )
+logger = createLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # preload in the background so that liveness probes are answered while models load
+    task = asyncio.create_task(preload_models())
+    resume_jobs()
+    yield
+    task.cancel()
+    stop_jobs()
+    shutdown_workers()
+
+app = FastAPI(title='A OpenAI Compatible API for HuggingFace', lifespan=lifespan)
+
+register_executor('completion', completion.executor)
+register_executor('embedding', embeddings.executor)
+register_executor('batch_jobs', batch_jobs.executor)
+stats_sources = {
+    'admission': get_admission_stats,
+    'batch_jobs': get_batch_job_stats,
+    'embedding_batchers': get_batcher_stats,
+    'embedding_cache': get_embedding_cache_stats,
+    'model_registry': model_registry.stats,
+    'prefix_cache': get_prefix_cache_stats,
+    'process_workers': get_worker_stats,
+    'speculative': get_speculative_stats
+}
+register_stats(stats_sources)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, e: AdmissionRejected):
+    return JSONResponse(status_code=429, content={'detail': str(e)}, headers={'Retry-After': str(e.retry_after)})
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded(request: Request, e: DeadlineExceeded):
+    return JSONResponse(status_code=504, content={'detail': str(e)})
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected(request: Request, e: ClientDisconnected):
+    # nobody reads this, nginx logs the same status for requests closed by the client
+    return Response(status_code=499)
+
+def get_admission(http_request: Request, request, default_priority: str) -> int:
+    '''
+    Resolves the deadline of `request` in place and returns its priority. Chat and completions
+    default to interactive, embeddings to default, and clients can set `X-Priority: batch`.
+    '''
+    try:
+        request.deadline = get_deadline(http_request.headers.get('X-Request-Timeout'), request.deadline)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return get_priority(http_request.headers.get('X-Priority'), default_priority)
+
+@app.post("/v1/embeddings", response_model=EmbeddingsResponse)
+async def text_embeddings(request: EmbeddingsRequest, http_request: Request):
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    # checked before batching, where a bad input would fail the batch it is in
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        raise HTTPException(
+            status_code=400, detail="input needs to be an array of strings or a string"
+        )
+
+    priority = get_admission(http_request, request, 'default')
+    async with admit(request.model, priority, request.deadline, http_request.is_disconnected):
+        # may load the model, which counts against the limits like the request itself
+        try:
+            await check_dimensions(request)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        vectors, usage = await run_cancellable(lambda _: get_embeddings_async(request), http_request.is_disconnected, request.deadline)
+    return Response(content=serialize_embeddings(request, vectors, usage), media_type='application/json')
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    text, usage = await get_chat_completion_async(request)
-    message = ChatMessage(role='assistant', content=text)
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
+    priority = get_admission(http_request, request, 'interactive')
+    if request.stream:
+        return await stream_admitted(request.model, priority, request.deadline, http_request.is_disconnected, partial(stream_chat_completions, request))
+
+    async with admit(request.model, priority, request.deadline, http_request.is_disconnected):
+        choices, usage = await run_cancellable(partial(get_chat_completion_async, request), http_request.is_disconnected, request.deadline)
     return ChatCompletionResponse(
         model=request.model, 
-        choices=[ChatCompletionResponseChoice(message=message, index=0, finish_reason='length')],
+        choices=[
+            ChatCompletionResponseChoice(message=ChatMessage(role='assistant', content=text), index=index, finish_reason=finish_reason)
+            for index, (text, finish_reason) in enumerate(choices)
+        ],
         usage=usage
     )
 
 @app.post("/v1/completions")
-async def completions(request: CompletionRequest): 
-    text, usage = await get_text_completion_async(request)
+async def completions(request: CompletionRequest, http_request: Request):
+    priority = get_admission(http_request, request, 'interactive')
+    if request.stream:
+        return await stream_admitted(request.model, priority, request.deadline, http_request.is_disconnected, partial(stream_completions, request))
+
+    async with admit(request.model, priority, request.deadline, http_request.is_disconnected):
+        choices, usage = await run_cancellable(partial(get_text_completion_async, request), http_request.is_disconnected, request.deadline)
     return CompletionResponse(
         model=request.model, 
-        choices=[CompletionResponseChoice(text=text, index=0, finish_reason='length', logprobs=None)],
+        choices=[
+            CompletionResponseChoice(text=text, index=index, finish_reason=finish_reason, logprobs=None)
+            for index, (text, finish_reason) in enumerate(choices)
+        ],
         usage=usage
     )
+
+@app.post("/v1/batches")
+async def create_batch(http_request: Request, model: Optional[str] = None):
+    '''
+    Takes a JSONL file of embedding requests as the request body and embeds it in the background.
+    '''
+    try:
+        job = await create_job(http_request.stream(), model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return job.to_response()
+
+@app.get("/v1/batches")
+async def list_batches():
+    return {'object': 'list', 'data': [job.to_response() for job in list_jobs()]}
+
+@app.get("/v1/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    return get_batch_job(batch_id).to_response()
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str):
+    return (await cancel_job(get_batch_job(batch_id))).to_response()
+
+@app.get("/v1/batches/{batch_id}/embeddings")
+async def get_batch_embeddings(batch_id: str):
+    job = get_batch_job(batch_id, completed=True)
+    return FileResponse(get_output_path(job, 'embeddings.npy'), media_type='application/octet-stream', filename=f'{batch_id}.npy')
+
+@app.get("/v1/batches/{batch_id}/ids")
+async def get_batch_ids(batch_id: str):
+    job = get_batch_job(batch_id, completed=True)
+    return FileResponse(get_output_path(job, 'ids.txt'), media_type='text/plain', filename=f'{batch_id}.ids.txt')
+
+def get_batch_job(batch_id: str, completed: bool = False):
+    job = get_job(batch_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Batch {batch_id} not found')
+    if completed and job.status != 'completed':
+        raise HTTPException(status_code=409, detail=f'Batch {batch_id} is {job.status}')
+    return job
+
+class AdmittedStreamingResponse(StreamingResponse):
+    '''
+    Holds the admission of a streamed request until the stream ends or the client disconnects,
+    which closes the stream and with it the generation.
+    '''
+    def __init__(self, content, admission: AsyncExitStack, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.admission.aclose()
+
+async def stream_admitted(model_name: str, priority: int, deadline: Optional[float], is_disconnected: Callable[[], Awaitable[bool]], start: Callable[[], Awaitable[AsyncIterator[str]]]) -> StreamingResponse:
+    # admitted and started before the response starts, so that a full queue can still answer
+    # with 429 and a model that cannot be loaded with an error status
+    admission = AsyncExitStack()
+    await admission.enter_async_context(admit(model_name, priority, deadline, is_disconnected))
+    try:
+        stream = await start()
+    except BaseException:
+        await admission.aclose()
+        raise
+    return AdmittedStreamingResponse(stream, admission, media_type='text/event-stream')
+
+async def stream_chat_completions(request: ChatCompletionRequest) -> AsyncIterator[str]:
+    return format_chat_stream(request, await stream_chat_completion_async(request))
+
+async def format_chat_stream(request: ChatCompletionRequest, completion: AsyncIterator):
+    id, created = str(uuid.uuid4()), int(time.time())
+    chunk = ChatCompletionStreamResponse(
+        id=id, created=created, model=request.model,
+        choices=[ChatCompletionResponseStreamChoice(index=0, delta=DeltaMessage(role='assistant', content=''))]
+    )
+    yield f'data: {chunk.model_dump_json()}\n\n'
+
+    try:
+        async for text, finish_reason in completion:
+            delta = DeltaMessage(content=text) if finish_reason is None else DeltaMessage()
+            chunk = ChatCompletionStreamResponse(
+                id=id, created=created, model=request.model,
+                choices=[ChatCompletionResponseStreamChoice(index=0, delta=delta, finish_reason=to_stream_finish_reason(finish_reason))]
+            )
+            yield f'data: {chunk.model_dump_json()}\n\n'
+    except Exception as e:
+        yield format_stream_error(request.model, e)
+
+    yield 'data: [DONE]\n\n'
+
+async def stream_completions(request: CompletionRequest) -> AsyncIterator[str]:
+    return format_completion_stream(request, await stream_text_completion_async(request))
+
+async def format_completion_stream(request: CompletionRequest, completion: AsyncIterator):
+    id, created = str(uuid.uuid4()), int(time.time())
+    try:
+        async for text, finish_reason in completion:
+            chunk = CompletionStreamResponse(
+                id=id, created=created, model=request.model,
+                choices=[CompletionResponseStreamChoice(index=0, text=text, finish_reason=finish_reason)]
+            )
+            yield f'data: {chunk.model_dump_json()}\n\n'
+    except Exception as e:
+        yield format_stream_error(request.model, e)
+
+    yield 'data: [DONE]\n\n'
+
+def format_stream_error(model_name: str, e: Exception) -> str:
+    # the status line is already sent, the error goes into the stream like OpenAI does it
+    logger.exception(f'Streaming a completion of {model_name} failed')
+    return f"data: {json.dumps({'error': {'message': str(e) or type(e).__name__, 'type': type(e).__name__}})}\n\n"
+
+def to_stream_finish_reason(finish_reason: str):
+    if finish_reason is None:
+        return None
+    return 'length' if finish_reason == 'length' else 'stop'
+
+@app.get("/health/live")
+async def health_live():
+    return {'status': 'live'}
+
+@app.get("/health/ready")
+async def health_ready():
+    status = 'ready' if is_ready() else 'not ready'
+    return JSONResponse(status_code=200 if is_ready() else 503, content={'status': status, 'models': preload_status})
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=get_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/stats")
+async def stats():
+    return {source: get_stats() for source, get_stats in stats_sources.items()}
     
 if __name__ == '__main__':
     LOGGING_CONFIG["formatters"]["access"]["fmt"] = ("%(asctime)s " + LOGGING_CONFIG["formatters"]["access"]["fmt"])
@@ -0,0 +1,350 @@
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple
+from dataclasses import dataclass, asdict
+from time import time, perf_counter
+from utils import Batch_Jobs_Folder, createLogger
+from admission import admit, priorities
+from models import EmbeddingsRequest
+from concurrent.futures import ThreadPoolExecutor
+import os, json, uuid, shutil, asyncio
+import numpy as np
+import embeddings
+
+logger = createLogger(__name__)
+
+jobs_folder = os.getenv('BATCH-JOBS-FOLDER', Batch_Jobs_Folder)
+# texts per call of the model, the same upper bound as a dynamically batched call
+chunk_size = int(os.getenv('BATCH-JOB-CHUNK-SIZE', str(embeddings.dynamic_batch_max_size)))
+# longer lines are rejected at upload, so that no single line has to be held in memory whole
+max_line_size = int(os.getenv('BATCH-JOB-MAX-LINE-SIZE', str(1024 * 1024)))
+# reads and writes the files of jobs, which would otherwise block the event loop
+executor = ThreadPoolExecutor(2)
+
+finished_statuses = ('completed', 'failed', 'cancelled')
+
+@dataclass
+class BatchJob:
+    id: str
+    model: str
+    status: str
+    created_at: int
+    total_requests: int
+    total_rows: int
+    completed_requests: int = 0
+    completed_rows: int = 0
+    # the input file is processed up to this byte, the checkpoint a restarted job resumes from
+    input_offset: int = 0
+    prompt_tokens: int = 0
+    dimensions: Optional[int] = None
+    processing_seconds: float = 0
+    started_at: Optional[int] = None
+    finished_at: Optional[int] = None
+    error: Optional[str] = None
+
+    def to_response(self) -> dict:
+        rows_per_second = self.completed_rows / self.processing_seconds if self.processing_seconds > 0 else None
+        response = {
+            'id': self.id,
+            'object': 'batch',
+            'endpoint': '/v1/embeddings',
+            'model': self.model,
+            'status': self.status,
+            'created_at': self.created_at,
+            'in_progress_at': self.started_at,
+            'finished_at': self.finished_at,
+            'request_counts': {'total': self.total_requests, 'completed': self.completed_requests, 'failed': 0},
+            'progress': {
+                'total_rows': self.total_rows,
+                'completed_rows': self.completed_rows,
+                'fraction': round(self.completed_rows / self.total_rows, 4) if self.total_rows > 0 else 1.0,
+                'rows_per_second': round(rows_per_second, 3) if rows_per_second else None,
+                'eta_seconds': round((self.total_rows - self.completed_rows) / rows_per_second, 1) if rows_per_second and self.status not in finished_statuses else None,
+            },
+            'usage': {'prompt_tokens': self.prompt_tokens, 'total_tokens': self.prompt_tokens},
+            'error': self.error,
+        }
+        if self.status == 'completed':
+            response['output'] = {
+                'embeddings': f'/v1/batches/{self.id}/embeddings',
+                'ids': f'/v1/batches/{self.id}/ids',
+                'shape': [self.total_rows, self.dimensions or 0],
+                'dtype': 'float32',
+            }
+        return response
+
+
+jobs: Dict[str, BatchJob] = {}
+job_queue: Optional[asyncio.Queue] = None
+runner: Optional[asyncio.Task] = None
+
+def get_job_folder(job_id: str) -> str:
+    return os.path.join(jobs_folder, job_id)
+
+def save_job(job: BatchJob):
+    path = os.path.join(get_job_folder(job.id), 'job.json')
+    with open(path + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(asdict(job), f)
+    os.replace(path + '.tmp', path)
+
+def get_job(job_id: str) -> Optional[BatchJob]:
+    return jobs.get(job_id)
+
+def list_jobs() -> List[BatchJob]:
+    return sorted(jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+def parse_line(line: bytes, line_number: int) -> Tuple[str, List[str], Optional[str]]:
+    '''
+    Reads one line of a batch input file: `{"custom_id": ..., "body": {"input": ...}}` as in
+    OpenAI batch files, or `{"id": ..., "input": ...}`, where `input` is a string or a list of
+    strings. Returns the id (the line number if there is none), the texts and the model if given.
+    The output rows of a line with several texts are named `id:index`.
+    '''
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f'Line {line_number} is not valid JSON: {e}')
+    if not isinstance(record, dict):
+        raise ValueError(f'Line {line_number} is not a JSON object')
+
+    body = record.get('body') if isinstance(record.get('body'), dict) else record
+    texts = body.get('input')
+    if isinstance(texts, str):
+        texts = [texts]
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        raise ValueError(f'Line {line_number} needs an input that is a string or an array of strings')
+
+    custom_id = str(record.get('custom_id', record.get('id', record.get('request_id', line_number))))
+    if '\n' in custom_id:
+        raise ValueError(f'Line {line_number} has an id containing a line break')
+    return custom_id, texts, body.get('model')
+
+def get_row_ids(custom_id: str, texts: List[str]) -> List[str]:
+    return [custom_id] if len(texts) == 1 else [f'{custom_id}:{index}' for index in range(len(texts))]
+
+class InputWriter:
+    '''
+    Writes an uploaded JSONL file chunk by chunk and checks every line once it is complete,
+    writing the ids of its output rows next to it. Lines longer than `max_line_size` are rejected.
+    '''
+    def __init__(self, folder: str, model: Optional[str]):
+        self.model = model
+        self.total_requests = 0
+        self.total_rows = 0
+        self.line_number = 0
+        self.pending = b''
+        self.input_file = open(os.path.join(folder, 'input.jsonl'), 'wb')
+        self.ids_file = open(os.path.join(folder, 'ids.txt'), 'wt', encoding='utf-8')
+
+    def write(self, chunk: bytes):
+        self.input_file.write(chunk)
+        lines = (self.pending + chunk).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.check_line(line)
+        if len(self.pending) > max_line_size:
+            raise ValueError(f'Line {self.line_number + 1} is longer than {max_line_size} bytes')
+
+    def finish(self):
+        if self.pending.strip():
+            # the last line has no line break, add one so that offsets always end at lines
+            self.input_file.write(b'\n')
+            self.check_line(self.pending)
+        self.close()
+
+    def check_line(self, line: bytes):
+        self.line_number += 1
+        if len(line) > max_line_size:
+            raise ValueError(f'Line {self.line_number} is longer than {max_line_size} bytes')
+        self.model, requests, rows = check_line(line, self.line_number, self.model, self.ids_file)
+        self.total_requests, self.total_rows = self.total_requests + requests, self.total_rows + rows
+
+    def close(self):
+        self.input_file.close()
+        self.ids_file.close()
+
+
+async def create_job(content: AsyncIterator[bytes], model: Optional[str] = None) -> BatchJob:
+    '''
+    Stores an uploaded JSONL file as a new job and queues it. Every line is checked while the
+    file is written, and the ids of the output rows are written next to it, so a file with an
+    invalid line is rejected as a whole before anything is computed.
+    '''
+    loop = asyncio.get_event_loop()
+    job_id = f'batch_{uuid.uuid4().hex}'
+    folder = get_job_folder(job_id)
+    await loop.run_in_executor(executor, os.makedirs, folder)
+    writer = None
+    try:
+        writer = await loop.run_in_executor(executor, InputWriter, folder, model)
+        async for chunk in content:
+            await loop.run_in_executor(executor, writer.write, chunk)
+        await loop.run_in_executor(executor, writer.finish)
+    except BaseException:
+        await loop.run_in_executor(executor, remove_upload, folder, writer)
+        raise
+
+    job = BatchJob(
+        id=job_id,
+        model=writer.model or EmbeddingsRequest.model_fields['model'].default,
+        status='queued',
+        created_at=int(time()),
+        total_requests=writer.total_requests,
+        total_rows=writer.total_rows
+    )
+    await loop.run_in_executor(executor, save_job, job)
+    jobs[job.id] = job
+    get_job_queue().put_nowait(job.id)
+    logger.info(f'Queued {job.id} with {job.total_requests} requests, {job.total_rows} texts for {job.model}')
+    return job
+
+def remove_upload(folder: str, writer: Optional[InputWriter]):
+    if writer is not None:
+        writer.close()
+    shutil.rmtree(folder, ignore_errors=True)
+
+def check_line(line: bytes, line_number: int, model: Optional[str], ids_file) -> Tuple[Optional[str], int, int]:
+    if not line.strip():
+        return model, 0, 0
+    custom_id, texts, line_model = parse_line(line, line_number)
+    if line_model is not None and model is not None and line_model != model:
+        raise ValueError(f'Line {line_number} is for {line_model}, a job only embeds with one model ({model})')
+    for row_id in get_row_ids(custom_id, texts):
+        ids_file.write(row_id + '\n')
+    return model or line_model, 1, len(texts)
+
+async def cancel_job(job: BatchJob) -> BatchJob:
+    if job.status not in finished_statuses:
+        job.status = 'cancelled'
+        job.finished_at = int(time())
+        await asyncio.get_event_loop().run_in_executor(executor, save_job, job)
+    return job
+
+def get_job_queue() -> asyncio.Queue:
+    global job_queue, runner
+    if job_queue is None:
+        job_queue = asyncio.Queue()
+    if runner is None or runner.done():
+        runner = asyncio.get_event_loop().create_task(run_jobs())
+    return job_queue
+
+def resume_jobs():
+    '''
+    Loads the jobs stored in BATCH-JOBS-FOLDER and queues the unfinished ones again in the order
+    they were created. In-progress jobs continue from their last checkpoint.
+    '''
+    if not os.path.isdir(jobs_folder):
+        return
+    for job_id in os.listdir(jobs_folder):
+        path = os.path.join(get_job_folder(job_id), 'job.json')
+        if job_id not in jobs and os.path.exists(path):
+            with open(path, 'rt', encoding='utf-8') as f:
+                jobs[job_id] = BatchJob(**json.load(f))
+
+    unfinished = [job for job in jobs.values() if job.status not in finished_statuses]
+    for job in sorted(unfinished, key=lambda job: job.created_at):
+        get_job_queue().put_nowait(job.id)
+    if len(unfinished) > 0:
+        logger.info(f'Resuming {len(unfinished)} batch jobs')
+
+def stop_jobs():
+    # jobs keep their status and continue from their checkpoint after a restart
+    if runner is not None:
+        runner.cancel()
+
+async def run_jobs():
+    while True:
+        job = jobs[await job_queue.get()]
+        if job.status in finished_statuses:
+            continue
+        try:
+            await run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f'Batch job {job.id} failed')
+            job.status, job.error, job.finished_at = 'failed', str(e), int(time())
+            await asyncio.get_event_loop().run_in_executor(executor, save_job, job)
+
+async def run_job(job: BatchJob):
+    '''
+    Embeds the texts of `job` in chunks of whole lines with up to `chunk_size` texts each, at
+    batch priority so that interactive requests for the same model are admitted first. Every chunk
+    is written into the preallocated output matrix before the checkpoint moves past it. The files
+    are read and written on `executor`.
+    '''
+    loop = asyncio.get_event_loop()
+    folder = get_job_folder(job.id)
+    job.status, job.started_at = 'in_progress', job.started_at or int(time())
+    await loop.run_in_executor(executor, save_job, job)
+
+    matrix = None
+    input_file = await loop.run_in_executor(executor, open, os.path.join(folder, 'input.jsonl'), 'rb')
+    try:
+        await loop.run_in_executor(executor, input_file.seek, job.input_offset)
+        while job.status == 'in_progress':
+            texts, requests, offset = await loop.run_in_executor(executor, read_chunk, input_file)
+            if requests == 0:
+                break
+            started_at = perf_counter()
+            if len(texts) > 0:
+                async with admit(job.model, priorities['batch'], None):
+                    vectors, token_counts = await loop.run_in_executor(embeddings.executor, embeddings.get_embeddings_batch, job.model, texts)
+                if matrix is None:
+                    matrix = await loop.run_in_executor(executor, open_matrix, folder, job, vectors.shape[1])
+                await loop.run_in_executor(executor, write_rows, matrix, job.completed_rows, vectors)
+                job.prompt_tokens += sum(token_counts)
+
+            job.completed_rows += len(texts)
+            job.completed_requests += requests
+            job.input_offset = offset
+            job.processing_seconds += perf_counter() - started_at
+            await loop.run_in_executor(executor, save_job, job)
+    finally:
+        input_file.close()
+
+    if job.status != 'in_progress':
+        return
+    if matrix is None:
+        # nothing to embed, the output is an empty matrix
+        await loop.run_in_executor(executor, np.save, os.path.join(folder, 'embeddings.npy'), np.empty((job.total_rows, 0), dtype=np.float32))
+    del matrix
+    job.status, job.finished_at = 'completed', int(time())
+    await loop.run_in_executor(executor, save_job, job)
+    logger.info(f'Batch job {job.id} completed {job.completed_rows} texts in {round(job.processing_seconds, 1)} seconds')
+
+def read_chunk(input_file: BinaryIO) -> Tuple[List[str], int, int]:
+    '''
+    Reads whole lines until they hold `chunk_size` texts. Returns the texts, the number of
+    requests read and the offset after the last line.
+    '''
+    texts, requests = [], 0
+    while len(texts) < chunk_size:
+        line = input_file.readline(max_line_size + 1)
+        if not line:
+            break
+        if len(line) > max_line_size:
+            raise ValueError(f'A line at byte {input_file.tell() - len(line)} is longer than {max_line_size} bytes')
+        if line.strip():
+            texts.extend(parse_line(line, 0)[1])
+            requests += 1
+    return texts, requests, input_file.tell()
+
+def open_matrix(folder: str, job: BatchJob, dimensions: int) -> np.memmap:
+    path = os.path.join(folder, 'embeddings.npy')
+    if job.dimensions is not None and os.path.exists(path):
+        return np.lib.format.open_memmap(path, mode='r+')
+    job.dimensions = dimensions
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(job.total_rows, dimensions))
+
+def write_rows(matrix: np.memmap, start: int, vectors: np.ndarray):
+    matrix[start:start + len(vectors)] = vectors
+    matrix.flush()
+
+def get_output_path(job: BatchJob, name: str) -> str:
+    return os.path.join(get_job_folder(job.id), name)
+
+def get_batch_job_stats() -> dict:
+    stats = {status: 0 for status in ('queued', 'in_progress') + finished_statuses}
+    for job in jobs.values():
+        stats[job.status] += 1
+    stats['pending_rows'] = sum(job.total_rows - job.completed_rows for job in jobs.values() if job.status not in finished_statuses)
+    return stats
@@ -0,0 +1,132 @@
+from typing import Any, Callable, List, Tuple
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from time import time
+import asyncio
+from utils import createLogger, record_span
+
+logger = createLogger(__name__)
+
+@dataclass
+class BatchItem:
+    inputs: List[Any]
+    future: asyncio.Future
+    enqueued_at: float
+
+
+class DynamicBatcher:
+    '''
+    Collects inputs from concurrent requests for up to `max_wait_ms` milliseconds or `max_batch_size` items,
+    runs `process` once for the whole batch on `executor` and resolves every caller with its own slice.
+    If the batch fails, its requests run again one by one so that only the request at fault fails.
+    `process` receives a flat list of inputs and returns a tuple of sequences aligned with it.
+    '''
+    def __init__(self, name: str, process: Callable[[List[Any]], Tuple], executor: Executor, max_batch_size: int, max_wait_ms: float):
+        self.name = name
+        self.process = process
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = None
+        self.queued_inputs = 0
+        self.task = None
+        self.loop = None
+        self.batches = 0
+        self.requests = 0
+        self.inputs = 0
+        self.last_batch_size = 0
+        self.largest_batch_size = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def submit(self, inputs: List[Any]) -> Tuple:
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            # the queue and its consumer belong to one event loop, start over if called from another
+            self.loop, self.queue, self.queued_inputs = loop, asyncio.Queue(), 0
+            self.task = None
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+
+        future = loop.create_future()
+        self.queued_inputs += len(inputs)
+        await self.queue.put(BatchItem(inputs=inputs, future=future, enqueued_at=time()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            batch_size = len(batch[0].inputs)
+            deadline = loop.time() + self.max_wait
+            while batch_size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                try:
+                    item = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                batch.append(item)
+                batch_size += len(item.inputs)
+
+            await self.run_batch(batch)
+
+    async def run_batch(self, batch: List[BatchItem]):
+        started_at = time()
+        self.queued_inputs -= sum(len(item.inputs) for item in batch)
+        batch = [item for item in batch if not item.future.done()]
+        if len(batch) == 0:
+            return
+
+        self.record(batch, started_at)
+        await self.process_batch(batch)
+
+    async def process_batch(self, batch: List[BatchItem]):
+        loop = asyncio.get_event_loop()
+        inputs = [input for item in batch for input in item.inputs]
+        try:
+            results = await loop.run_in_executor(self.executor, self.process, inputs)
+        except Exception as e:
+            if len(batch) > 1:
+                # one bad request must not fail the others, so each of them runs on its own
+                logger.warning(f'Batch of {len(inputs)} inputs for {self.name} failed, retrying its {len(batch)} requests separately')
+                for item in batch:
+                    if not item.future.done():
+                        await self.process_batch([item])
+                return
+            logger.exception(f'Batch of {len(inputs)} inputs for {self.name} failed')
+            if not batch[0].future.done():
+                batch[0].future.set_exception(e)
+            return
+
+        offset = 0
+        for item in batch:
+            size = len(item.inputs)
+            if not item.future.done():
+                item.future.set_result(tuple(result[offset:offset + size] for result in results))
+            offset += size
+
+    def record(self, batch: List[BatchItem], started_at: float):
+        batch_size = sum(len(item.inputs) for item in batch)
+        self.batches += 1
+        self.requests += len(batch)
+        self.inputs += batch_size
+        self.last_batch_size = batch_size
+        self.largest_batch_size = max(self.largest_batch_size, batch_size)
+        for item in batch:
+            wait_time = started_at - item.enqueued_at
+            record_span('queue_wait', wait_time, model=self.name)
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.queued_inputs,
+            'batches': self.batches,
+            'requests': self.requests,
+            'inputs': self.inputs,
+            'last_batch_size': self.last_batch_size,
+            'largest_batch_size': self.largest_batch_size,
+            'avg_batch_size': round(self.inputs / self.batches, 3) if self.batches else 0,
+            'avg_wait_ms': round(self.total_wait_time / self.requests * 1000, 3) if self.requests else 0,
+            'max_wait_ms': round(self.max_wait_time * 1000, 3),
+        }
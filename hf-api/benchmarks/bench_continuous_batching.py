@@ -0,0 +1,72 @@
+'''
+Compares the executor-per-request completion path against the continuous batching scheduler
+on the same prompts. Run from the hf-api folder:
+
+    python benchmarks/bench_continuous_batching.py --model Qwen/Qwen1.5-1.8B-Chat --concurrency 8 --max-tokens 64
+'''
+import os, sys, json, time, asyncio, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from models import ChatCompletionRequest, ChatMessage
+import completion
+from sampling import SamplingParams
+
+PROMPTS = [
+    '你好，请介绍一下你自己',
+    '用三句话解释什么是向量数据库',
+    'Write a haiku about autumn wind',
+    '请把“人生若只如初见”翻译成英文',
+    'List three differences between TCP and UDP',
+    '什么是检索增强生成？',
+]
+
+def build_requests(model: str, concurrency: int, max_tokens: int):
+    return [
+        ChatCompletionRequest(model=model, max_tokens=max_tokens, temperature=0, messages=[ChatMessage(role='user', content=PROMPTS[index % len(PROMPTS)])])
+        for index in range(concurrency)
+    ]
+
+async def run_executor(requests):
+    loop = asyncio.get_event_loop()
+    return await asyncio.gather(*[loop.run_in_executor(completion.executor, completion.get_chat_completion, request) for request in requests])
+
+async def run_scheduler(requests):
+    return await asyncio.gather(*[completion.get_scheduled_completion(request.model, request.messages, SamplingParams.from_request(request)) for request in requests])
+
+async def measure(name: str, runner, requests, rounds: int) -> dict:
+    elapsed, completion_tokens = 0.0, 0
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        results = await runner(requests)
+        elapsed += time.perf_counter() - started_at
+        completion_tokens += sum(usage.completion_tokens for _, usage in results)
+    return {
+        'path': name,
+        'requests': len(requests) * rounds,
+        'seconds': round(elapsed, 3),
+        'completion_tokens': completion_tokens,
+        'tokens_per_second': round(completion_tokens / elapsed, 3),
+        'requests_per_second': round(len(requests) * rounds / elapsed, 3),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark continuous batching against the executor path.')
+    parser.add_argument('--model', type=str, default='Qwen/Qwen1.5-1.8B-Chat')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--max-tokens', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    requests = build_requests(args.model, args.concurrency, args.max_tokens)
+
+    # load and warm up the model once so neither path pays for it
+    await run_executor(requests[:1])
+
+    results = [
+        await measure('executor', run_executor, requests, args.rounds),
+        await measure('continuous_batching', run_scheduler, requests, args.rounds),
+    ]
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+'''
+Compares load time, memory, latency and output similarity of the quantized variants of a model
+against fp32 on the same prompts. Run from the hf-api folder:
+
+    python benchmarks/bench_quantization.py --kind embedding --model BAAI/bge-small-zh-v1.5 --variants fp32 int8 bf16 onnx
+    python benchmarks/bench_quantization.py --kind completion --model Qwen/Qwen1.5-1.8B-Chat --variants fp32 int8 bf16
+'''
+import os, sys, json, time, argparse
+from functools import partial
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+import quantization, embeddings, completion
+from quantization import compare_outputs, get_module_size
+from registry import release_memory
+
+PROMPTS = [
+    '你好，请介绍一下你自己',
+    '用三句话解释什么是向量数据库',
+    'Write a haiku about autumn leaves.',
+    'What is the difference between a process and a thread?',
+]
+
+def get_rss() -> int:
+    with open('/proc/self/status', 'rt') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def get_variant_options(variant: str) -> dict:
+    # the accuracy check is what this benchmark reports, so it must not fall back to fp32
+    options = {'backend': 'onnx'} if variant == 'onnx' else {'precision': variant}
+    return {**options, 'min_similarity': -1}
+
+def load(kind: str, model_name: str, variant: str):
+    quantization.load_options[model_name] = get_variant_options(variant)
+    if kind == 'embedding':
+        model, tokenizer = embeddings.load_model(model_name, embeddings.model_cache_folder)
+        return model, tokenizer, embeddings.probe_model
+    model, tokenizer = completion.load_model(model_name, os.path.join(completion.model_cache_folder, model_name))
+    return model, tokenizer, partial(completion.probe_model, tokenizer)
+
+@torch.inference_mode()
+def run(kind: str, model, tokenizer, batch_size: int, max_tokens: int) -> int:
+    if kind == 'embedding':
+        texts = (PROMPTS * batch_size)[:batch_size]
+        embeddings.encode_texts(model, texts)
+        return len(texts)
+
+    for prompt in PROMPTS:
+        text = tokenizer.apply_chat_template([{'role': 'user', 'content': prompt}], tokenize=False, add_generation_prompt=True)
+        input_ids = tokenizer([text], return_tensors='pt').input_ids.to(model.device)
+        model.generate(input_ids, max_new_tokens=max_tokens, min_new_tokens=max_tokens, do_sample=False)
+    return len(PROMPTS) * max_tokens
+
+def measure(kind: str, model_name: str, variant: str, reference, rounds: int, batch_size: int, max_tokens: int) -> dict:
+    release_memory()
+    rss_before = get_rss()
+    started_at = time.perf_counter()
+    model, tokenizer, probe = load(kind, model_name, variant)
+    load_seconds = time.perf_counter() - started_at
+    rss = get_rss() - rss_before
+
+    outputs = probe(model)
+    run(kind, model, tokenizer, batch_size, max_tokens)
+
+    elapsed, items = 0.0, 0
+    for _ in range(rounds):
+        started_at = time.perf_counter()
+        items += run(kind, model, tokenizer, batch_size, max_tokens)
+        elapsed += time.perf_counter() - started_at
+
+    result = {
+        'variant': variant,
+        'load_seconds': round(load_seconds, 3),
+        'model_bytes': get_module_size(model),
+        'rss_bytes': rss,
+        'seconds_per_round': round(elapsed / rounds, 4),
+        ('texts_per_second' if kind == 'embedding' else 'tokens_per_second'): round(items / elapsed, 3),
+        'similarity_to_fp32': round(compare_outputs(reference, outputs), 5) if reference is not None else 1.0,
+    }
+    del model
+    return result, outputs
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark quantized model variants against fp32.')
+    parser.add_argument('--kind', choices=['embedding', 'completion'], default='embedding')
+    parser.add_argument('--model', type=str, default='BAAI/bge-small-zh-v1.5')
+    parser.add_argument('--variants', nargs='+', default=['fp32', 'int8', 'bf16'], choices=['fp32', 'int8', 'bf16', 'onnx'])
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-tokens', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    results, reference = [], None
+    for variant in ['fp32'] + [variant for variant in args.variants if variant != 'fp32']:
+        result, outputs = measure(args.kind, args.model, variant, reference, args.rounds, args.batch_size, args.max_tokens)
+        reference = outputs if reference is None else reference
+        results.append(result)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
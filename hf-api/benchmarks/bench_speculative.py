@@ -0,0 +1,57 @@
+'''
+Compares plain decoding of a chat model with speculative decoding using a draft model on the same
+prompts, one request at a time. Run from the hf-api folder:
+
+    python benchmarks/bench_speculative.py --model Qwen/Qwen1.5-4B-Chat --draft Qwen/Qwen1.5-0.5B-Chat --draft-tokens 4 --max-tokens 64
+'''
+import os, sys, json, time, argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import torch
+import completion, speculative
+from sampling import SamplingParams
+
+PROMPTS = [
+    '你好，请介绍一下你自己',
+    '用三句话解释什么是向量数据库',
+    'Write a haiku about autumn wind',
+    'List three differences between TCP and UDP',
+]
+
+def measure(name: str, model_name: str, params: SamplingParams, rounds: int) -> dict:
+    model, tokenizer = completion.get_cached_model(model_name, os.path.join(completion.model_cache_folder, model_name))
+    prompts = [completion.get_prompt_ids(model_name, [{'role': 'user', 'content': prompt}])[0] for prompt in PROMPTS]
+    completion.generate(model_name, model, tokenizer, torch.tensor([prompts[0]], device=model.device), params)
+
+    elapsed, generated = 0.0, 0
+    for _ in range(rounds):
+        for prompt_ids in prompts:
+            started_at = time.perf_counter()
+            output = completion.generate(model_name, model, tokenizer, torch.tensor([prompt_ids], device=model.device), params)
+            elapsed += time.perf_counter() - started_at
+            generated += output.shape[-1] - len(prompt_ids)
+    return {'mode': name, 'seconds': round(elapsed, 3), 'generated_tokens': generated, 'tokens_per_second': round(generated / elapsed, 3)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark speculative decoding against plain decoding.')
+    parser.add_argument('--model', type=str, default='Qwen/Qwen1.5-4B-Chat')
+    parser.add_argument('--draft', type=str, default='Qwen/Qwen1.5-0.5B-Chat')
+    parser.add_argument('--draft-tokens', type=int, default=4)
+    parser.add_argument('--max-tokens', type=int, default=64)
+    parser.add_argument('--temperature', type=float, default=0)
+    parser.add_argument('--rounds', type=int, default=2)
+    args = parser.parse_args()
+
+    params = SamplingParams(max_new_tokens=args.max_tokens, do_sample=args.temperature > 0, temperature=args.temperature or 1.0)
+    speculative.draft_models.pop(args.model, None)
+    plain = measure('plain', args.model, params, args.rounds)
+
+    speculative.draft_models[args.model] = args.draft
+    speculative.num_draft_tokens = args.draft_tokens
+    drafted = measure('speculative', args.model, params, args.rounds)
+    drafted.update(speculative.get_speculative_stats().get(args.model, {}))
+    drafted['speedup'] = round(drafted['tokens_per_second'] / plain['tokens_per_second'], 3)
+    print(json.dumps([plain, drafted], indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
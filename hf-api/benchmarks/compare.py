@@ -0,0 +1,60 @@
+'''
+Compares two reports of `load_test.py` or `micro.py` and exits with status 1 when a scenario got
+slower than the baseline by more than the tolerance, so CI can fail on regressions:
+
+    python benchmarks/compare.py baseline.json current.json --tolerance 0.15
+'''
+import sys, json, argparse
+from typing import Iterator, Optional, Tuple
+
+HIGHER_IS_BETTER = ['requests_per_second', 'prompt_tokens_per_second', 'completion_tokens_per_second', 'chunks_per_second']
+LOWER_IS_BETTER = ['latency_ms.p50', 'latency_ms.p95', 'latency_ms.p99', 'ttft_ms.p50', 'ttft_ms.p95', 'ttft_ms.p99', 'us_per_call']
+
+def get_metric(result: dict, path: str) -> Optional[float]:
+    value = result
+    for key in path.split('.'):
+        if not isinstance(value, dict) or value.get(key) is None:
+            return None
+        value = value[key]
+    return float(value)
+
+def compare(baseline: dict, current: dict, tolerance: float) -> Iterator[Tuple[str, str, float, float, float, bool]]:
+    '''
+    Yields `(scenario, metric, baseline, current, relative change, regressed)` for every metric
+    both reports have. The relative change is positive when the metric got better.
+    '''
+    baseline_results = {result['name']: result for result in baseline['results']}
+    for result in current['results']:
+        reference = baseline_results.get(result['name'])
+        if reference is None:
+            continue
+        if result.get('errors', 0) > reference.get('errors', 0):
+            yield result['name'], 'errors', reference.get('errors', 0), result['errors'], 0.0, True
+        for metric, higher_is_better in [(metric, True) for metric in HIGHER_IS_BETTER] + [(metric, False) for metric in LOWER_IS_BETTER]:
+            before, after = get_metric(reference, metric), get_metric(result, metric)
+            if before is None or after is None or before == 0:
+                continue
+            change = (after - before) / before if higher_is_better else (before - after) / before
+            yield result['name'], metric, before, after, change, change < -tolerance
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('baseline', type=str)
+    parser.add_argument('current', type=str)
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown per metric')
+    args = parser.parse_args()
+
+    with open(args.baseline, 'rt') as f:
+        baseline = json.load(f)
+    with open(args.current, 'rt') as f:
+        current = json.load(f)
+
+    regressions = 0
+    for scenario, metric, before, after, change, regressed in compare(baseline, current, args.tolerance):
+        regressions += regressed
+        print(f"{'REGRESSION' if regressed else 'ok':<10}  {scenario:<48}  {metric:<30}  {before:>12.3f} -> {after:>12.3f}  {change:+.1%}")
+    print(f'{regressions} regression(s) beyond {args.tolerance:.0%}')
+    sys.exit(1 if regressions > 0 else 0)
+
+if __name__ == '__main__':
+    main()
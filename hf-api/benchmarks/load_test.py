@@ -0,0 +1,228 @@
+'''
+Drives the OpenAI compatible endpoints at a fixed concurrency and reports throughput, latency
+percentiles, time to first token and tokens per second as JSON. Without `--url` the app is served
+by uvicorn on a thread of this process with the tiny local models of `tiny_models.py`, so nothing
+is downloaded; settings such as CONTINUOUS-BATCHING or EMBEDDING-CACHE are read from the
+environment as usual. Needs httpx.
+Run from the hf-api folder:
+
+    python benchmarks/load_test.py --concurrency 8 --requests 64 --output baseline.json
+    python benchmarks/load_test.py --url http://127.0.0.1:8003 --chat-model Qwen/Qwen1.5-1.8B-Chat --embedding-model BAAI/bge-small-zh-v1.5
+
+Streamed scenarios measure time to first token, the others read token counts from `usage`.
+Compare two runs with `benchmarks/compare.py`.
+'''
+import os, sys, json, time, socket, asyncio, argparse, platform, threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+import httpx
+
+PROMPTS = [
+    '你好，请介绍一下你自己',
+    '用三句话解释什么是向量数据库',
+    'Write a haiku about autumn wind',
+    'List three differences between TCP and UDP',
+    '什么是检索增强生成？',
+]
+TEXTS = [
+    '人生若只如初见，何事秋风悲画扇',
+    'The quick brown fox jumps over the lazy dog.',
+    '向量数据库通过近似最近邻搜索来检索相似的文本',
+    'def add(a, b):\n    return a + b',
+]
+SETTINGS = ['CONTINUOUS-BATCHING', 'DYNAMIC-BATCHING', 'PREFIX-CACHE', 'EMBEDDING-CACHE', 'MAX-WORKERS', 'PROCESS-WORKERS', 'MODEL-LOAD-OPTIONS', 'SPECULATIVE-DRAFT-MODELS']
+
+def build_scenarios(args) -> List[dict]:
+    streams = {'on': [True], 'off': [False], 'both': [False, True]}[args.stream]
+    scenarios = []
+    if 'embeddings' in args.endpoints:
+        scenarios.append({
+            'name': 'embeddings', 'path': '/v1/embeddings', 'stream': False,
+            'body': lambda index: {'model': args.embedding_model, 'input': [TEXTS[(index + offset) % len(TEXTS)] for offset in range(args.batch_size)]}
+        })
+    for endpoint in ('completions', 'chat'):
+        if endpoint not in args.endpoints:
+            continue
+        for stream in streams:
+            scenarios.append({
+                'name': endpoint + (' (stream)' if stream else ''),
+                'path': '/v1/completions' if endpoint == 'completions' else '/v1/chat/completions',
+                'stream': stream,
+                'body': build_completion_body(endpoint, args.chat_model, args.max_tokens, stream)
+            })
+    return scenarios
+
+def build_completion_body(endpoint: str, model: str, max_tokens: int, stream: bool) -> Callable[[int], dict]:
+    def build(index: int) -> dict:
+        prompt = PROMPTS[index % len(PROMPTS)]
+        body = {'model': model, 'max_tokens': max_tokens, 'temperature': 0, 'stream': stream}
+        if endpoint == 'chat':
+            return {**body, 'messages': [{'role': 'user', 'content': prompt}]}
+        return {**body, 'prompt': prompt}
+    return build
+
+async def send(client: httpx.AsyncClient, scenario: dict, index: int) -> dict:
+    body = scenario['body'](index)
+    started_at = time.perf_counter()
+    if not scenario['stream']:
+        response = await client.post(scenario['path'], json=body)
+        result = {'status': response.status_code, 'latency': time.perf_counter() - started_at}
+        if response.status_code == 200:
+            usage = response.json().get('usage', {})
+            result.update(prompt_tokens=usage.get('prompt_tokens', 0), completion_tokens=usage.get('completion_tokens') or 0)
+        return result
+
+    first_token_at, chunks = None, 0
+    async with client.stream('POST', scenario['path'], json=body) as response:
+        async for line in response.aiter_lines():
+            if not line.startswith('data: {'):
+                continue
+            choice = json.loads(line[len('data: '):])['choices'][0]
+            if choice.get('text') or (choice.get('delta') or {}).get('content'):
+                chunks += 1
+                first_token_at = first_token_at or time.perf_counter()
+    result = {'status': response.status_code, 'latency': time.perf_counter() - started_at, 'chunks': chunks}
+    if first_token_at is not None:
+        result['ttft'] = first_token_at - started_at
+    return result
+
+async def run_scenario(client: httpx.AsyncClient, scenario: dict, concurrency: int, requests: int, warmup: int) -> dict:
+    for index in range(warmup):
+        await send(client, scenario, index)
+
+    results, next_index = [], iter(range(requests))
+    async def worker():
+        for index in next_index:
+            try:
+                results.append(await send(client, scenario, index))
+            except httpx.HTTPError as e:
+                results.append({'status': type(e).__name__})
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(scenario, concurrency, results, time.perf_counter() - started_at)
+
+def summarize(scenario: dict, concurrency: int, results: List[dict], seconds: float) -> dict:
+    succeeded = [result for result in results if result['status'] == 200]
+    statuses: Dict[str, int] = {}
+    for result in results:
+        statuses[str(result['status'])] = statuses.get(str(result['status']), 0) + 1
+
+    summary = {
+        'name': scenario['name'],
+        'path': scenario['path'],
+        'stream': scenario['stream'],
+        'concurrency': concurrency,
+        'requests': len(results),
+        'errors': len(results) - len(succeeded),
+        'status_codes': statuses,
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(succeeded) / seconds, 3),
+        'latency_ms': percentiles([result['latency'] for result in succeeded]),
+    }
+    if scenario['stream']:
+        summary['ttft_ms'] = percentiles([result['ttft'] for result in succeeded if 'ttft' in result])
+        summary['chunks_per_second'] = round(sum(result['chunks'] for result in succeeded) / seconds, 3)
+    else:
+        summary['prompt_tokens'] = sum(result.get('prompt_tokens', 0) for result in succeeded)
+        summary['prompt_tokens_per_second'] = round(summary['prompt_tokens'] / seconds, 3)
+        if scenario['path'] != '/v1/embeddings':
+            summary['completion_tokens'] = sum(result.get('completion_tokens', 0) for result in succeeded)
+            summary['completion_tokens_per_second'] = round(summary['completion_tokens'] / seconds, 3)
+    return summary
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    if len(values) == 0:
+        return None
+    values = np.array(values) * 1000
+    return {
+        'p50': round(float(np.percentile(values, 50)), 3),
+        'p95': round(float(np.percentile(values, 95)), 3),
+        'p99': round(float(np.percentile(values, 99)), 3),
+        'mean': round(float(values.mean()), 3),
+    }
+
+@contextmanager
+def serve_in_process(args) -> Iterator[str]:
+    '''
+    Serves the app on a free local port for the duration of the block, so that streamed responses
+    arrive chunk by chunk like they do from a real server.
+    '''
+    import uvicorn
+    # the models are tiny local ones unless given, and nothing may be downloaded
+    os.environ['HF_HUB_OFFLINE'] = '1'
+    from tiny_models import build_tiny_models
+    paths = build_tiny_models(args.models_folder)
+    args.chat_model = args.chat_model or paths['chat']
+    args.embedding_model = args.embedding_model or paths['embedding']
+    import api
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(api.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError('The in-process server failed to start')
+        time.sleep(0.05)
+    try:
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        server.should_exit = True
+        thread.join()
+
+async def run(args, url: str) -> dict:
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=httpx.Timeout(args.timeout), limits=limits) as client:
+        results = []
+        for scenario in build_scenarios(args):
+            results.append(await run_scenario(client, scenario, args.concurrency, args.requests, args.warmup))
+            print(f"{scenario['name']}: {results[-1]['requests_per_second']} requests/s", file=sys.stderr)
+
+    return {
+        'target': args.url or 'in-process',
+        'started_at': int(time.time()),
+        'python': platform.python_version(),
+        'models': {'chat': args.chat_model, 'embedding': args.embedding_model},
+        'settings': {name: os.environ[name] for name in SETTINGS if name in os.environ},
+        'results': results,
+    }
+
+def main():
+    from tiny_models import default_folder
+    parser = argparse.ArgumentParser(description='Load test the hf-api endpoints.')
+    parser.add_argument('--url', type=str, default=None, help='a running server, by default the app runs in-process')
+    parser.add_argument('--chat-model', type=str, default=None)
+    parser.add_argument('--embedding-model', type=str, default=None)
+    parser.add_argument('--models-folder', type=str, default=default_folder, help='where the tiny models are built')
+    parser.add_argument('--endpoints', nargs='+', default=['embeddings', 'completions', 'chat'], choices=['embeddings', 'completions', 'chat'])
+    parser.add_argument('--stream', choices=['on', 'off', 'both'], default='both')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=16, help='texts per embeddings request')
+    parser.add_argument('--max-tokens', type=int, default=32)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+    if args.url and (args.chat_model is None or args.embedding_model is None):
+        parser.error('--url needs --chat-model and --embedding-model')
+
+    if args.url:
+        report = asyncio.run(run(args, args.url))
+    else:
+        with serve_in_process(args) as url:
+            report = asyncio.run(run(args, url))
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'wt') as f:
+            f.write(output)
+    print(output)
+
+if __name__ == '__main__':
+    main()
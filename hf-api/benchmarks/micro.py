@@ -0,0 +1,105 @@
+'''
+Micro-benchmarks of the hot paths around the models: the LRU cache, embedding cache keys,
+serialization of embedding responses and tokenization. Reports the time per call as JSON in the
+same layout as `load_test.py`, so `compare.py` works on both. Uses the tiny local models unless
+a tokenizer and an embedding model are given. Run from the hf-api folder:
+
+    python benchmarks/micro.py --output micro.json
+'''
+import os, sys, json, time, timeit, argparse, platform, itertools
+from typing import Callable, List
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+
+TEXTS = [
+    '人生若只如初见，何事秋风悲画扇',
+    'The quick brown fox jumps over the lazy dog.',
+    '向量数据库通过近似最近邻搜索来检索相似的文本',
+    'def add(a, b):\n    return a + b',
+]
+
+def measure(name: str, func: Callable[[], object], min_seconds: float) -> dict:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    repeat = max(3, int(min_seconds / max(timer.timeit(number), 1e-9)))
+    seconds = min(timer.repeat(repeat=min(repeat, 20), number=number)) / number
+    return {'name': name, 'us_per_call': round(seconds * 1e6, 3), 'calls_per_second': round(1 / seconds, 3)}
+
+def bench_lru_cache(min_seconds: float) -> List[dict]:
+    from utils import LRUCache
+    cache = LRUCache(10000)
+    keys = [f'key-{index}' for index in range(20000)]
+    for key in keys[:10000]:
+        cache.put(key, key)
+    hits, misses, puts = itertools.cycle(keys[:10000]), itertools.cycle(keys[10000:]), itertools.cycle(keys)
+    return [
+        measure('lru_cache.get (hit)', lambda: cache.get(next(hits)), min_seconds),
+        measure('lru_cache.get (miss)', lambda: cache.get(next(misses)), min_seconds),
+        measure('lru_cache.put', lambda: cache.put(next(puts), 0), min_seconds),
+    ]
+
+def bench_embedding_cache_key(min_seconds: float) -> List[dict]:
+    from embedding_cache import get_key
+    return [measure('embedding_cache.get_key', lambda: get_key('BAAI/bge-small-zh-v1.5', TEXTS[0]), min_seconds)]
+
+def bench_serialization(min_seconds: float, rows: int, dimensions: int) -> List[dict]:
+    from embeddings import serialize_embeddings
+    from models import EmbeddingsRequest, Usage
+    vectors = np.random.default_rng(0).standard_normal((rows, dimensions), dtype=np.float32)
+    usage = Usage(prompt_tokens=rows * 16, total_tokens=rows * 16)
+    results = []
+    for encoding_format, dtype in (('float', 'float32'), ('base64', 'float32'), ('float', 'int8'), ('base64', 'float16')):
+        request = EmbeddingsRequest(input=TEXTS, encoding_format=encoding_format, dtype=dtype)
+        results.append(measure(f'serialize_embeddings ({rows}x{dimensions}, {encoding_format}, {dtype})', lambda: serialize_embeddings(request, vectors, usage), min_seconds))
+    return results
+
+def bench_tokenization(min_seconds: float, chat_tokenizer: str, embedding_model: str, batch_size: int) -> List[dict]:
+    from transformers import AutoTokenizer
+    from sentence_transformers import SentenceTransformer
+    tokenizer = AutoTokenizer.from_pretrained(chat_tokenizer)
+    messages = [{'role': 'user', 'content': ' '.join(TEXTS)}]
+    model = SentenceTransformer(embedding_model, device='cpu')
+    texts = (TEXTS * batch_size)[:batch_size]
+    return [
+        measure('chat_template + tokenize', lambda: tokenizer([tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)]), min_seconds),
+        measure(f'embedding tokenize (batch of {batch_size})', lambda: model.tokenize(texts), min_seconds),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of hf-api internals.')
+    parser.add_argument('--chat-tokenizer', type=str, default=None)
+    parser.add_argument('--embedding-model', type=str, default=None)
+    parser.add_argument('--rows', type=int, default=64)
+    parser.add_argument('--dimensions', type=int, default=768)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--min-seconds', type=float, default=1.0, help='rough time spent per benchmark')
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    if args.chat_tokenizer is None or args.embedding_model is None:
+        os.environ['HF_HUB_OFFLINE'] = '1'
+        from tiny_models import build_tiny_models, default_folder
+        paths = build_tiny_models(default_folder)
+        args.chat_tokenizer = args.chat_tokenizer or paths['chat']
+        args.embedding_model = args.embedding_model or paths['embedding']
+
+    results = bench_lru_cache(args.min_seconds)
+    results += bench_embedding_cache_key(args.min_seconds)
+    results += bench_serialization(args.min_seconds, args.rows, args.dimensions)
+    results += bench_tokenization(args.min_seconds, args.chat_tokenizer, args.embedding_model, args.batch_size)
+
+    output = json.dumps({
+        'target': 'micro',
+        'started_at': int(time.time()),
+        'python': platform.python_version(),
+        'models': {'chat_tokenizer': args.chat_tokenizer, 'embedding': args.embedding_model},
+        'results': results,
+    }, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'wt') as f:
+            f.write(output)
+    print(output)
+
+if __name__ == '__main__':
+    main()
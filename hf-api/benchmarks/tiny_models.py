@@ -0,0 +1,84 @@
+'''
+Builds tiny randomly initialized models with a byte-level BPE tokenizer trained on a few sentences,
+so that benchmarks and smoke tests run without downloading anything. The models produce nonsense
+but exercise the same code paths as real ones: a Qwen2 chat model with a chat template, a smaller
+Qwen2 draft model sharing its tokenizer, and a BERT sentence-transformers embedding model.
+
+    python benchmarks/tiny_models.py --folder /tmp/hf-api-tiny-models
+'''
+import os, json, argparse, tempfile
+from typing import Dict
+
+default_folder = os.path.join(tempfile.gettempdir(), 'hf-api-tiny-models')
+
+CORPUS = [
+    'hello world, this is a tiny model',
+    'the quick brown fox jumps over the lazy dog',
+    '人生若只如初见，何事秋风悲画扇',
+    '向量数据库通过近似最近邻搜索来检索相似的文本',
+    'def add(a, b):\n    return a + b',
+]
+CHAT_TEMPLATE = (
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+def build_tokenizer(**special_tokens):
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=512,
+        special_tokens=['<|endoftext|>', '<|im_start|>', '<|im_end|>', '[PAD]', '[CLS]', '[SEP]', '[UNK]'],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(CORPUS * 20, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, **special_tokens)
+
+def build_tiny_models(folder: str = default_folder) -> Dict[str, str]:
+    '''
+    Returns the paths of the chat, draft and embedding models, building the ones that are missing.
+    The paths work as model names for the API.
+    '''
+    import torch
+    from transformers import Qwen2Config, Qwen2ForCausalLM, BertConfig, BertModel
+    from sentence_transformers import SentenceTransformer, models
+
+    paths = {name: os.path.join(folder, name) for name in ('chat', 'draft', 'embedding')}
+    if all(os.path.exists(os.path.join(path, 'config.json')) for path in paths.values()):
+        return paths
+
+    torch.manual_seed(0)
+    tokenizer = build_tokenizer(eos_token='<|im_end|>', pad_token='<|endoftext|>')
+    tokenizer.chat_template = CHAT_TEMPLATE
+    for name, hidden_size, layers in (('chat', 64, 2), ('draft', 32, 1)):
+        config = Qwen2Config(
+            vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2, num_hidden_layers=layers,
+            num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=2048,
+            eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id, tie_word_embeddings=True
+        )
+        Qwen2ForCausalLM(config).save_pretrained(paths[name])
+        tokenizer.save_pretrained(paths[name])
+
+    tokenizer = build_tokenizer(pad_token='[PAD]', cls_token='[CLS]', sep_token='[SEP]', unk_token='[UNK]')
+    config = BertConfig(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=1, num_attention_heads=2, intermediate_size=64, max_position_embeddings=512)
+    transformer_folder = os.path.join(folder, 'embedding-transformer')
+    BertModel(config).save_pretrained(transformer_folder)
+    tokenizer.save_pretrained(transformer_folder)
+    transformer = models.Transformer(transformer_folder, max_seq_length=512)
+    get_dimension = getattr(transformer, 'get_embedding_dimension', None) or transformer.get_word_embedding_dimension
+    pooling = models.Pooling(get_dimension(), pooling_mode='mean')
+    SentenceTransformer(modules=[transformer, pooling]).save(paths['embedding'])
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Build tiny local models for benchmarks.')
+    parser.add_argument('--folder', type=str, default=default_folder)
+    args = parser.parse_args()
+    print(json.dumps(build_tiny_models(args.folder), indent=2))
+
+if __name__ == '__main__':
+    main()
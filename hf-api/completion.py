@@ -1,8 +1,23 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextStreamer, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 from models import CompletionRequest, ChatCompletionRequest, Usage
 from utils import Text_Generation_Model_Cache_Folder as model_cache_folder
-from utils import timer, createLogger, LRUCache
-import os, gc, torch, asyncio
+from utils import span, record_span, createLogger, parse_size
+from metrics import record_usage
+from prefix_cache import PrefixCache
+from kv_cache import to_legacy_cache, from_legacy_cache
+from registry import model_registry
+from workers import get_worker_pool, run_on_workers
+from quantization import apply_load_options, load_options, probe_texts
+from scheduler import GenerationScheduler
+from admission import DeadlineExceeded
+from speculative import speculative_generate, get_draft_model_name, is_compatible
+from sampling import SamplingParams, RequestCancelled, StopSequenceCriteria, CancellationCriteria, find_stop, finish_text, get_eos_token_ids
+from typing import Any, AsyncIterator, Callable, List, Optional, Tuple
+from functools import partial
+from dataclasses import replace
+from time import perf_counter
+import os, torch, asyncio, threading
 from concurrent.futures import ThreadPoolExecutor
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -11,26 +26,32 @@ logger = createLogger(__name__)
 max_workers = int(os.getenv('MAX-WORKERS', '10'))
 executor = ThreadPoolExecutor(max_workers)
 
-cached_models = LRUCache(3)
-cached_tokenizers = LRUCache(3)
+registry_prefix = 'text-generation:'
 
-@timer(logger=logger)
-def get_chat_completion(request: ChatCompletionRequest) -> tuple[str, Usage]:
+continuous_batching = os.getenv('CONTINUOUS-BATCHING', 'false').lower() == 'true'
+continuous_batching_max_size = int(os.getenv('CONTINUOUS-BATCHING-MAX-SIZE', '16'))
+schedulers = {}
+
+prefix_cache = PrefixCache(
+    block_size=int(os.getenv('PREFIX-CACHE-BLOCK-SIZE', '32')),
+    memory_limit=parse_size(os.getenv('PREFIX-CACHE-SIZE', '1GB'))
+) if os.getenv('PREFIX-CACHE', 'false').lower() == 'true' else None
+
+@span(logger=logger)
+def get_chat_completion(request: ChatCompletionRequest, cancelled: Optional[threading.Event] = None) -> tuple[List[Tuple[str, str]], Usage]:
     cache_dir = os.path.join(model_cache_folder, request.model)
 
     (model, tokenizer) = get_cached_model(request.model, cache_dir)
 
-    text = tokenizer.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)
-    model_inputs = tokenizer([text], return_tensors="pt").to(device)
+    with span('tokenize', model=request.model):
+        text = tokenizer.apply_chat_template(request.messages, tokenize=False, add_generation_prompt=True)
+        model_inputs = tokenizer([text], return_tensors="pt").to(device)
     
     prompt_tokens = len(model_inputs.input_ids[0])
 
-    generated_ids = model.generate(model_inputs.input_ids, max_new_tokens=request.max_tokens)
-    generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
-
-    completion_tokens = len(generated_ids[0])
-    
-    response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    params = SamplingParams.from_request(request, cancelled)
+    generated_ids = generate(request.model, model, tokenizer, model_inputs.input_ids, params)
+    choices, completion_tokens = decode_choices(model, tokenizer, generated_ids[:, prompt_tokens:].tolist(), params)
 
     usage = Usage(
         prompt_tokens=prompt_tokens,
@@ -38,27 +59,25 @@ def get_chat_completion(request: ChatCompletionRequest) -> tuple[str, Usage]:
         total_tokens=prompt_tokens + completion_tokens
     )
     
-    return response, usage
+    return choices, usage
 
-@timer(logger=logger)
-def get_text_completion(request: CompletionRequest) -> tuple[str, Usage]:
+@span(logger=logger)
+def get_text_completion(request: CompletionRequest, cancelled: Optional[threading.Event] = None) -> tuple[List[Tuple[str, str]], Usage]:
     cache_dir = os.path.join(model_cache_folder, request.model)
 
     (model, tokenizer) = get_cached_model(request.model, cache_dir)
     
     messages = [{"role": "user", "content": request.prompt}] if isinstance(request.prompt, str) else request.prompt
 
-    text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    model_inputs = tokenizer([text], return_tensors="pt").to(device)
+    with span('tokenize', model=request.model):
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        model_inputs = tokenizer([text], return_tensors="pt").to(device)
     
     prompt_tokens = len(model_inputs.input_ids[0])
 
-    generated_ids = model.generate(model_inputs.input_ids, max_new_tokens=request.max_tokens)
-    generated_ids = [output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)]
-
-    completion_tokens = len(generated_ids[0])
-    
-    response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+    params = SamplingParams.from_request(request, cancelled)
+    generated_ids = generate(request.model, model, tokenizer, model_inputs.input_ids, params)
+    choices, completion_tokens = decode_choices(model, tokenizer, generated_ids[:, prompt_tokens:].tolist(), params)
     
     usage = Usage(
         prompt_tokens=prompt_tokens,
@@ -66,27 +85,302 @@ def get_text_completion(request: CompletionRequest) -> tuple[str, Usage]:
         total_tokens=prompt_tokens + completion_tokens
     )
     
-    return response, usage
+    return choices, usage
+
+def generate(model_name: str, model, tokenizer, input_ids: torch.Tensor, params: SamplingParams, **kwargs) -> torch.Tensor:
+    if params.is_cancelled():
+        raise RequestCancelled(f'Request for {model_name} cancelled before generation')
+
+    kwargs.update(params.to_generate_kwargs())
+    kwargs['streamer'] = StageStreamer(model_name, kwargs.get('streamer'))
+    draft_model = get_draft_model(model_name, tokenizer) if params.n == 1 else None
+    if draft_model is not None:
+        prompt_ids, eos_token_ids = input_ids[0].tolist(), get_eos_token_ids(model, tokenizer)
+        generated_ids, finish_reason = speculative_generate(model_name, model, draft_model, tokenizer, prompt_ids, params, eos_token_ids, kwargs['streamer'])
+        # like with generate, a sequence that stopped at EOS ends with it
+        generated_ids = generated_ids + eos_token_ids[:1] if finish_reason == 'eos_token' else generated_ids
+        return torch.tensor([prompt_ids + generated_ids], device=input_ids.device)
+
+    stopping_criteria = StoppingCriteriaList()
+    if len(params.stop) > 0:
+        stopping_criteria.append(StopSequenceCriteria(tokenizer, params.stop, input_ids.shape[-1]))
+    if params.deadline is not None or params.cancelled is not None:
+        stopping_criteria.append(CancellationCriteria(params))
+    if len(stopping_criteria) > 0:
+        kwargs['stopping_criteria'] = stopping_criteria
+
+    if prefix_cache is None or params.n > 1:
+        # a cached prefix holds a single row, generate does not expand it for `num_return_sequences`
+        return model.generate(input_ids, **kwargs)
+
+    prompt_ids = input_ids[0].tolist()
+    cached_length, past_key_values = prefix_cache.lookup(model_name, prompt_ids)
+    if past_key_values is not None:
+        kwargs['past_key_values'] = from_legacy_cache(past_key_values)
+
+    outputs = model.generate(input_ids, return_dict_in_generate=True, **kwargs)
+    prefix_cache.put(model_name, prompt_ids, to_legacy_cache(outputs.past_key_values))
+    return outputs.sequences
+
+def decode_choices(model, tokenizer, generated_ids: List[List[int]], params: SamplingParams) -> Tuple[List[Tuple[str, str]], int]:
+    '''
+    Turns the rows returned by `generate` into `(text, finish_reason)` choices and counts their tokens.
+    Rows that finished early are padded up to the longest one, so they end at their first EOS or pad token.
+    '''
+    end_token_ids = set(get_eos_token_ids(model, tokenizer))
+    if model.generation_config.pad_token_id is not None:
+        end_token_ids.add(model.generation_config.pad_token_id)
+
+    choices, completion_tokens = [], 0
+    for row in generated_ids:
+        end = next((index for index, token_id in enumerate(row) if token_id in end_token_ids), None)
+        finish_reason = 'length' if end is None else 'eos_token'
+        row = row[:end]
+        completion_tokens += len(row)
+        choices.append(decode_choice(tokenizer, row, finish_reason, params.stop))
+    return choices, completion_tokens
+
+def decode_choice(tokenizer, generated_ids: List[int], finish_reason: str, stop: List[str]) -> Tuple[str, str]:
+    text, stop_reason = finish_text(tokenizer.decode(generated_ids, skip_special_tokens=True), stop)
+    return text, stop_reason or finish_reason
 
 def get_cached_model(model_name: str, cache_dir: str):
-    if cached_models.hasKey(model_name):
-        return (cached_models.get(model_name), cached_tokenizers.get(model_name))
-    else:
-        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype="auto", device_map="auto", cache_dir=cache_dir)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        cached_models.put(model_name, model)
-        cached_tokenizers.put(model_name, tokenizer)
-        return (model, tokenizer)
+    return model_registry.get_or_load(registry_prefix + model_name, partial(load_model, model_name, cache_dir))
+
+def get_draft_model(model_name: str, tokenizer):
+    '''
+    The draft model for speculative decoding of `model_name` if one is configured, cached in the
+    registry like any other model.
+    '''
+    draft_name = get_draft_model_name(model_name)
+    if draft_name is None:
+        return None
+    (draft_model, draft_tokenizer) = get_cached_model(draft_name, os.path.join(model_cache_folder, draft_name))
+    return draft_model if is_compatible(model_name, tokenizer, draft_name, draft_tokenizer) else None
+
+def load_model(model_name: str, cache_dir: str):
+    # converted models start from fp32 so that they can be checked against it
+    torch_dtype = torch.float32 if model_name in load_options else "auto"
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch_dtype, device_map="auto", cache_dir=cache_dir)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = apply_load_options(model_name, model, probe=partial(probe_model, tokenizer))
+    return (model, tokenizer)
+
+@torch.inference_mode()
+def probe_model(tokenizer, model) -> torch.Tensor:
+    return torch.cat([model(**tokenizer([text], return_tensors="pt").to(model.device)).logits[0] for text in probe_texts])
+
+async def get_chat_completion_async(request: ChatCompletionRequest, cancelled: Optional[threading.Event] = None) -> tuple[List[Tuple[str, str]], Usage]:
+    if continuous_batching:
+        return await get_scheduled_completion(request.model, request.messages, SamplingParams.from_request(request, cancelled))
+
+    started_at = perf_counter()
+    choices, usage = await run_in_executor(request.model, get_chat_completion, request, cancelled=cancelled)
+    record_usage(request.model, usage.prompt_tokens, usage.completion_tokens, perf_counter() - started_at)
+    return choices, usage
+
+async def get_text_completion_async(request: CompletionRequest, cancelled: Optional[threading.Event] = None) -> tuple[List[Tuple[str, str]], Usage]:
+    if continuous_batching:
+        messages = [{"role": "user", "content": request.prompt}] if isinstance(request.prompt, str) else request.prompt
+        return await get_scheduled_completion(request.model, messages, SamplingParams.from_request(request, cancelled))
+
+    started_at = perf_counter()
+    choices, usage = await run_in_executor(request.model, get_text_completion, request, cancelled=cancelled)
+    record_usage(request.model, usage.prompt_tokens, usage.completion_tokens, perf_counter() - started_at)
+    return choices, usage
+
+async def run_in_executor(model_name: str, func: Callable, *args, cancelled: Optional[threading.Event] = None) -> Any:
+    '''
+    Runs `func` in the worker processes of `model_name` if it has any, or else on the thread pool,
+    recording how long the call waited for a thread. `cancelled` cannot be sent to worker processes,
+    generation there only stops early at the deadline of the request.
+    '''
+    loop = asyncio.get_event_loop()
+    pool = get_worker_pool(model_name)
+    if pool is not None:
+        return await loop.run_in_executor(pool, func, *args)
+
+    submitted_at = perf_counter()
+    def run():
+        record_span('queue_wait', perf_counter() - submitted_at, model=model_name)
+        return func(*args, cancelled=cancelled)
+    return await loop.run_in_executor(executor, run)
+
+async def get_scheduled_completion(model_name: str, messages: List[Any], params: SamplingParams) -> tuple[List[Tuple[str, str]], Usage]:
+    loop = asyncio.get_event_loop()
+    started_at = perf_counter()
+    prompt_ids, tokenizer = await loop.run_in_executor(executor, get_prompt_ids, model_name, messages)
+
+    futures = get_scheduler(model_name).submit(prompt_ids, params)
+    results = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+    choices = [decode_choice(tokenizer, generated_ids, finish_reason, params.stop) for generated_ids, finish_reason in results]
+    completion_tokens = sum(len(generated_ids) for generated_ids, _ in results)
 
-async def get_chat_completion_async(request: ChatCompletionRequest) -> tuple[str, Usage]:
+    usage = Usage(
+        prompt_tokens=len(prompt_ids),
+        completion_tokens=completion_tokens,
+        total_tokens=len(prompt_ids) + completion_tokens
+    )
+
+    record_usage(model_name, usage.prompt_tokens, completion_tokens, perf_counter() - started_at)
+    return choices, usage
+
+def get_prompt_ids(model_name: str, messages: List[Any]):
+    cache_dir = os.path.join(model_cache_folder, model_name)
+    (model, tokenizer) = get_cached_model(model_name, cache_dir)
+    with span('tokenize', model=model_name):
+        text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        return tokenizer([text])['input_ids'][0], tokenizer
+
+def get_scheduler(model_name: str) -> GenerationScheduler:
+    if model_name not in schedulers:
+        cache_dir = os.path.join(model_cache_folder, model_name)
+        schedulers[model_name] = GenerationScheduler(
+            name=model_name,
+            load=partial(get_cached_model, model_name, cache_dir),
+            max_batch_size=continuous_batching_max_size,
+            prefix_cache=prefix_cache
+        )
+    return schedulers[model_name]
+
+class AsyncQueueStreamer(TextStreamer):
+    '''
+    Pushes decoded text from the generation thread into an asyncio queue owned by `loop`.
+    '''
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, skip_prompt: bool = False):
+        super().__init__(tokenizer, skip_prompt=skip_prompt, skip_special_tokens=True)
+        self.loop = loop
+        self.queue = queue
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+
+
+class StageStreamer(BaseStreamer):
+    '''
+    Times the prefill and decode stages of `generate`, which puts the prompt into its streamer
+    first and then every generated token, and passes everything on to `streamer` if given.
+    '''
+    def __init__(self, model_name: str, streamer: Optional[BaseStreamer] = None):
+        self.model_name = model_name
+        self.streamer = streamer
+        self.started_at = perf_counter()
+        self.first_token_at = None
+        self.puts = 0
+
+    def put(self, value):
+        self.puts += 1
+        if self.puts == 2:
+            self.first_token_at = perf_counter()
+            record_span('prefill', self.first_token_at - self.started_at, model=self.model_name)
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        if self.first_token_at is not None:
+            record_span('decode', perf_counter() - self.first_token_at, model=self.model_name)
+        if self.streamer is not None:
+            self.streamer.end()
+
+async def stream_chat_completion_async(request: ChatCompletionRequest) -> AsyncIterator[Tuple[str, Optional[str]]]:
+    return await stream_completion(request.model, request.messages, SamplingParams.from_request(request))
+
+async def stream_text_completion_async(request: CompletionRequest) -> AsyncIterator[Tuple[str, Optional[str]]]:
+    messages = [{"role": "user", "content": request.prompt}] if isinstance(request.prompt, str) else request.prompt
+    return await stream_completion(request.model, messages, SamplingParams.from_request(request))
+
+async def stream_completion(model_name: str, messages: List[Any], params: SamplingParams) -> AsyncIterator[Tuple[str, Optional[str]]]:
+    '''
+    Tokenizes the prompt, which loads the model, and returns the stream of the completion, so
+    that an unknown model or a failed load is raised before a response starts. The stream
+    yields `(text, None)` for every decoded piece of text and finally `('', finish_reason)`.
+    Only a single choice is streamed. Text that could be the start of a stop sequence is held
+    back until it is clear whether it is one, so stop sequences never reach the client.
+    Generation is cancelled when the stream is closed early, e.g. because the client left.
+    A stream that runs past the deadline raises DeadlineExceeded instead of finishing.
+    '''
+    started_at = perf_counter()
     loop = asyncio.get_event_loop()
-    completion, usage = await loop.run_in_executor(executor, get_chat_completion, request)
-    return completion, usage
+    prompt_ids, tokenizer = await loop.run_in_executor(executor, get_prompt_ids, model_name, messages)
+    return stream_prompt(model_name, prompt_ids, tokenizer, replace(params, n=1, cancelled=params.cancelled or threading.Event()), started_at)
+
+async def stream_prompt(model_name: str, prompt_ids: List[int], tokenizer, params: SamplingParams, started_at: float) -> AsyncIterator[Tuple[str, Optional[str]]]:
+    try:
+        async for chunk in stream_generated(model_name, prompt_ids, tokenizer, params, started_at):
+            yield chunk
+    finally:
+        params.cancelled.set()
 
-async def get_text_completion_async(request: CompletionRequest) -> tuple[str, Usage]:
+async def stream_generated(model_name: str, prompt_ids: List[int], tokenizer, params: SamplingParams, started_at: float) -> AsyncIterator[Tuple[str, Optional[str]]]:
     loop = asyncio.get_event_loop()
-    completion, usage = await loop.run_in_executor(executor, get_text_completion, request)
-    return completion, usage
+    queue = asyncio.Queue()
+
+    if continuous_batching:
+        streamer = AsyncQueueStreamer(tokenizer, loop, queue)
+        future = asyncio.wrap_future(get_scheduler(model_name).submit(prompt_ids, params, streamer=streamer)[0])
+    else:
+        future = loop.run_in_executor(executor, generate_stream, model_name, prompt_ids, params, loop, queue)
+    future.add_done_callback(lambda _: queue.put_nowait(None))
+
+    holdback = max((len(stop) for stop in params.stop), default=1) - 1
+    pending, stopped = '', False
+    while True:
+        text = await queue.get()
+        if text is None:
+            break
+        if stopped:
+            continue
+
+        pending += text
+        position = find_stop(pending, params.stop)
+        if position >= 0:
+            pending, stopped = pending[:position], True
+        end = len(pending) if stopped else len(pending) - holdback
+        if end > 0:
+            yield pending[:end], None
+            pending = pending[end:]
+
+    if pending:
+        yield pending, None
+
+    try:
+        generated_ids, finish_reason = await future
+    except RequestCancelled:
+        # the deadline passed before generation started
+        generated_ids, finish_reason = [], None
+    record_usage(model_name, len(prompt_ids), len(generated_ids), perf_counter() - started_at)
+    if params.is_past_deadline():
+        # like run_cancellable, a generation cut off at the deadline does not finish normally
+        raise DeadlineExceeded(f'Deadline passed while generating with {model_name}')
+    yield '', 'stop_sequence' if stopped else finish_reason
+
+@span(logger=logger)
+def generate_stream(model_name: str, prompt_ids: List[int], params: SamplingParams, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> Tuple[List[int], str]:
+    cache_dir = os.path.join(model_cache_folder, model_name)
+    (model, tokenizer) = get_cached_model(model_name, cache_dir)
+
+    input_ids = torch.tensor([prompt_ids], device=model.device)
+    streamer = AsyncQueueStreamer(tokenizer, loop, queue, skip_prompt=True)
+    generated_ids = generate(model_name, model, tokenizer, input_ids, params, streamer=streamer)
+    generated_ids = generated_ids[0][len(prompt_ids):].tolist()
+
+    finish_reason = 'length' if len(generated_ids) >= params.max_new_tokens or params.is_cancelled() else 'eos_token'
+    return generated_ids, finish_reason
+
+@span(logger=logger)
+def warmup_model(model_name: str):
+    if run_on_workers(model_name, warmup_model, model_name):
+        return
+
+    cache_dir = os.path.join(model_cache_folder, model_name)
+    (model, tokenizer) = get_cached_model(model_name, cache_dir)
+    get_draft_model(model_name, tokenizer)
+    prompt_ids, _ = get_prompt_ids(model_name, [{"role": "user", "content": "warmup"}])
+    model.generate(torch.tensor([prompt_ids], device=model.device), max_new_tokens=2)
+
+def get_prefix_cache_stats() -> dict:
+    return prefix_cache.stats() if prefix_cache is not None else {}
 
 def release_completion_models():
-    gc.collect()
\ No newline at end of file
+    model_registry.evict_all(registry_prefix)
\ No newline at end of file
@@ -0,0 +1,104 @@
+from typing import List, Optional, Tuple
+from hashlib import sha256
+from time import time
+from utils import createLogger, LRUCache, format_size
+import os, sqlite3, threading
+import numpy as np
+
+logger = createLogger(__name__)
+
+class EmbeddingCache:
+    '''
+    Content-addressed cache of embedding vectors keyed by `(model, sha256(text))`. Lookups go to an
+    in-memory LRU first and then to a SQLite file holding float32 blobs together with the token
+    count of each text, so cache hits can still be reported in `usage`. The file is trimmed by
+    least recent use once it grows beyond `disk_size_limit` bytes.
+    '''
+    def __init__(self, path: str, memory_items: int, disk_size_limit: int):
+        self.memory = LRUCache(memory_items)
+        self.disk_size_limit = disk_size_limit
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, tokens INTEGER NOT NULL, last_used REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.disk_size = self.db.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[Tuple[np.ndarray, int]]]:
+        keys = [get_key(model_name, text) for text in texts]
+        results = [self.memory.get(key) for key in keys]
+        self.memory_hits += sum(1 for result in results if result is not None)
+
+        missing = [key for key, result in zip(keys, results) if result is None]
+        if len(missing) > 0:
+            found = {}
+            with self.lock:
+                for start in range(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    for key, vector, tokens in self.db.execute(f'SELECT key, vector, tokens FROM embeddings WHERE key IN ({placeholders})', chunk):
+                        found[key] = (np.frombuffer(vector, dtype=np.float32), tokens)
+                    self.db.execute(f'UPDATE embeddings SET last_used = ? WHERE key IN ({placeholders})', [time()] + chunk)
+                self.db.commit()
+
+            for index, key in enumerate(keys):
+                if results[index] is None and key in found:
+                    results[index] = found[key]
+                    self.memory.put(key, found[key])
+            self.disk_hits += len(found)
+            self.misses += len(missing) - len(found)
+
+        return results
+
+    def put_many(self, model_name: str, texts: List[str], vectors: np.ndarray, token_counts: List[int]):
+        vectors = vectors.astype(np.float32, copy=False)
+        # repeated texts of a request are stored once
+        rows = {}
+        for text, vector, tokens in zip(texts, vectors, token_counts):
+            key = get_key(model_name, text)
+            self.memory.put(key, (vector, tokens))
+            rows[key] = (key, vector.tobytes(), int(tokens), time())
+
+        with self.lock:
+            for row in rows.values():
+                # a row stored meanwhile by a concurrent miss on the same text is kept, so that
+                # disk_size only grows by rows that were added
+                if self.db.execute('INSERT OR IGNORE INTO embeddings (key, vector, tokens, last_used) VALUES (?, ?, ?, ?)', row).rowcount > 0:
+                    self.disk_size += len(row[1])
+            if self.disk_size > self.disk_size_limit:
+                self.trim()
+            self.db.commit()
+
+    def trim(self):
+        # trim below the limit so that the next few inserts do not have to trim again
+        target = int(self.disk_size_limit * 0.9)
+        while self.disk_size > target:
+            rows = self.db.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 1000').fetchall()
+            if len(rows) == 0:
+                break
+            freed, keys = 0, []
+            for key, size in rows:
+                if self.disk_size - freed <= target:
+                    break
+                keys.append(key)
+                freed += size
+            self.db.execute(f'DELETE FROM embeddings WHERE key IN ({",".join("?" * len(keys))})', keys)
+            self.disk_size -= freed
+        logger.info(f'Trimmed embedding cache to {format_size(self.disk_size)}')
+
+    def stats(self) -> dict:
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'disk_size': self.disk_size,
+            'disk_size_limit': self.disk_size_limit,
+        }
+
+
+def get_key(model_name: str, text: str) -> str:
+    return f'{model_name}:{sha256(str(text).encode("utf-8")).hexdigest()}'
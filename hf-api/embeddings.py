@@ -1,62 +1,263 @@
 from sentence_transformers import SentenceTransformer
-from models import EmbeddingsRequest, EmbeddingsObjectResponse, Usage
-from typing import List, Tuple
+from sentence_transformers.util import batch_to_device
+from models import EmbeddingsRequest, Usage
+from typing import List, Optional, Tuple
 from utils import Embedding_Model_Cache_Folder as model_cache_folder
-import os, gc, asyncio
-from utils import timer, createLogger, LRUCache
+from utils import Embedding_Result_Cache_File as result_cache_file
+import os, json, asyncio, torch
+import numpy as np
+import base64, orjson
+from utils import span, createLogger, parse_size
+from metrics import record_usage
+from embedding_cache import EmbeddingCache
+from registry import model_registry
+from workers import get_worker_pool, run_on_workers
+from quantization import apply_load_options, probe_texts, load_options
 from concurrent.futures import ThreadPoolExecutor
-from transformers import AutoTokenizer
+from batching import DynamicBatcher
+from functools import partial
 
-cached_models = LRUCache(5)
-cached_tokenizers = LRUCache(5)
+registry_prefix = 'embedding:'
 logger = createLogger(__name__)
 
 max_workers = int(os.getenv('MAX-WORKERS', '10'))
 executor = ThreadPoolExecutor(max_workers)
+batch_size = int(os.getenv('EMBEDDING-BATCH-SIZE', '32'))
+
+dynamic_batching = os.getenv('DYNAMIC-BATCHING', 'true').lower() == 'true'
+dynamic_batch_max_size = int(os.getenv('DYNAMIC-BATCH-MAX-SIZE', '256'))
+dynamic_batch_wait_ms = float(os.getenv('DYNAMIC-BATCH-WAIT-MS', '5'))
+batchers = {}
+model_dimensions = {}
+
+embedding_cache = EmbeddingCache(
+    path=os.getenv('EMBEDDING-CACHE-PATH', result_cache_file),
+    memory_items=int(os.getenv('EMBEDDING-CACHE-MEMORY-ITEMS', '10000')),
+    disk_size_limit=parse_size(os.getenv('EMBEDDING-CACHE-DISK-SIZE', '1GB'))
+) if os.getenv('EMBEDDING-CACHE', 'false').lower() == 'true' else None
+
+def get_embeddings(request: EmbeddingsRequest) -> Tuple[np.ndarray, Usage]: 
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    vectors, token_counts = get_embeddings_batch(request.model, texts)
+    return vectors, build_usage(token_counts)
+
+@span(logger=logger)
+def get_embeddings_batch(model_name: str, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+    if embedding_cache is None:
+        return encode_model_texts(model_name, texts)
+
+    cache_name = get_cache_name(model_name)
+    cached = embedding_cache.get_many(cache_name, texts)
+    missing = [index for index, result in enumerate(cached) if result is None]
+    if len(missing) == len(texts):
+        vectors, token_counts = encode_model_texts(model_name, texts)
+        embedding_cache.put_many(cache_name, texts, vectors, token_counts)
+        return vectors, token_counts
+
+    if len(missing) > 0:
+        missing_texts = [texts[index] for index in missing]
+        missing_vectors, missing_token_counts = encode_model_texts(model_name, missing_texts)
+        embedding_cache.put_many(cache_name, missing_texts, missing_vectors, missing_token_counts)
+        for index, vector, token_count in zip(missing, missing_vectors, missing_token_counts):
+            cached[index] = (vector, token_count)
+
+    vectors = np.stack([vector for vector, _ in cached])
+    token_counts = [token_count for _, token_count in cached]
+    return vectors, token_counts
+
+def get_cache_name(model_name: str) -> str:
+    # int8, bf16 and ONNX variants give slightly different vectors than fp32, cache them apart
+    options = load_options.get(model_name)
+    return f'{model_name}:{json.dumps(options, sort_keys=True)}' if options else model_name
+
+def encode_model_texts(model_name: str, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+    pool = get_worker_pool(model_name)
+    if pool is not None:
+        return pool.submit(encode_model_texts, model_name, texts).result()
 
-@timer(logger=logger)
-def get_embeddings(request: EmbeddingsRequest) -> Tuple[List[EmbeddingsObjectResponse], Usage]: 
     cache_dir = os.path.join(model_cache_folder)
-    model, tokenizer = get_cached_model(model_name=request.model, cache_dir=cache_dir)
-    
-    total_tokens = 0
-    
-    if isinstance(request.input, str):
-        tokens = tokenizer(request.input, add_special_tokens=True)
-        total_tokens = len(tokens['input_ids'])
-        vectors = model.encode(request.input)
-        embeddings = [EmbeddingsObjectResponse(embedding=vectors, index=0, object="embedding")]
-    elif isinstance(request.input, list):
-        embeddings = []
-        for index, text_input in enumerate(request.input):
-            tokens = tokenizer(text_input, add_special_tokens=True)
-            total_tokens += len(tokens['input_ids'])
-            vectors = model.encode(text_input)
-            embeddings.append(EmbeddingsObjectResponse(embedding=vectors, index=index, object="embedding"))
-    
-    usage = Usage(
+    model, _ = get_cached_model(model_name=model_name, cache_dir=cache_dir)
+    with span('encode', model=model_name):
+        return encode_texts(model, texts)
+
+def build_usage(token_counts: List[int]) -> Usage:
+    total_tokens = sum(token_counts)
+    return Usage(
         prompt_tokens=total_tokens,
         completion_tokens=0, 
         total_tokens=total_tokens
     )
+
+def serialize_embeddings(request: EmbeddingsRequest, vectors: np.ndarray, usage: Usage) -> bytes:
+    '''
+    Builds the `/v1/embeddings` response body straight from the NumPy array: orjson writes the
+    rows without creating a Python float per element, and base64 output is the raw little-endian
+    bytes of each row.
+    '''
+    with span('serialize', model=request.model):
+        return build_response(request, vectors, usage)
+
+def build_response(request: EmbeddingsRequest, vectors: np.ndarray, usage: Usage) -> bytes:
+    vectors = quantize(resize(vectors, request.dimensions, request.normalize), request.dtype)
+    if request.encoding_format == 'base64':
+        vectors = vectors.astype(vectors.dtype.newbyteorder('<'), copy=False)
+        embeddings = [base64.b64encode(vector.tobytes()).decode('ascii') for vector in vectors]
+    else:
+        embeddings = list(np.ascontiguousarray(vectors))
+
+    return orjson.dumps({
+        'object': 'list',
+        'data': [{'object': 'embedding', 'index': index, 'embedding': embedding} for index, embedding in enumerate(embeddings)],
+        'model': request.model,
+        'usage': usage.model_dump()
+    }, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def resize(vectors: np.ndarray, dimensions: Optional[int], normalize: bool) -> np.ndarray:
+    '''
+    Truncates all rows to `dimensions` and scales them to unit length in one pass over the batch,
+    so that clients can compare the vectors with a dot product.
+    '''
+    if dimensions is not None:
+        vectors = vectors[:, :dimensions]
+    if normalize:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors = vectors / norms
+    return vectors
+
+def quantize(vectors: np.ndarray, dtype: str) -> np.ndarray:
+    if dtype == 'float16':
+        return vectors.astype(np.float16)
+    if dtype == 'int8':
+        # symmetric per-vector scaling keeps the direction (and so cosine similarity) of every vector
+        scale = np.abs(vectors).max(axis=1, keepdims=True)
+        scale[scale == 0] = 1
+        return np.rint(vectors / scale * 127).astype(np.int8)
+    return vectors.astype(np.float32, copy=False)
+
+@torch.inference_mode()
+def encode_texts(model: SentenceTransformer, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+    '''
+    Tokenizes all texts in one call of the model's own tokenizer and feeds slices of the result to
+    the model, so the token counts for usage come from the same pass the model consumes. The
+    model's default prompt is applied like `SentenceTransformer.encode` does.
+    '''
+    if len(texts) == 0:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32), []
+
+    prompt = model.prompts.get(model.default_prompt_name) if model.default_prompt_name else None
+    if prompt:
+        texts = [prompt + text for text in texts]
+    features = model.tokenize(texts)
+    if prompt and 'input_ids' in features:
+        # lets models that pool without the prompt (e.g. INSTRUCTOR) drop it, a trailing special token is not part of it
+        prompt_ids = model.tokenize([prompt])['input_ids'][0].tolist()
+        features['prompt_length'] = len(prompt_ids) - (1 if prompt_ids[-1] in model.tokenizer.all_special_ids else 0)
+    token_counts = features['attention_mask'].sum(dim=1).tolist()
+    padding_side = getattr(model.tokenizer, 'padding_side', 'right')
+
+    # sort by length so that each micro-batch pads to a similar length, then scatter back by index
+    order = np.argsort([-count for count in token_counts], kind='stable')
+    vectors = None
+    for start in range(0, len(texts), batch_size):
+        indices = order[start:start + batch_size]
+        batch = slice_features(features, indices, token_counts[indices[0]], padding_side)
+        batch_vectors = model(batch_to_device(batch, model.device))['sentence_embedding'].float().cpu().numpy()
+        if vectors is None:
+            vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=batch_vectors.dtype)
+        vectors[indices] = batch_vectors
+
+    return vectors, token_counts
+
+def slice_features(features: dict, indices: np.ndarray, length: int, padding_side: str) -> dict:
+    '''
+    Selects the rows `indices` of the tokenized features and drops the padding beyond `length`.
+    '''
+    rows = torch.as_tensor(indices)
+    batch = {}
+    for key, value in features.items():
+        if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == len(features['attention_mask']):
+            value = value[rows]
+            if value.dim() == 2:
+                value = value[:, :length] if padding_side == 'right' else value[:, -length:]
+        batch[key] = value
+    return batch
     
-    return embeddings, usage
-    
-async def get_embeddings_async(request: EmbeddingsRequest) -> Tuple[List[EmbeddingsObjectResponse], Usage]:
+async def get_embeddings_async(request: EmbeddingsRequest) -> Tuple[np.ndarray, Usage]:
+    if dynamic_batching:
+        texts = [request.input] if isinstance(request.input, str) else request.input
+        vectors, token_counts = await get_batcher(request.model).submit(texts)
+        record_usage(request.model, sum(token_counts))
+        return vectors, build_usage(token_counts)
+
+    loop = asyncio.get_event_loop()
+    vectors, usage = await loop.run_in_executor(executor, get_embeddings, request)
+    record_usage(request.model, usage.prompt_tokens)
+    return vectors, usage
+
+async def check_dimensions(request: EmbeddingsRequest):
+    if request.dimensions is None:
+        return
+    if request.dimensions < 1:
+        raise ValueError('dimensions needs to be a positive integer')
     loop = asyncio.get_event_loop()
-    embeddings, usage = await loop.run_in_executor(executor, get_embeddings, request)
-    return embeddings, usage
+    dimension = await loop.run_in_executor(executor, get_model_dimension, request.model)
+    if dimension is not None and request.dimensions > dimension:
+        raise ValueError(f'{request.model} has {dimension} dimensions, {request.dimensions} is too many')
+
+def get_model_dimension(model_name: str) -> Optional[int]:
+    if model_name not in model_dimensions:
+        pool = get_worker_pool(model_name)
+        if pool is not None:
+            dimension = pool.submit(get_model_dimension, model_name).result()
+        else:
+            model, _ = get_cached_model(model_name=model_name, cache_dir=model_cache_folder)
+            dimension = model.get_sentence_embedding_dimension()
+        model_dimensions[model_name] = dimension
+    return model_dimensions[model_name]
+
+def get_batcher(model_name: str) -> DynamicBatcher:
+    if model_name not in batchers:
+        batchers[model_name] = DynamicBatcher(
+            name=model_name,
+            process=partial(get_embeddings_batch, model_name),
+            executor=executor,
+            max_batch_size=dynamic_batch_max_size,
+            max_wait_ms=dynamic_batch_wait_ms
+        )
+    return batchers[model_name]
+
+def get_embedding_cache_stats() -> dict:
+    return embedding_cache.stats() if embedding_cache is not None else {}
+
+def get_batcher_stats() -> dict:
+    return {model_name: batcher.stats() for model_name, batcher in batchers.items()}
 
 def get_cached_model(model_name: str, cache_dir: str):
-    if cached_models.hasKey(model_name):
-        return cached_models.get(model_name), cached_tokenizers.get(model_name)
-    else:
-        model = SentenceTransformer(model_name, cache_folder=cache_dir, trust_remote_code=True)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
-        cached_models.put(model_name, model)
-        cached_tokenizers.put(model_name, tokenizer)
-        return model, tokenizer
+    return model_registry.get_or_load(registry_prefix + model_name, partial(load_model, model_name, cache_dir))
+
+def load_model(model_name: str, cache_dir: str):
+    model = SentenceTransformer(model_name, cache_folder=cache_dir, trust_remote_code=True)
+    model = apply_load_options(model_name, model, probe=probe_model, load_onnx=partial(load_onnx_model, model_name, cache_dir))
+    return model, model.tokenizer
+
+def load_onnx_model(model_name: str, cache_dir: str) -> SentenceTransformer:
+    model = SentenceTransformer(model_name, cache_folder=cache_dir, trust_remote_code=True, backend='onnx')
+    # the weights live in an ONNX Runtime session, count the model file against the memory budget instead
+    model_path = getattr(model[0].auto_model, 'model_path', None)
+    if model_path is not None and os.path.exists(model_path):
+        model.external_size = os.path.getsize(model_path)
+    return model
+
+def probe_model(model: SentenceTransformer) -> torch.Tensor:
+    return torch.from_numpy(model.encode(probe_texts, convert_to_numpy=True))
     
+@span(logger=logger)
+def warmup_model(model_name: str):
+    if not run_on_workers(model_name, warmup_model, model_name):
+        # bypasses the embedding cache, a cached 'warmup' would skip loading the model
+        encode_model_texts(model_name, ['warmup'])
+
 def release_embedding_models():
-    gc.collect()
+    model_registry.evict_all(registry_prefix)
 
@@ -0,0 +1,67 @@
+from typing import List, Tuple
+import torch
+
+# A per-sequence KV cache is kept in the legacy layout: one (key, value) pair per layer,
+# each tensor shaped [batch, num_heads, seq_len, head_dim]. It converts to whatever cache
+# object the installed transformers version expects right before a forward pass.
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+def to_legacy_cache(past_key_values) -> LegacyCache:
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, 'layers'):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return tuple(past_key_values)
+
+def from_legacy_cache(past_key_values: LegacyCache):
+    from transformers import DynamicCache
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+def cache_length(past_key_values: LegacyCache) -> int:
+    return past_key_values[0][0].shape[-2]
+
+def merge_caches(caches: List[LegacyCache]) -> Tuple[LegacyCache, torch.Tensor]:
+    '''
+    Left-pads every cache to the longest one and concatenates them along the batch axis.
+    Returns the batched cache and an attention mask of shape [batch, max_len] covering it.
+    '''
+    lengths = [cache_length(cache) for cache in caches]
+    max_length = max(lengths)
+    device = caches[0][0][0].device
+    attention_mask = torch.zeros((len(caches), max_length), dtype=torch.long, device=device)
+    for index, length in enumerate(lengths):
+        attention_mask[index, max_length - length:] = 1
+
+    if len(caches) == 1:
+        return caches[0], attention_mask
+
+    merged = []
+    for layer in range(len(caches[0])):
+        keys = [pad_left(cache[layer][0], max_length) for cache in caches]
+        values = [pad_left(cache[layer][1], max_length) for cache in caches]
+        merged.append((torch.cat(keys, dim=0), torch.cat(values, dim=0)))
+    return tuple(merged), attention_mask
+
+def split_cache(past_key_values: LegacyCache, lengths: List[int]) -> List[LegacyCache]:
+    '''
+    Inverse of `merge_caches`: slices a left-padded batched cache back into per-sequence caches
+    of the given lengths.
+    '''
+    max_length = cache_length(past_key_values)
+    return [
+        tuple((keys[index:index + 1, :, max_length - length:], values[index:index + 1, :, max_length - length:]) for keys, values in past_key_values)
+        for index, length in enumerate(lengths)
+    ]
+
+def pad_left(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    padding = length - tensor.shape[-2]
+    if padding == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[-2] = padding
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=-2)
+
+def crop_cache(past_key_values: LegacyCache, length: int) -> LegacyCache:
+    return tuple((keys[:, :, :length], values[:, :, :length]) for keys, values in past_key_values)
@@ -0,0 +1,72 @@
+from typing import Callable, Dict, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from utils import span_listeners
+
+stage_seconds = Histogram(
+    'hf_api_stage_seconds', 'Time spent in each stage of handling a request',
+    ['stage', 'model'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+prompt_tokens = Counter('hf_api_prompt_tokens', 'Prompt or input tokens processed', ['model'])
+completion_tokens = Counter('hf_api_completion_tokens', 'Tokens generated', ['model'])
+tokens_per_second = Gauge('hf_api_tokens_per_second', 'Generation throughput of the latest completion', ['model'])
+executor_queue_depth = Gauge('hf_api_executor_queue_depth', 'Calls waiting for a thread of an executor', ['executor'])
+
+def observe_span(stage: str, labels: Dict[str, str], elapsed: float):
+    stage_seconds.labels(stage, labels.get('model', '')).observe(elapsed)
+
+span_listeners.append(observe_span)
+
+def record_usage(model_name: str, prompt_token_count: int, completion_token_count: int = 0, seconds: float = 0):
+    prompt_tokens.labels(model_name).inc(prompt_token_count)
+    if completion_token_count > 0:
+        completion_tokens.labels(model_name).inc(completion_token_count)
+        if seconds > 0:
+            tokens_per_second.labels(model_name).set(completion_token_count / seconds)
+
+def register_executor(name: str, executor: ThreadPoolExecutor):
+    executor_queue_depth.labels(name).set_function(lambda: executor._work_queue.qsize())
+
+
+class StatsCollector:
+    '''
+    Exports the numbers of existing `stats()` dictionaries as gauges named after their source and
+    key, e.g. `hf_api_model_registry_hits`. Dictionaries keyed by model, like the batcher stats or
+    the models of the registry, become a `model` label. They are read when metrics are scraped.
+    '''
+    def __init__(self, sources: Dict[str, Callable[[], dict]]):
+        self.sources = sources
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        families: Dict[str, GaugeMetricFamily] = {}
+        for source, get_stats in self.sources.items():
+            for name, labels, value in flatten_stats(f'hf_api_{source}', get_stats(), {}):
+                if name not in families:
+                    families[name] = GaugeMetricFamily(name, f'{source} stats', labels=list(labels.keys()))
+                families[name].add_metric(list(labels.values()), value)
+        return iter(families.values())
+
+    def describe(self):
+        # prevents the registry from collecting once at registration
+        return []
+
+
+def flatten_stats(prefix: str, stats: dict, labels: Dict[str, str]) -> Iterator[Tuple[str, Dict[str, str], float]]:
+    if len(stats) > 0 and all(isinstance(value, dict) for value in stats.values()):
+        for model_name, model_stats in stats.items():
+            yield from flatten_stats(prefix, model_stats, {**labels, 'model': model_name})
+        return
+
+    for key, value in stats.items():
+        if isinstance(value, (bool, int, float)):
+            yield f'{prefix}_{key}', labels, float(value)
+        elif isinstance(value, dict):
+            yield from flatten_stats(f'{prefix}_{key}', value, labels)
+
+def register_stats(sources: Dict[str, Callable[[], dict]]):
+    REGISTRY.register(StatsCollector(sources))
+
+def get_metrics() -> bytes:
+    return generate_latest(REGISTRY)
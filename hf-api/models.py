@@ -23,6 +23,8 @@ class ChatCompletionRequest(BaseModel):
     stream: bool = False
     frequency_penalty: Optional[float] = 1.0
     user: Optional[str] = Field(default='')
+    # unix time after which the request is abandoned, see also the X-Request-Timeout header
+    deadline: Optional[float] = None
 
 
 class ChatCompletionResponseChoice(BaseModel):
@@ -72,6 +74,8 @@ class CompletionRequest(BaseModel):
     stream: bool = False
     frequency_penalty: Optional[float] = 1.0
     user: Optional[str] = Field(default='')
+    # unix time after which the request is abandoned, see also the X-Request-Timeout header
+    deadline: Optional[float] = None
     logprobs: bool = False
     echo: bool = False
 
@@ -111,12 +115,18 @@ class EmbeddingsRequest(BaseModel):
     model: Optional[str] = Field(default="google-bert/bert-base-chinese")
     input: Union[str, List[Any]] = Field(default=["人生若只如初见，何事秋风悲画扇"])
     user: Optional[str] = Field(default='')
+    deadline: Optional[float] = None
+    encoding_format: Literal["float", "base64"] = "float"
+    dtype: Literal["float32", "float16", "int8"] = "float32"
+    # keeps the first `dimensions` values of every vector, for models trained with Matryoshka loss
+    dimensions: Optional[int] = None
+    normalize: bool = False
 
 
 class EmbeddingsObjectResponse(BaseModel):
     index: int
     object: str = "embedding"
-    embedding: List[float]
+    embedding: Union[List[float], str]
 
 
 class EmbeddingsResponse(BaseModel):
@@ -0,0 +1,133 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from hashlib import sha256
+from kv_cache import LegacyCache, cache_length
+from utils import createLogger, format_size
+import threading
+
+logger = createLogger(__name__)
+
+@dataclass
+class PrefixEntry:
+    past_key_values: LegacyCache
+    block_hashes: List[str]
+    size: int
+
+
+class PrefixCache:
+    '''
+    Reuses the KV cache of prompt prefixes across requests. Prompts are split into blocks of
+    `block_size` tokens and every block boundary is identified by a hash chained over all tokens
+    before it, so the boundaries of all cached prompts form a prefix tree. A lookup walks the chain
+    of a new prompt until it leaves the tree and returns the KV cache for the deepest boundary
+    found, leaving only the rest of the prompt to be prefilled. Entries are evicted in LRU order
+    to keep their tensors under `memory_limit` bytes.
+    '''
+    def __init__(self, block_size: int, memory_limit: int):
+        self.block_size = block_size
+        self.memory_limit = memory_limit
+        self.entries: OrderedDict[str, PrefixEntry] = OrderedDict()
+        self.index: Dict[str, Tuple[str, int]] = {}
+        self.lock = threading.Lock()
+        self.used_memory = 0
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.tokens_saved = 0
+
+    def lookup(self, model_name: str, prompt_ids: List[int]) -> Tuple[int, Optional[LegacyCache]]:
+        '''
+        Returns the number of leading prompt tokens covered by the cache and their KV cache.
+        At least one prompt token is always left uncached so that prefill still yields logits.
+        '''
+        block_hashes = self.hash_blocks(model_name, prompt_ids[:len(prompt_ids) - 1])
+        if self.lookups % 100 == 99:
+            self.log_stats()
+
+        with self.lock:
+            self.lookups += 1
+            self.prompt_tokens += len(prompt_ids)
+            match = None
+            for block_hash in block_hashes:
+                if block_hash not in self.index:
+                    break
+                match = self.index[block_hash]
+            if match is None:
+                return 0, None
+
+            entry_key, length = match
+            self.entries.move_to_end(entry_key)
+            past_key_values = self.entries[entry_key].past_key_values
+            self.hits += 1
+            self.tokens_saved += length
+
+        logger.debug(f'Prefix cache hit for {model_name}: reused {length} of {len(prompt_ids)} prompt tokens')
+        return length, tuple((keys[:, :, :length], values[:, :, :length]) for keys, values in past_key_values)
+
+    def put(self, model_name: str, prompt_ids: List[int], past_key_values: LegacyCache) -> None:
+        '''
+        Stores the block aligned part of `past_key_values` that belongs to `prompt_ids`.
+        '''
+        length = min(len(prompt_ids), cache_length(past_key_values)) // self.block_size * self.block_size
+        if length == 0:
+            return
+
+        block_hashes = self.hash_blocks(model_name, prompt_ids[:length])
+        entry_key = block_hashes[-1]
+        with self.lock:
+            if entry_key in self.index:
+                # already covered by this or a longer cached prompt
+                self.entries.move_to_end(self.index[entry_key][0])
+                return
+
+        past_key_values = tuple((keys[:, :, :length].clone(), values[:, :, :length].clone()) for keys, values in past_key_values)
+        size = sum(keys.numel() * keys.element_size() + values.numel() * values.element_size() for keys, values in past_key_values)
+        if size > self.memory_limit:
+            return
+
+        with self.lock:
+            while self.used_memory + size > self.memory_limit and len(self.entries) > 0:
+                self.evict(next(iter(self.entries)))
+            self.entries[entry_key] = PrefixEntry(past_key_values=past_key_values, block_hashes=block_hashes, size=size)
+            self.used_memory += size
+            for index, block_hash in enumerate(block_hashes):
+                self.index[block_hash] = (entry_key, (index + 1) * self.block_size)
+
+    def evict(self, entry_key: str) -> None:
+        entry = self.entries.pop(entry_key)
+        self.used_memory -= entry.size
+        for index, block_hash in enumerate(entry.block_hashes):
+            if self.index.get(block_hash, (None,))[0] != entry_key:
+                continue
+            # another entry may share this boundary, keep it reachable through that one
+            owner = next((key for key, other in reversed(self.entries.items()) if block_hash in other.block_hashes), None)
+            if owner is None:
+                del self.index[block_hash]
+            else:
+                self.index[block_hash] = (owner, (index + 1) * self.block_size)
+
+    def hash_blocks(self, model_name: str, token_ids: List[int]) -> List[str]:
+        block_hashes = []
+        digest = sha256(model_name.encode('utf-8'))
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            digest.update(','.join(map(str, token_ids[start:start + self.block_size])).encode('ascii') + b';')
+            block_hashes.append(digest.copy().hexdigest())
+        return block_hashes
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'used_memory': self.used_memory,
+                'memory_limit': self.memory_limit,
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.lookups, 3) if self.lookups else 0,
+                'prompt_tokens': self.prompt_tokens,
+                'tokens_saved': self.tokens_saved,
+            }
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.info(f'Prefix cache: {stats["entries"]} entries, {format_size(stats["used_memory"])}, hit rate {stats["hit_rate"]}, {stats["tokens_saved"]} of {stats["prompt_tokens"]} prompt tokens reused')
@@ -0,0 +1,53 @@
+from typing import Dict, List
+from utils import createLogger
+import os, json, asyncio
+import completion, embeddings
+
+logger = createLogger(__name__)
+
+preload_status: Dict[str, str] = {}
+preload_finished = False
+
+def get_preload_config() -> Dict[str, List[str]]:
+    '''
+    Models to preload come from the JSON file named by PRELOAD-CONFIG, e.g.
+    {"embedding": ["BAAI/bge-small-zh-v1.5"], "completion": ["Qwen/Qwen1.5-1.8B-Chat"]},
+    and/or the comma separated PRELOAD-EMBEDDING-MODELS and PRELOAD-COMPLETION-MODELS.
+    '''
+    config = {'embedding': [], 'completion': []}
+    config_file = os.getenv('PRELOAD-CONFIG', '')
+    if config_file:
+        with open(config_file, 'rt', encoding='utf-8') as f:
+            for kind, models in json.load(f).items():
+                config[kind].extend(models)
+
+    for kind, env in [('embedding', 'PRELOAD-EMBEDDING-MODELS'), ('completion', 'PRELOAD-COMPLETION-MODELS')]:
+        config[kind].extend(name.strip() for name in os.getenv(env, '').split(',') if name.strip())
+    return config
+
+async def preload_models():
+    global preload_finished
+    config = get_preload_config()
+    loop = asyncio.get_event_loop()
+
+    tasks = []
+    for model_name in config['embedding']:
+        tasks.append(warmup('embedding:' + model_name, loop.run_in_executor(embeddings.executor, embeddings.warmup_model, model_name)))
+    for model_name in config['completion']:
+        tasks.append(warmup('text-generation:' + model_name, loop.run_in_executor(completion.executor, completion.warmup_model, model_name)))
+
+    await asyncio.gather(*tasks)
+    preload_finished = True
+    logger.info(f'Preloading finished: {preload_status}')
+
+async def warmup(key: str, task: asyncio.Future):
+    preload_status[key] = 'loading'
+    try:
+        await task
+        preload_status[key] = 'ready'
+    except Exception as e:
+        logger.exception(f'Preloading {key} failed')
+        preload_status[key] = f'failed: {e}'
+
+def is_ready() -> bool:
+    return preload_finished and all(status == 'ready' for status in preload_status.values())
@@ -0,0 +1,101 @@
+from typing import Callable, Dict, Optional
+from utils import createLogger, format_size
+import os, copy, json, torch
+
+logger = createLogger(__name__)
+
+precisions = ('fp32', 'bf16', 'int8')
+backends = ('torch', 'onnx')
+probe_texts = [
+    '人生若只如初见，何事秋风悲画扇',
+    'The quick brown fox jumps over the lazy dog.',
+    '向量数据库通过近似最近邻搜索来检索相似的文本',
+    'def add(a, b):\n    return a + b',
+]
+
+def get_load_options() -> Dict[str, dict]:
+    '''
+    MODEL-LOAD-OPTIONS maps model names to how they are loaded, e.g.
+    {"BAAI/bge-small-zh-v1.5": {"backend": "onnx"}, "Qwen/Qwen1.5-1.8B-Chat": {"precision": "int8"}}.
+    `precision` is one of fp32 (default), bf16 or int8 (dynamic quantization of all linear layers),
+    `backend` is torch (default) or onnx, which is only available for embedding models and needs
+    `optimum[onnxruntime]`. A converted model is checked against fp32 on a few probe inputs and
+    only used if the mean cosine similarity of the outputs reaches `min_similarity` (0.99),
+    unless `check_accuracy` is false.
+    '''
+    return json.loads(os.getenv('MODEL-LOAD-OPTIONS', '{}'))
+
+load_options = get_load_options()
+
+def apply_load_options(model_name: str, model: torch.nn.Module, probe: Callable[[torch.nn.Module], torch.Tensor], load_onnx: Optional[Callable[[], torch.nn.Module]] = None) -> torch.nn.Module:
+    '''
+    Returns `model`, an fp32 model, converted as configured for `model_name`. `probe` runs a model
+    on fixed inputs and returns its outputs, `load_onnx` loads the ONNX Runtime variant of the model.
+    '''
+    options = load_options.get(model_name, {})
+    precision, backend = options.get('precision', 'fp32'), options.get('backend', 'torch')
+    if precision not in precisions or backend not in backends:
+        raise ValueError(f'Unsupported load options for {model_name}: {options}')
+    if precision == 'fp32' and backend == 'torch':
+        return model
+
+    check_accuracy = options.get('check_accuracy', True)
+    reference = probe(model) if check_accuracy else None
+    if backend == 'onnx':
+        if load_onnx is None:
+            raise ValueError(f'The onnx backend is not available for {model_name}')
+        converted = load_onnx()
+    elif precision == 'int8':
+        if model.device.type != 'cpu':
+            logger.warning(f'Dynamic int8 quantization runs on CPU only, keeping {model_name} in fp32 on {model.device}')
+            return model
+        converted = quantize_int8(model, inplace=not check_accuracy)
+    else:
+        if not supports_bf16(model.device):
+            logger.warning(f'{model.device} has no native bf16 support, keeping {model_name} in fp32')
+            return model
+        converted = (copy.deepcopy(model) if check_accuracy else model).to(torch.bfloat16)
+
+    variant = backend if backend == 'onnx' else precision
+    if check_accuracy:
+        similarity = compare_outputs(reference, probe(converted))
+        min_similarity = options.get('min_similarity', 0.99)
+        if similarity < min_similarity:
+            logger.warning(f'{variant} {model_name} reaches a similarity of {round(similarity, 4)} to fp32, below {min_similarity}, keeping fp32')
+            return model
+        logger.info(f'{variant} {model_name} reaches a similarity of {round(similarity, 4)} to fp32')
+
+    logger.info(f'Loaded {model_name} as {variant}, {format_size(get_module_size(converted))} of parameters')
+    return converted
+
+def quantize_int8(model: torch.nn.Module, inplace: bool = False) -> torch.nn.Module:
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=inplace)
+
+def supports_bf16(device: torch.device) -> bool:
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    try:
+        with open('/proc/cpuinfo', 'rt') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def compare_outputs(reference: torch.Tensor, outputs: torch.Tensor) -> float:
+    '''
+    Mean cosine similarity between the rows of two outputs, e.g. embeddings or per-position logits.
+    '''
+    reference, outputs = reference.float().flatten(0, -2), outputs.float().flatten(0, -2).to(reference.device)
+    return torch.nn.functional.cosine_similarity(reference, outputs, dim=-1).mean().item()
+
+def get_module_size(module: torch.nn.Module) -> int:
+    '''
+    Bytes taken by the parameters and buffers of `module`, including the packed weights of
+    dynamically quantized linear layers, which are neither.
+    '''
+    size = sum(tensor.numel() * tensor.element_size() for tensor in module.parameters())
+    size += sum(tensor.numel() * tensor.element_size() for tensor in module.buffers())
+    for submodule in module.modules():
+        if isinstance(submodule, torch.ao.nn.quantized.dynamic.Linear):
+            size += sum(tensor.numel() * tensor.element_size() for tensor in submodule._weight_bias() if tensor is not None)
+    return size + getattr(module, 'external_size', 0)
@@ -0,0 +1,239 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set
+from concurrent.futures import Future
+from time import time, sleep
+from utils import createLogger, parse_size, format_size
+from quantization import get_module_size
+import os, gc, ctypes, threading, torch
+
+logger = createLogger(__name__)
+
+@dataclass
+class RegistryEntry:
+    value: tuple
+    size: int
+    last_used: float
+    pinned: bool = False
+
+
+class ModelRegistry:
+    '''
+    A single cache for every loaded model together with its tokenizer. Entries are evicted in LRU
+    order whenever the total parameter memory would exceed `memory_budget` bytes (0 disables the
+    limit) or there are more than `max_entries` of them. Pinned entries are never evicted, and
+    unpinned entries that have not been used for `idle_ttl` seconds (0 disables it) are unloaded
+    by a background thread.
+    All methods are thread-safe, and `get_or_load` makes concurrent callers for a model that is
+    still loading wait for that one load instead of starting their own. Evicted entries are
+    removed under the lock but their memory is released after it, so that lookups of other
+    models do not wait for the garbage collector.
+    '''
+    def __init__(self, memory_budget: int, max_entries: int, idle_ttl: float, pinned: Set[str]):
+        self.entries: OrderedDict[str, RegistryEntry] = OrderedDict()
+        self.loading: Dict[str, Future] = {}
+        self.lock = threading.RLock()
+        self.known_sizes: Dict[str, int] = {}
+        self.memory_budget = memory_budget
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.pinned = pinned
+        self.reaper = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+            entry.last_used = time()
+            return entry.value
+
+    def get_or_load(self, key: str, load: Callable[[], tuple]) -> tuple:
+        with self.lock:
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            loading = self.loading.get(key)
+            if loading is None:
+                loading = self.loading[key] = Future()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            logger.debug(f'Waiting for {key} to be loaded by another request')
+            return loading.result()
+
+        try:
+            self.reserve(key)
+            value = load()
+            self.put(key, value)
+            loading.set_result(value)
+            return value
+        except Exception as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def put(self, key: str, value: tuple) -> None:
+        size = get_memory_size(value)
+        with self.lock:
+            # a replaced entry is released like an evicted one
+            evicted = [self.entries.pop(key)] if key in self.entries else []
+            self.known_sizes[key] = size
+            evicted += self.make_room(size)
+            if self.memory_budget and self.used_memory() + size > self.memory_budget:
+                logger.warning(f'Loading {key} ({format_size(size)}) exceeds the model memory budget of {format_size(self.memory_budget)}')
+
+            self.entries[key] = RegistryEntry(value=value, size=size, last_used=time(), pinned=self.is_pinned(key))
+            logger.info(f'Cached {key} ({format_size(size)}), {format_size(self.used_memory())} of model memory in use')
+        release_entries(evicted)
+        self.start_reaper()
+
+    def hasKey(self, key: str):
+        with self.lock:
+            return key in self.entries
+
+    def reserve(self, key: str) -> None:
+        '''
+        Evicts ahead of loading `key` if its size is known from an earlier load, so the new model
+        and the ones it replaces are never resident at the same time.
+        '''
+        with self.lock:
+            evicted = self.make_room(self.known_sizes[key]) if key in self.known_sizes else []
+        release_entries(evicted)
+
+    def make_room(self, size: int) -> List[RegistryEntry]:
+        '''
+        Removes entries in LRU order until `size` more bytes fit and returns them, for the caller
+        to release once it no longer holds the lock.
+        '''
+        evicted = []
+        with self.lock:
+            for key in list(self.entries.keys()):
+                over_budget = self.memory_budget and self.used_memory() + size > self.memory_budget
+                over_capacity = len(self.entries) >= self.max_entries
+                if not over_budget and not over_capacity:
+                    break
+                if not self.entries[key].pinned:
+                    evicted.append(self.remove(key))
+        return evicted
+
+    def remove(self, key: str) -> Optional[RegistryEntry]:
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.evictions += 1
+                logger.info(f'Evicted {key} ({format_size(entry.size)}) from the model cache')
+            return entry
+
+    def evict(self, key: str) -> None:
+        release_entries([self.remove(key)])
+
+    def evict_idle(self) -> None:
+        with self.lock:
+            now = time()
+            idle = [key for key, entry in self.entries.items() if not entry.pinned and now - entry.last_used > self.idle_ttl]
+            for key in idle:
+                logger.info(f'{key} has been idle for {round(now - self.entries[key].last_used)} seconds')
+            evicted = [self.remove(key) for key in idle]
+        release_entries(evicted)
+
+    def evict_all(self, prefix: str = '') -> None:
+        with self.lock:
+            evicted = [self.remove(key) for key in [key for key, entry in self.entries.items() if key.startswith(prefix) and not entry.pinned]]
+        release_entries(evicted)
+
+    def pin(self, key: str) -> None:
+        with self.lock:
+            self.pinned.add(key.split(':', 1)[-1])
+            if key in self.entries:
+                self.entries[key].pinned = True
+
+    def unpin(self, key: str) -> None:
+        with self.lock:
+            self.pinned.discard(key.split(':', 1)[-1])
+            if key in self.entries:
+                self.entries[key].pinned = False
+
+    def is_pinned(self, key: str) -> bool:
+        return key.split(':', 1)[-1] in self.pinned
+
+    def used_memory(self) -> int:
+        with self.lock:
+            return sum(entry.size for entry in self.entries.values())
+
+    def start_reaper(self):
+        with self.lock:
+            if self.idle_ttl <= 0 or self.reaper is not None:
+                return
+            self.reaper = threading.Thread(target=self.reap, name='model-registry-reaper', daemon=True)
+            self.reaper.start()
+
+    def reap(self):
+        interval = min(max(self.idle_ttl / 4, 1), 60)
+        while True:
+            sleep(interval)
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception('Unloading idle models failed')
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time()
+            return {
+                'used_memory': self.used_memory(),
+                'memory_budget': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'loading': list(self.loading.keys()),
+                'models': {
+                    key: {'size': entry.size, 'pinned': entry.pinned, 'idle_seconds': round(now - entry.last_used, 3)}
+                    for key, entry in self.entries.items()
+                }
+            }
+
+
+def get_memory_size(value: tuple) -> int:
+    size = 0
+    for item in value:
+        if isinstance(item, torch.nn.Module):
+            size += get_module_size(item)
+    return size
+
+def release_entries(entries: List[Optional[RegistryEntry]]):
+    # drops the last references of the registry before collecting, callers must not hold its lock
+    if any(entry is not None for entry in entries):
+        entries.clear()
+        release_memory()
+
+def release_memory():
+    '''
+    Collects the dropped model and gives the freed memory back: the CUDA caching allocator
+    keeps its blocks and glibc keeps freed arenas unless they are asked to release them.
+    '''
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+model_registry = ModelRegistry(
+    memory_budget=parse_size(os.getenv('MODEL-MEMORY-BUDGET', '0')),
+    max_entries=int(os.getenv('MAX-CACHED-MODELS', '8')),
+    idle_ttl=float(os.getenv('MODEL-IDLE-TTL', '0')),
+    pinned=set(name.strip() for name in os.getenv('PINNED-MODELS', '').split(',') if name.strip())
+)
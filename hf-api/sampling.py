@@ -0,0 +1,127 @@
+from typing import List, Optional, Tuple
+from dataclasses import dataclass, field
+from time import time
+from transformers import StoppingCriteria, LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper, RepetitionPenaltyLogitsProcessor
+import threading, torch
+
+class RequestCancelled(Exception):
+    pass
+
+@dataclass
+class SamplingParams:
+    max_new_tokens: int
+    n: int = 1
+    do_sample: bool = True
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = 0
+    repetition_penalty: float = 1.0
+    stop: List[str] = field(default_factory=list)
+    deadline: Optional[float] = None
+    # set when the client is gone, cannot be sent to worker processes
+    cancelled: Optional[threading.Event] = None
+
+    @staticmethod
+    def from_request(request, cancelled: Optional[threading.Event] = None) -> 'SamplingParams':
+        # frequency_penalty defaults to 1.0 in our request models, i.e. it follows the multiplicative
+        # `repetition_penalty` of transformers rather than OpenAI's additive one; values <= 0 disable it
+        penalty = request.frequency_penalty if request.frequency_penalty is not None and request.frequency_penalty > 0 else 1.0
+        return SamplingParams(
+            max_new_tokens=request.max_tokens,
+            n=max(request.n, 1),
+            do_sample=request.temperature > 0,
+            temperature=request.temperature if request.temperature > 0 else 1.0,
+            top_p=request.top_p,
+            top_k=request.top_k or 0,
+            repetition_penalty=penalty,
+            stop=[stop for stop in (request.stop or []) if stop],
+            deadline=request.deadline,
+            cancelled=cancelled
+        )
+
+    def is_cancelled(self) -> bool:
+        return (self.cancelled is not None and self.cancelled.is_set()) or self.is_past_deadline()
+
+    def is_past_deadline(self) -> bool:
+        return self.deadline is not None and time() >= self.deadline
+
+    def to_generate_kwargs(self) -> dict:
+        kwargs = dict(max_new_tokens=self.max_new_tokens, do_sample=self.do_sample, num_return_sequences=self.n, repetition_penalty=self.repetition_penalty)
+        if self.do_sample:
+            kwargs.update(temperature=self.temperature, top_p=self.top_p, top_k=self.top_k)
+        else:
+            kwargs.update(temperature=None, top_p=None, top_k=None)
+        return kwargs
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    '''
+    Stops each row of a `generate` call as soon as its generated text contains one of `stop`.
+    '''
+    def __init__(self, tokenizer, stop: List[str], prompt_length: int):
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = [has_stop(self.tokenizer, row.tolist(), self.stop) for row in input_ids[:, self.prompt_length:]]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class CancellationCriteria(StoppingCriteria):
+    '''
+    Stops all rows of a `generate` call once its request is cancelled or past its deadline.
+    '''
+    def __init__(self, params: SamplingParams):
+        self.params = params
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.params.is_cancelled(), dtype=torch.bool, device=input_ids.device)
+
+
+def build_logits_processor(params: SamplingParams) -> LogitsProcessorList:
+    processors = LogitsProcessorList()
+    if params.repetition_penalty != 1.0:
+        processors.append(RepetitionPenaltyLogitsProcessor(penalty=params.repetition_penalty))
+    if params.do_sample:
+        if params.temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(params.temperature))
+        if params.top_k > 0:
+            processors.append(TopKLogitsWarper(top_k=params.top_k))
+        if params.top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p=params.top_p))
+    return processors
+
+def has_stop(tokenizer, generated_ids: List[int], stop: List[str]) -> bool:
+    '''
+    Checks the text of the last tokens for a stop sequence. Tokens practically always decode to at
+    least one character, so the tail is long enough to contain the longest stop string.
+    '''
+    if len(stop) == 0:
+        return False
+    tail_length = max(len(text) for text in stop) + 8
+    return find_stop(tokenizer.decode(generated_ids[-tail_length:], skip_special_tokens=True), stop) >= 0
+
+def find_stop(text: str, stop: List[str]) -> int:
+    positions = [text.find(stop_text) for stop_text in stop]
+    positions = [position for position in positions if position >= 0]
+    return min(positions) if len(positions) > 0 else -1
+
+def finish_text(text: str, stop: List[str]) -> Tuple[str, Optional[str]]:
+    '''
+    Cuts `text` at the first stop sequence. Returns the text and 'stop_sequence' if one was found.
+    '''
+    position = find_stop(text, stop)
+    if position < 0:
+        return text, None
+    return text[:position], 'stop_sequence'
+
+def get_eos_token_ids(model, tokenizer) -> List[int]:
+    eos_token_ids = model.generation_config.eos_token_id
+    if eos_token_ids is None:
+        eos_token_ids = []
+    elif isinstance(eos_token_ids, int):
+        eos_token_ids = [eos_token_ids]
+    if tokenizer.eos_token_id is not None and tokenizer.eos_token_id not in eos_token_ids:
+        eos_token_ids = list(eos_token_ids) + [tokenizer.eos_token_id]
+    return list(eos_token_ids)
@@ -0,0 +1,205 @@
+from typing import Callable, List, Optional, Tuple
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from transformers.generation.streamers import BaseStreamer
+from transformers import LogitsProcessorList
+from prefix_cache import PrefixCache
+from sampling import SamplingParams, RequestCancelled, build_logits_processor, has_stop, get_eos_token_ids
+from kv_cache import LegacyCache, to_legacy_cache, from_legacy_cache, cache_length, merge_caches, split_cache
+from utils import createLogger, span, record_span
+from time import perf_counter
+import threading, queue, torch
+
+logger = createLogger(__name__)
+
+@dataclass
+class Sequence:
+    prompt_ids: List[int]
+    params: SamplingParams
+    logits_processor: LogitsProcessorList
+    future: Future = field(default_factory=Future)
+    generated_ids: List[int] = field(default_factory=list)
+    past_key_values: Optional[LegacyCache] = None
+    finish_reason: Optional[str] = None
+    streamer: Optional[BaseStreamer] = None
+    submitted_at: float = field(default_factory=perf_counter)
+    first_token_at: Optional[float] = None
+
+
+class GenerationScheduler:
+    '''
+    Continuous batching for one causal LM. Requests are admitted into the running batch between
+    decode steps, every sequence keeps its own KV cache, and finished sequences leave the batch
+    as soon as they hit EOS, a stop sequence or their token budget instead of waiting for the
+    longest one. The `n` sequences of a request share one prefill and sample from it independently.
+    Cancelled requests are skipped before prefill and leave the batch at the next step.
+    The worker thread exits when there is nothing left to do and is restarted on the next submit.
+    '''
+    def __init__(self, name: str, load: Callable[[], Tuple[object, object]], max_batch_size: int, prefix_cache: Optional[PrefixCache] = None):
+        self.name = name
+        self.load = load
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.pending: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.tokenizer = None
+        self.eos_token_ids: List[int] = []
+
+    def submit(self, prompt_ids: List[int], params: SamplingParams, streamer: Optional[BaseStreamer] = None) -> List[Future]:
+        '''
+        Returns one future per requested sequence, each resolving to `(generated_ids, finish_reason)`.
+        A streamer only receives the tokens of the first sequence.
+        '''
+        logits_processor = build_logits_processor(params)
+        group = [Sequence(prompt_ids=prompt_ids, params=params, logits_processor=logits_processor) for _ in range(params.n)]
+        group[0].streamer = streamer
+        with self.lock:
+            self.pending.put(group)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f'scheduler-{self.name}', daemon=True)
+                self.thread.start()
+        return [sequence.future for sequence in group]
+
+    def run(self):
+        try:
+            model, tokenizer = self.load()
+        except Exception as e:
+            logger.exception(f'Loading {self.name} for generation failed')
+            with self.lock:
+                while not self.pending.empty():
+                    for sequence in self.pending.get_nowait():
+                        sequence.future.set_exception(e)
+                self.thread = None
+            return
+
+        self.tokenizer = tokenizer
+        self.eos_token_ids = get_eos_token_ids(model, tokenizer)
+        active: List[Sequence] = []
+
+        while True:
+            with self.lock:
+                if len(active) == 0 and self.pending.empty():
+                    self.thread = None
+                    return
+
+            try:
+                while len(active) < self.max_batch_size and not self.pending.empty():
+                    active.extend(self.admit(model, self.pending.get_nowait()))
+
+                active = self.retire(active)
+                if len(active) > 0:
+                    self.decode(model, active)
+                    active = self.retire(active)
+            except Exception as e:
+                logger.exception(f'Generation step for {self.name} failed')
+                for sequence in active:
+                    self.fail(sequence, e)
+                active = []
+
+    def admit(self, model, group: List[Sequence]) -> List[Sequence]:
+        group = [sequence for sequence in group if sequence.future.set_running_or_notify_cancel()]
+        if len(group) == 0:
+            return []
+        if group[0].params.is_cancelled():
+            for sequence in group:
+                self.fail(sequence, RequestCancelled(f'Request for {self.name} cancelled before prefill'))
+            return []
+        record_span('queue_wait', perf_counter() - group[0].submitted_at, model=self.name)
+        try:
+            with span('prefill', model=self.name):
+                past_key_values, logits = self.prefill(model, group[0].prompt_ids)
+            first_token_at = perf_counter()
+            for sequence in group:
+                # the caches are never modified in place, so the sequences can share the prompt's one
+                sequence.past_key_values = past_key_values
+                sequence.first_token_at = first_token_at
+                self.append_token(sequence, logits)
+        except Exception as e:
+            for sequence in group:
+                self.fail(sequence, e)
+            return []
+        return group
+
+    @torch.inference_mode()
+    def prefill(self, model, prompt_ids: List[int]) -> Tuple[LegacyCache, torch.Tensor]:
+        cached_length, past_key_values = 0, None
+        if self.prefix_cache is not None:
+            cached_length, past_key_values = self.prefix_cache.lookup(self.name, prompt_ids)
+
+        input_ids = torch.tensor([prompt_ids[cached_length:]], device=model.device)
+        if past_key_values is None:
+            outputs = model(input_ids=input_ids, use_cache=True)
+        else:
+            outputs = model(input_ids=input_ids, past_key_values=from_legacy_cache(past_key_values), use_cache=True)
+        past_key_values = to_legacy_cache(outputs.past_key_values)
+
+        if self.prefix_cache is not None:
+            self.prefix_cache.put(self.name, prompt_ids, past_key_values)
+        return past_key_values, outputs.logits[:, -1, :]
+
+    @torch.inference_mode()
+    def decode(self, model, active: List[Sequence]):
+        lengths = [cache_length(sequence.past_key_values) for sequence in active]
+        past_key_values, attention_mask = merge_caches([sequence.past_key_values for sequence in active])
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1)
+        input_ids = torch.tensor([[sequence.generated_ids[-1]] for sequence in active], device=model.device)
+        position_ids = torch.tensor([[length] for length in lengths], device=model.device)
+
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(past_key_values),
+            use_cache=True
+        )
+
+        caches = split_cache(to_legacy_cache(outputs.past_key_values), [length + 1 for length in lengths])
+        for index, sequence in enumerate(active):
+            sequence.past_key_values = caches[index]
+            self.append_token(sequence, outputs.logits[index:index + 1, -1, :])
+
+    def append_token(self, sequence: Sequence, logits: torch.Tensor):
+        token_ids = torch.tensor([sequence.prompt_ids + sequence.generated_ids], device=logits.device)
+        scores = sequence.logits_processor(token_ids, logits.float())
+        if sequence.params.do_sample:
+            next_token = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).item()
+        else:
+            next_token = torch.argmax(scores, dim=-1).item()
+
+        if next_token in self.eos_token_ids:
+            sequence.finish_reason = 'eos_token'
+            return
+
+        sequence.generated_ids.append(next_token)
+        if sequence.streamer is not None:
+            sequence.streamer.put(torch.tensor([next_token]))
+        if has_stop(self.tokenizer, sequence.generated_ids, sequence.params.stop):
+            sequence.finish_reason = 'stop_sequence'
+        elif len(sequence.generated_ids) >= sequence.params.max_new_tokens:
+            sequence.finish_reason = 'length'
+
+    def retire(self, active: List[Sequence]) -> List[Sequence]:
+        running = []
+        for sequence in active:
+            if sequence.future.cancelled():
+                continue
+            if sequence.finish_reason is None and sequence.params.is_cancelled():
+                # the caller is gone or out of time and discards what was generated so far
+                sequence.finish_reason = 'length'
+            if sequence.finish_reason is None:
+                running.append(sequence)
+                continue
+            sequence.past_key_values = None
+            record_span('decode', perf_counter() - sequence.first_token_at, model=self.name)
+            if sequence.streamer is not None:
+                sequence.streamer.end()
+            sequence.future.set_result((sequence.generated_ids, sequence.finish_reason))
+        return running
+
+    def fail(self, sequence: Sequence, e: Exception):
+        sequence.past_key_values = None
+        if sequence.streamer is not None:
+            sequence.streamer.end()
+        sequence.future.set_exception(e)
+
@@ -0,0 +1,167 @@
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from transformers.generation.streamers import BaseStreamer
+from transformers import LogitsProcessorList
+from kv_cache import LegacyCache, to_legacy_cache, from_legacy_cache, cache_length, crop_cache
+from sampling import SamplingParams, build_logits_processor, has_stop
+from utils import createLogger
+import os, json, threading, torch
+
+logger = createLogger(__name__)
+
+# e.g. {"Qwen/Qwen1.5-7B-Chat": "Qwen/Qwen1.5-0.5B-Chat"}, the draft model must share the tokenizer of its target
+draft_models: Dict[str, str] = json.loads(os.getenv('SPECULATIVE-DRAFT-MODELS', '{}'))
+num_draft_tokens = int(os.getenv('SPECULATIVE-DRAFT-TOKENS', '4'))
+
+@dataclass
+class SpeculationStats:
+    drafted: int = 0
+    accepted: int = 0
+    target_steps: int = 0
+    generated: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'drafted': self.drafted,
+            'accepted': self.accepted,
+            'target_steps': self.target_steps,
+            'generated': self.generated,
+            'acceptance_rate': round(self.accepted / self.drafted, 4) if self.drafted > 0 else 0,
+            # the speedup over plain decoding if a draft step were free
+            'tokens_per_target_step': round(self.generated / self.target_steps, 4) if self.target_steps > 0 else 0,
+        }
+
+
+stats: Dict[str, SpeculationStats] = {}
+stats_lock = threading.Lock()
+compatible_drafts: Dict[Tuple[str, str], bool] = {}
+
+def get_draft_model_name(model_name: str) -> Optional[str]:
+    return draft_models.get(model_name)
+
+def is_compatible(model_name: str, tokenizer, draft_name: str, draft_tokenizer) -> bool:
+    key = (model_name, draft_name)
+    if key not in compatible_drafts:
+        compatible_drafts[key] = tokenizer.get_vocab() == draft_tokenizer.get_vocab()
+        if not compatible_drafts[key]:
+            logger.warning(f'{draft_name} does not share the tokenizer of {model_name}, generating without it')
+    return compatible_drafts[key]
+
+@torch.inference_mode()
+def speculative_generate(model_name: str, model, draft_model, tokenizer, prompt_ids: List[int], params: SamplingParams, eos_token_ids: List[int], streamer: Optional[BaseStreamer] = None) -> Tuple[List[int], str]:
+    '''
+    Speculative decoding of a single sequence. The draft model proposes `num_draft_tokens` tokens
+    one at a time, the target model scores all of them in one forward pass and keeps the longest
+    prefix it agrees with plus one token of its own. Greedy decoding keeps the draft tokens that
+    match the target's argmax, sampling accepts a draft token with probability min(1, p / q) and
+    otherwise resamples from max(0, p - q), so the output follows the target model either way.
+    Returns the generated ids and the finish reason. Like `generate`, the streamer receives the
+    prompt first and then every generated token.
+    '''
+    logits_processor = build_logits_processor(params)
+    tokens, generated = list(prompt_ids), []
+    if streamer is not None:
+        streamer.put(torch.tensor([prompt_ids]))
+
+    def append(token: int) -> Optional[str]:
+        if token in eos_token_ids:
+            return 'eos_token'
+        tokens.append(token)
+        generated.append(token)
+        if streamer is not None:
+            streamer.put(torch.tensor([token]))
+        if has_stop(tokenizer, generated, params.stop):
+            return 'stop_sequence'
+        if len(generated) >= params.max_new_tokens:
+            return 'length'
+        return None
+
+    # both caches always cover all tokens but the last one
+    target_cache, target_logits = forward(model, tokens, None)
+    draft_cache, draft_logits = forward(draft_model, tokens[:-1], None) if len(tokens) > 1 else (None, None)
+    vocab_size = min(target_logits.shape[-1], model.config.vocab_size, draft_model.config.vocab_size)
+    finish_reason = append(choose(params, score(logits_processor, tokens, target_logits[-1:, :vocab_size])))
+
+    run = SpeculationStats()
+    while finish_reason is None:
+        if params.is_cancelled():
+            finish_reason = 'length'
+            break
+
+        count = min(num_draft_tokens, params.max_new_tokens - len(generated))
+        context, draft_tokens, draft_probs = list(tokens), [], []
+        draft_cache, draft_logits = forward(draft_model, tokens[cache_length(draft_cache) if draft_cache is not None else 0:], draft_cache)
+        for index in range(count):
+            scores = score(logits_processor, context, draft_logits[-1:, :vocab_size])
+            probs = torch.softmax(scores, dim=-1)[0] if params.do_sample else None
+            token = choose(params, scores, probs)
+            context.append(token)
+            draft_tokens.append(token)
+            draft_probs.append(probs)
+            if index < count - 1:
+                draft_cache, draft_logits = forward(draft_model, [token], draft_cache)
+
+        target_cache, target_logits = forward(model, context[cache_length(target_cache):], target_cache)
+        accepted, next_token = 0, None
+        for index, token in enumerate(draft_tokens):
+            scores = score(logits_processor, context[:len(tokens) + index], target_logits[index:index + 1, :vocab_size])
+            if params.do_sample:
+                probs, draft_token_probs = torch.softmax(scores, dim=-1)[0], draft_probs[index]
+                if torch.rand(()).item() < min(1.0, (probs[token] / draft_token_probs[token]).item()):
+                    accepted += 1
+                    continue
+                residual = torch.clamp(probs - draft_token_probs, min=0)
+                next_token = torch.multinomial(residual / residual.sum() if residual.sum() > 0 else probs, num_samples=1).item()
+            else:
+                next_token = torch.argmax(scores, dim=-1).item()
+                if next_token == token:
+                    accepted, next_token = accepted + 1, None
+                    continue
+            break
+        if next_token is None:
+            next_token = choose(params, score(logits_processor, context, target_logits[count:count + 1, :vocab_size]))
+
+        length = len(generated)
+        for token in draft_tokens[:accepted] + [next_token]:
+            finish_reason = append(token)
+            if finish_reason is not None:
+                break
+        run.drafted, run.accepted = run.drafted + count, run.accepted + accepted
+        run.target_steps, run.generated = run.target_steps + 1, run.generated + len(generated) - length
+
+        target_cache = crop_cache(target_cache, len(tokens) - 1)
+        draft_cache = crop_cache(draft_cache, min(cache_length(draft_cache), len(tokens) - 1))
+
+    if streamer is not None:
+        streamer.end()
+    record_stats(model_name, run)
+    return generated, finish_reason
+
+def forward(model, input_ids: List[int], past_key_values: Optional[LegacyCache]) -> Tuple[LegacyCache, torch.Tensor]:
+    input_ids = torch.tensor([input_ids], device=model.device)
+    if past_key_values is None:
+        outputs = model(input_ids=input_ids, use_cache=True)
+    else:
+        outputs = model(input_ids=input_ids, past_key_values=from_legacy_cache(past_key_values), use_cache=True)
+    return to_legacy_cache(outputs.past_key_values), outputs.logits[0].float()
+
+def score(logits_processor: LogitsProcessorList, context: List[int], logits: torch.Tensor) -> torch.Tensor:
+    return logits_processor(torch.tensor([context], device=logits.device), logits)
+
+def choose(params: SamplingParams, scores: torch.Tensor, probs: Optional[torch.Tensor] = None) -> int:
+    if not params.do_sample:
+        return torch.argmax(scores, dim=-1).item()
+    probs = probs if probs is not None else torch.softmax(scores, dim=-1)[0]
+    return torch.multinomial(probs, num_samples=1).item()
+
+def record_stats(model_name: str, run: SpeculationStats):
+    with stats_lock:
+        total = stats.setdefault(model_name, SpeculationStats())
+        total.drafted += run.drafted
+        total.accepted += run.accepted
+        total.target_steps += run.target_steps
+        total.generated += run.generated
+
+def get_speculative_stats() -> dict:
+    with stats_lock:
+        return {model_name: model_stats.to_dict() for model_name, model_stats in stats.items()}
@@ -0,0 +1,4 @@
+import os, sys
+
+# the modules of hf-api import each other by name, as when api.py is run from this folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
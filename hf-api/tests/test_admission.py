@@ -0,0 +1,117 @@
+from time import time
+import asyncio
+import pytest
+import admission
+from admission import ConcurrencyLimiter, AdmissionRejected, DeadlineExceeded, ClientDisconnected, get_deadline, run_cancellable
+
+def test_admits_up_to_max_concurrency():
+    async def run():
+        limiter = ConcurrencyLimiter('model', 2, 0)
+        await limiter.acquire(1, None)
+        await limiter.acquire(1, None)
+        with pytest.raises(AdmissionRejected):
+            await limiter.acquire(1, None)
+        assert limiter.stats()['running'] == 2
+        assert limiter.stats()['rejected'] == 1
+    asyncio.run(run())
+
+def test_admits_queued_requests_by_priority_then_arrival():
+    async def run():
+        limiter = ConcurrencyLimiter('model', 1, 3)
+        await limiter.acquire(1, None)
+        order = []
+        async def wait(priority, name):
+            await limiter.acquire(priority, None)
+            order.append(name)
+        tasks = []
+        for priority, name in [(2, 'batch'), (1, 'first'), (1, 'second')]:
+            tasks.append(asyncio.create_task(wait(priority, name)))
+            await asyncio.sleep(0)
+        for _ in tasks:
+            limiter.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        assert order == ['first', 'second', 'batch']
+        limiter.release()
+        assert limiter.stats()['running'] == 0
+    asyncio.run(run())
+
+def test_expired_waiters_leave_the_queue():
+    async def run():
+        limiter = ConcurrencyLimiter('model', 1, 2)
+        await limiter.acquire(1, None)
+        for _ in range(2):
+            with pytest.raises(DeadlineExceeded):
+                await limiter.acquire(1, time() + 0.01)
+        assert limiter.stats()['queued'] == 0
+        assert limiter.stats()['expired'] == 2
+
+        # the queue has room again
+        waiter = asyncio.create_task(limiter.acquire(1, None))
+        await asyncio.sleep(0)
+        assert limiter.stats()['queued'] == 1
+        limiter.release()
+        await waiter
+        assert limiter.stats()['running'] == 1
+        assert limiter.stats()['queued'] == 0
+    asyncio.run(run())
+
+def test_cancelled_waiters_leave_the_queue():
+    async def run():
+        limiter = ConcurrencyLimiter('model', 1, 1)
+        await limiter.acquire(1, None)
+        waiter = asyncio.create_task(limiter.acquire(1, None))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.stats()['queued'] == 0
+        limiter.release()
+        assert limiter.stats()['running'] == 0
+    asyncio.run(run())
+
+def test_disconnected_client_gives_up_its_place(monkeypatch):
+    async def run():
+        limiter = ConcurrencyLimiter('all models', 1, 1)
+        monkeypatch.setattr(admission, 'global_limiter', limiter)
+        disconnected = False
+        async def is_disconnected():
+            return disconnected
+
+        async with admission.admit('model', 1, None):
+            async def queued():
+                async with admission.admit('model', 1, None, is_disconnected):
+                    pass
+            task = asyncio.create_task(queued())
+            await asyncio.sleep(0.05)
+            assert limiter.stats()['queued'] == 1
+            disconnected = True
+            with pytest.raises(ClientDisconnected):
+                await task
+            assert limiter.stats()['queued'] == 0
+        assert limiter.stats()['running'] == 0
+    asyncio.run(run())
+
+def test_deadline_header(monkeypatch):
+    monkeypatch.setattr(admission, 'request_timeout', 0)
+    assert get_deadline(None, None) is None
+    assert abs(get_deadline('2.5', None) - time() - 2.5) < 1
+    assert get_deadline('60', 100.0) == 100.0
+    for header in ['abc', 'nan', 'inf', '-1']:
+        with pytest.raises(ValueError):
+            get_deadline(header, None)
+
+def test_work_finished_past_the_deadline_is_not_returned():
+    async def connected():
+        return False
+    async def cut_short(cancelled, duration):
+        # like generation, which stops at the deadline by itself and returns what it has
+        await asyncio.sleep(duration)
+        return 'partial'
+    async def run():
+        assert await run_cancellable(lambda cancelled: cut_short(cancelled, 0), connected, time() + 5) == 'partial'
+        with pytest.raises(DeadlineExceeded):
+            await run_cancellable(lambda cancelled: cut_short(cancelled, 0), connected, time() - 1)
+        with pytest.raises(DeadlineExceeded):
+            await run_cancellable(lambda cancelled: cut_short(cancelled, 0.05), connected, time() + 0.05, poll_interval=1)
+    asyncio.run(run())
@@ -0,0 +1,63 @@
+import os, json, asyncio
+import pytest
+import batch_jobs
+from batch_jobs import parse_line, get_row_ids, read_chunk
+
+def test_parses_openai_batch_lines():
+    line = b'{"custom_id": "doc-1", "method": "POST", "url": "/v1/embeddings", "body": {"model": "m", "input": "hello"}}'
+    assert parse_line(line, 1) == ('doc-1', ['hello'], 'm')
+
+def test_parses_plain_lines():
+    assert parse_line(b'{"id": 7, "input": ["a", "b"]}', 1) == ('7', ['a', 'b'], None)
+    assert parse_line(b'{"input": "a"}', 3) == ('3', ['a'], None)
+
+@pytest.mark.parametrize('line', [b'not json', b'[1, 2]', b'{"input": 1}', b'{"input": ["a", 2]}', b'{"id": "a\\nb", "input": "a"}'])
+def test_rejects_invalid_lines(line):
+    with pytest.raises(ValueError, match='Line 5'):
+        parse_line(line, 5)
+
+def test_row_ids():
+    assert get_row_ids('doc', ['a']) == ['doc']
+    assert get_row_ids('doc', ['a', 'b']) == ['doc:0', 'doc:1']
+
+def upload(*chunks):
+    async def content():
+        for chunk in chunks:
+            yield chunk
+    return content()
+
+def test_create_job_checks_lines_across_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, 'jobs_folder', str(tmp_path))
+    monkeypatch.setattr(batch_jobs, 'get_job_queue', asyncio.Queue)
+    job = asyncio.run(batch_jobs.create_job(upload(b'{"id": "a", "input": "he', b'llo"}\n{"id": "b", "input": ["x", "y"]}')))
+    assert (job.total_requests, job.total_rows) == (2, 3)
+    folder = tmp_path / job.id
+    assert (folder / 'ids.txt').read_text() == 'a\nb:0\nb:1\n'
+    assert (folder / 'input.jsonl').read_bytes().endswith(b'\n')
+    assert json.loads((folder / 'job.json').read_text())['status'] == 'queued'
+
+@pytest.mark.parametrize('chunks', [[b'{"input": "' + b'x' * 64 + b'"}\n'], [b'{"input": "', b'x' * 64, b'x' * 64]])
+def test_create_job_rejects_long_lines(tmp_path, monkeypatch, chunks):
+    monkeypatch.setattr(batch_jobs, 'jobs_folder', str(tmp_path))
+    monkeypatch.setattr(batch_jobs, 'get_job_queue', asyncio.Queue)
+    monkeypatch.setattr(batch_jobs, 'max_line_size', 32)
+    with pytest.raises(ValueError, match='Line 1 is longer than 32 bytes'):
+        asyncio.run(batch_jobs.create_job(upload(*chunks)))
+    assert os.listdir(tmp_path) == []
+
+def test_read_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, 'chunk_size', 2)
+    path = tmp_path / 'input.jsonl'
+    lines = [b'{"input": "a"}\n', b'\n', b'{"input": ["b", "c"]}\n', b'{"input": "d"}\n']
+    path.write_bytes(b''.join(lines))
+    with open(path, 'rb') as input_file:
+        assert read_chunk(input_file) == (['a', 'b', 'c'], 2, len(b''.join(lines[:3])))
+        assert read_chunk(input_file) == (['d'], 1, len(b''.join(lines)))
+        assert read_chunk(input_file) == ([], 0, len(b''.join(lines)))
+
+def test_read_chunk_stops_at_long_lines(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, 'max_line_size', 16)
+    path = tmp_path / 'input.jsonl'
+    path.write_bytes(b'{"input": "' + b'x' * 64 + b'"}\n')
+    with open(path, 'rb') as input_file, pytest.raises(ValueError, match='longer than 16 bytes'):
+        read_chunk(input_file)
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import httpx
+import numpy as np
+from batching import DynamicBatcher
+
+def embed(texts):
+    if not all(isinstance(text, str) for text in texts):
+        raise TypeError('texts need to be strings')
+    return np.array([[len(text), 1.0] for text in texts], dtype=np.float32), [len(text) for text in texts]
+
+class CountingProcess:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        return embed(texts)
+
+def test_batches_concurrent_requests_and_slices_results():
+    async def run():
+        process = CountingProcess()
+        batcher = DynamicBatcher('model', process, executor, max_batch_size=8, max_wait_ms=50)
+        results = await asyncio.gather(batcher.submit(['a']), batcher.submit(['bb', 'ccc']), batcher.submit(['dddd']))
+        assert process.batches == [['a', 'bb', 'ccc', 'dddd']]
+        assert [token_counts for _, token_counts in results] == [[1], [2, 3], [4]]
+        assert results[1][0].tolist() == [[2, 1], [3, 1]]
+        assert batcher.stats()['batches'] == 1
+        assert batcher.stats()['requests'] == 3
+        assert batcher.stats()['queue_depth'] == 0
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(run())
+
+def test_splits_batches_at_max_batch_size():
+    async def run():
+        process = CountingProcess()
+        batcher = DynamicBatcher('model', process, executor, max_batch_size=2, max_wait_ms=50)
+        await asyncio.gather(*(batcher.submit([text]) for text in 'abc'))
+        assert process.batches == [['a', 'b'], ['c']]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(run())
+
+def test_failed_batch_fails_only_the_request_at_fault():
+    async def run():
+        process = CountingProcess()
+        batcher = DynamicBatcher('model', process, executor, max_batch_size=8, max_wait_ms=50)
+        valid, invalid, other = await asyncio.gather(batcher.submit(['a']), batcher.submit([1, 2]), batcher.submit(['bb']), return_exceptions=True)
+        assert valid[1] == [1]
+        assert other[1] == [2]
+        assert isinstance(invalid, TypeError)
+        assert process.batches == [['a', 1, 2, 'bb'], ['a'], [1, 2], ['bb']]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(run())
+
+def test_skips_requests_cancelled_while_queued():
+    async def run():
+        process = CountingProcess()
+        batcher = DynamicBatcher('model', process, executor, max_batch_size=8, max_wait_ms=50)
+        cancelled = asyncio.create_task(batcher.submit(['a']))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        assert await batcher.submit(['bb']) is not None
+        assert process.batches == [['bb']]
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(run())
+
+def test_invalid_input_does_not_fail_concurrent_requests(monkeypatch):
+    import api, embeddings
+    async def run():
+        batcher = DynamicBatcher('model', CountingProcess(), executor, max_batch_size=8, max_wait_ms=50)
+        monkeypatch.setattr(embeddings, 'dynamic_batching', True)
+        monkeypatch.setitem(embeddings.batchers, 'model', batcher)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url='http://test') as client:
+            valid, invalid = await asyncio.gather(
+                client.post('/v1/embeddings', json={'model': 'model', 'input': ['a', 'bb']}),
+                client.post('/v1/embeddings', json={'model': 'model', 'input': [{'a': 1}]})
+            )
+        assert valid.status_code == 200
+        assert [item['embedding'] for item in valid.json()['data']] == [[1, 1], [2, 1]]
+        assert invalid.status_code == 400
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(run())
@@ -0,0 +1,42 @@
+import numpy as np
+from embedding_cache import EmbeddingCache
+
+def stored_size(cache: EmbeddingCache) -> int:
+    return cache.db.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+
+def test_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.db'), memory_items=10, disk_size_limit=10 ** 6)
+    vectors = np.arange(8, dtype=np.float32).reshape(2, 4)
+    cache.put_many('model', ['a', 'b'], vectors, [3, 5])
+
+    results = cache.get_many('model', ['b', 'c', 'a'])
+    assert results[1] is None
+    np.testing.assert_array_equal(results[0][0], vectors[1])
+    assert results[0][1] == 5
+    assert results[2][1] == 3
+    assert cache.get_many('other model', ['a']) == [None]
+
+def test_disk_size_counts_repeated_texts_once(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.db'), memory_items=10, disk_size_limit=10 ** 6)
+    vectors = np.ones((3, 4), dtype=np.float32)
+    cache.put_many('model', ['a', 'a', 'b'], vectors, [1, 1, 1])
+    assert cache.disk_size == stored_size(cache) == 2 * 16
+
+    # a concurrent miss on the same text stores it again
+    cache.put_many('model', ['a', 'c'], vectors[:2], [1, 1])
+    assert cache.disk_size == stored_size(cache) == 3 * 16
+
+def test_disk_size_survives_reopening(tmp_path):
+    path = str(tmp_path / 'embeddings.db')
+    cache = EmbeddingCache(path, memory_items=10, disk_size_limit=10 ** 6)
+    cache.put_many('model', ['a', 'b'], np.ones((2, 4), dtype=np.float32), [1, 1])
+    cache.db.close()
+    assert EmbeddingCache(path, memory_items=10, disk_size_limit=10 ** 6).disk_size == 2 * 16
+
+def test_trims_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.db'), memory_items=1, disk_size_limit=100)
+    for index in range(7):
+        cache.put_many('model', [f'text {index}'], np.ones((1, 4), dtype=np.float32), [1])
+    assert cache.disk_size == stored_size(cache) <= 90
+    assert cache.get_many('model', ['text 0'])[0] is None
+    assert cache.get_many('model', ['text 6'])[0] is not None
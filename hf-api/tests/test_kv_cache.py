@@ -0,0 +1,23 @@
+import torch
+from kv_cache import merge_caches, split_cache, cache_length
+
+def make_cache(length: int, layers: int = 2):
+    return tuple((torch.randn(1, 2, length, 4), torch.randn(1, 2, length, 4)) for _ in range(layers))
+
+def test_merge_left_pads_and_split_restores():
+    caches = [make_cache(3), make_cache(5), make_cache(1)]
+    merged, attention_mask = merge_caches(caches)
+
+    assert cache_length(merged) == 5
+    assert merged[0][0].shape == (3, 2, 5, 4)
+    assert attention_mask.tolist() == [[0, 0, 1, 1, 1], [1, 1, 1, 1, 1], [0, 0, 0, 0, 1]]
+    for original, restored in zip(caches, split_cache(merged, [3, 5, 1])):
+        for (keys, values), (restored_keys, restored_values) in zip(original, restored):
+            torch.testing.assert_close(keys, restored_keys)
+            torch.testing.assert_close(values, restored_values)
+
+def test_merge_single_cache_is_unchanged():
+    cache = make_cache(4)
+    merged, attention_mask = merge_caches([cache])
+    assert merged is cache
+    assert attention_mask.tolist() == [[1, 1, 1, 1]]
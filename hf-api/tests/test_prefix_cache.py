@@ -0,0 +1,36 @@
+import torch
+from prefix_cache import PrefixCache
+
+def make_cache(length: int, layers: int = 2):
+    return tuple((torch.randn(1, 2, length, 4), torch.randn(1, 2, length, 4)) for _ in range(layers))
+
+def test_reuses_block_aligned_prefix():
+    cache = PrefixCache(block_size=4, memory_limit=10 ** 6)
+    prompt = list(range(10))
+    past_key_values = make_cache(10)
+    cache.put('model', prompt, past_key_values)
+
+    length, reused = cache.lookup('model', prompt[:8] + [100, 101, 102])
+    assert length == 8
+    torch.testing.assert_close(reused[0][0], past_key_values[0][0][:, :, :8])
+    assert cache.lookup('other model', prompt) == (0, None)
+    assert cache.lookup('model', [100] + prompt) == (0, None)
+
+def test_leaves_one_prompt_token_to_prefill():
+    cache = PrefixCache(block_size=4, memory_limit=10 ** 6)
+    cache.put('model', list(range(8)), make_cache(8))
+    assert cache.lookup('model', list(range(8)))[0] == 4
+
+def test_evicts_least_recently_used_within_memory_limit():
+    entry_size = 2 * 2 * (1 * 2 * 4 * 4) * 4
+    cache = PrefixCache(block_size=4, memory_limit=2 * entry_size)
+    prompts = [[index] * 5 for index in range(3)]
+    for prompt in prompts[:2]:
+        cache.put('model', prompt, make_cache(5))
+    cache.lookup('model', prompts[0])
+    cache.put('model', prompts[2], make_cache(5))
+
+    assert cache.stats()['used_memory'] == 2 * entry_size
+    assert cache.lookup('model', prompts[1])[0] == 0
+    assert cache.lookup('model', prompts[0])[0] == 4
+    assert cache.lookup('model', prompts[2])[0] == 4
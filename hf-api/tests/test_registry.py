@@ -0,0 +1,142 @@
+import threading, weakref
+import torch
+import registry
+from registry import ModelRegistry
+
+def make_model(size: int = 400) -> tuple:
+    # 4 bytes per float32 weight
+    return (torch.nn.Linear(size // 40, 10, bias=False), 'tokenizer')
+
+def make_registry(memory_budget: int = 0, max_entries: int = 8, pinned=()) -> ModelRegistry:
+    return ModelRegistry(memory_budget=memory_budget, max_entries=max_entries, idle_ttl=0, pinned=set(pinned))
+
+def test_evicts_least_recently_used_within_memory_budget():
+    models = make_registry(memory_budget=1000)
+    models.put('a', make_model())
+    models.put('b', make_model())
+    models.get('a')
+    models.put('c', make_model())
+
+    assert list(models.entries) == ['a', 'c']
+    assert models.used_memory() == 800
+    assert models.stats()['evictions'] == 1
+
+def test_evicts_beyond_max_entries():
+    models = make_registry(max_entries=2)
+    for key in 'abc':
+        models.put(key, make_model())
+    assert list(models.entries) == ['b', 'c']
+
+def test_never_evicts_pinned_entries():
+    models = make_registry(memory_budget=1000, pinned=['a'])
+    models.put('embedding:a', make_model())
+    models.put('b', make_model())
+    models.put('c', make_model())
+    assert list(models.entries) == ['embedding:a', 'c']
+
+    models.unpin('embedding:a')
+    models.pin('c')
+    models.put('d', make_model())
+    assert list(models.entries) == ['c', 'd']
+    models.evict_all()
+    assert list(models.entries) == ['c']
+
+def test_reserves_room_for_a_model_loaded_before():
+    models = make_registry(memory_budget=1000)
+    models.put('a', make_model())
+    models.evict('a')
+    models.put('b', make_model(800))
+    models.reserve('a')
+    assert list(models.entries) == []
+
+def test_evicts_idle_entries():
+    models = make_registry(pinned=['b'])
+    models.put('a', make_model())
+    models.put('b', make_model())
+    models.put('c', make_model())
+    models.entries['a'].last_used -= 10
+    models.entries['b'].last_used -= 10
+    models.idle_ttl = 5
+    models.evict_idle()
+    assert list(models.entries) == ['b', 'c']
+
+def test_releases_memory_without_holding_the_lock(monkeypatch):
+    models = make_registry(max_entries=1)
+    lock_free = []
+    def try_lock():
+        acquired = models.lock.acquire(timeout=1)
+        lock_free.append(acquired)
+        if acquired:
+            models.lock.release()
+    def release_memory():
+        # from another thread, since the lock is reentrant
+        thread = threading.Thread(target=try_lock)
+        thread.start()
+        thread.join()
+    monkeypatch.setattr(registry, 'release_memory', release_memory)
+
+    models.put('a', make_model())
+    models.put('b', make_model())
+    models.evict('b')
+    models.put('c', make_model())
+    models.evict_all()
+    assert lock_free == [True, True, True]
+
+def test_evicted_models_are_collected():
+    models = make_registry(max_entries=1)
+    models.put('a', make_model())
+    model = weakref.ref(models.get('a')[0])
+    models.put('b', make_model())
+    assert model() is None
+
+def load_concurrently(models: ModelRegistry, load, callers: int = 4) -> tuple:
+    results = []
+    def get():
+        try:
+            results.append(models.get_or_load('a', load))
+        except Exception as e:
+            results.append(e)
+    threads = [threading.Thread(target=get) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def test_loads_once_for_concurrent_callers():
+    models = make_registry()
+    started, finish, loads = threading.Event(), threading.Event(), []
+    def load():
+        loads.append(1)
+        started.set()
+        finish.wait(5)
+        return make_model()
+
+    threads, results = load_concurrently(models, load)
+    started.wait(5)
+    assert models.stats()['loading'] == ['a']
+    finish.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert all(result is results[0] for result in results)
+    assert models.stats()['loading'] == []
+
+def test_failed_load_reaches_every_caller_and_is_retried():
+    models = make_registry()
+    started, finish, loads = threading.Event(), threading.Event(), []
+    def load():
+        loads.append(1)
+        started.set()
+        finish.wait(5)
+        raise OSError('not found')
+
+    threads, results = load_concurrently(models, load)
+    started.wait(5)
+    finish.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 1
+    assert all(isinstance(result, OSError) for result in results)
+    assert models.get_or_load('a', make_model) is not None
+    assert list(models.entries) == ['a']
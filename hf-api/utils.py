@@ -1,22 +1,56 @@
-from time import time
-import sys, logging
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+from contextlib import ContextDecorator
+import sys, logging, threading
 from collections import OrderedDict
 
 Embedding_Model_Cache_Folder = './.cached_models/embedding/'
 Text_Generation_Model_Cache_Folder = './.cached_models/text-generation/'
+Embedding_Result_Cache_File = './.cached_embeddings/embeddings.db'
+Batch_Jobs_Folder = './.batch_jobs/'
 
-def timer(logger):
-    def wrapper(func):
-        def decorate(*args,**kwargs):
-            time_start = time()
-            logger.debug(f'The execution of method {func.__name__} starts...')
-            result = func(*args, **kwargs)
-            time_finish = time()
-            time_spend = time_finish - time_start
-            logger.debug(f'The execution of method {func.__name__} finished in  {round(time_spend, 3)} seconds.')
-            return result
-        return decorate
-    return wrapper
+span_listeners: List[Callable[[str, Dict[str, str], float], None]] = []
+
+class span(ContextDecorator):
+    '''
+    Times one stage of handling a request, used as a context manager or as a decorator, in which
+    case the stage defaults to the function name. Finished spans are logged at debug level and
+    passed to every function in `span_listeners` together with their labels, e.g. the model.
+    '''
+    def __init__(self, stage: Optional[str] = None, logger: Optional[logging.Logger] = None, **labels: str):
+        self.stage = stage
+        self.logger = logger
+        self.labels = labels
+        self.started_at = None
+
+    def __call__(self, func):
+        if self.stage is None:
+            self.stage = func.__name__
+        return super().__call__(func)
+
+    def _recreate_cm(self):
+        # a decorated function may run on several threads at once, every call needs its own start time
+        return span(self.stage, self.logger, **self.labels)
+
+    def __enter__(self):
+        if self.logger is not None:
+            self.logger.debug(f'The execution of {self.stage} starts...')
+        self.started_at = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.started_at
+        if self.logger is not None:
+            self.logger.debug(f'The execution of {self.stage} finished in {round(elapsed, 3)} seconds.')
+        record_span(self.stage, elapsed, **self.labels)
+        return False
+
+def record_span(stage: str, elapsed: float, **labels: str):
+    '''
+    Reports a stage that was timed elsewhere, e.g. how long a request waited in a queue.
+    '''
+    for listener in span_listeners:
+        listener(stage, labels, elapsed)
 
 def createLogger(name):
     logger = logging.getLogger(name)
@@ -27,25 +61,40 @@ def createLogger(name):
     logger.addHandler(stream_handler)
     return logger
 
+def parse_size(size: str) -> int:
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+    size = size.strip().upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * multiplier)
+    return int(float(size or '0'))
+
+def format_size(size: int) -> str:
+    return f'{round(size / 1024 ** 2, 1)} MB'
+
 
 class LRUCache:
     def __init__(self, capacity: int):
         self.cache = OrderedDict()
         self.capacity = capacity
+        self.lock = threading.Lock()
 
     def get(self, key: str) -> object:
-        if key not in self.cache:
-            return None
-        else:
-            self.cache.move_to_end(key)
-            return self.cache[key]
+        with self.lock:
+            if key not in self.cache:
+                return None
+            else:
+                self.cache.move_to_end(key)
+                return self.cache[key]
 
     def put(self, key: str, value: object) -> None:
-        if key in self.cache:
-            del self.cache[key]
-        elif len(self.cache) >= self.capacity:
-            self.cache.popitem(last=False)
-        self.cache[key] = value
+        with self.lock:
+            if key in self.cache:
+                del self.cache[key]
+            elif len(self.cache) >= self.capacity:
+                self.cache.popitem(last=False)
+            self.cache[key] = value
 
     def hasKey(self, key: str):
-        return key in self.cache
+        with self.lock:
+            return key in self.cache
@@ -0,0 +1,96 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Union
+from utils import createLogger
+import os, json, threading, multiprocessing, torch
+
+logger = createLogger(__name__)
+
+pools: Dict[str, ProcessPoolExecutor] = {}
+pools_lock = threading.Lock()
+in_worker = False
+
+def get_worker_config() -> Dict[str, dict]:
+    '''
+    PROCESS-WORKERS maps model names to the worker processes that serve them, e.g.
+    {"BAAI/bge-small-zh-v1.5": {"workers": 4, "threads": 8, "cpus": "0-31"}}.
+    `threads` defaults to an even share of the CPUs and `cpus` pins the workers to the given cores.
+    Models without an entry run in the API process, as do streamed and continuously batched completions.
+    '''
+    return json.loads(os.getenv('PROCESS-WORKERS', '{}'))
+
+worker_config = get_worker_config()
+
+def get_worker_pool(model_name: str) -> Optional[ProcessPoolExecutor]:
+    '''
+    Returns the process pool of `model_name`, or None if it runs in this process.
+    Inside a worker process this is always None, so the same code path runs the model locally.
+    '''
+    if in_worker or model_name not in worker_config:
+        return None
+
+    with pools_lock:
+        if model_name not in pools:
+            config = worker_config[model_name]
+            workers = int(config.get('workers', 1))
+            threads = int(config.get('threads', max(1, (os.cpu_count() or 1) // workers)))
+            cpus = parse_cpus(config.get('cpus', ''))
+            # spawn instead of fork: forking a process with running threads and an initialized torch is unsafe
+            pools[model_name] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(model_name, threads, cpus)
+            )
+            logger.info(f'Started a pool of {workers} worker processes with {threads} threads each for {model_name}')
+        return pools[model_name]
+
+def init_worker(model_name: str, threads: int, cpus: List[int]):
+    global in_worker
+    in_worker = True
+    if len(cpus) > 0 and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    logger.info(f'Worker process for {model_name} uses {threads} threads')
+
+def run_on_workers(model_name: str, func: Callable, *args) -> bool:
+    '''
+    Submits `func` once per worker process of `model_name` and waits for it, e.g. to load and
+    warm up the model in every worker. Returns False if the model runs in this process.
+    '''
+    pool = get_worker_pool(model_name)
+    if pool is None:
+        return False
+
+    # the tasks are submitted together so that every idle worker picks up one of them
+    futures = [pool.submit(func, *args) for _ in range(int(worker_config[model_name].get('workers', 1)))]
+    wait(futures)
+    for future in futures:
+        future.result()
+    return True
+
+def parse_cpus(cpus: Union[str, List[int]]) -> List[int]:
+    if isinstance(cpus, list):
+        return [int(cpu) for cpu in cpus]
+
+    result = []
+    for part in cpus.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-', 1)
+            result.extend(range(int(start), int(end) + 1))
+        elif part:
+            result.append(int(part))
+    return result
+
+def get_worker_stats() -> dict:
+    with pools_lock:
+        return {
+            model_name: {**config, 'started': model_name in pools}
+            for model_name, config in worker_config.items()
+        }
+
+def shutdown_workers():
+    with pools_lock:
+        for pool in pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        pools.clear()